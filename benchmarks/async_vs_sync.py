@@ -0,0 +1,95 @@
+"""
+Requests per second of the same customer lookup served two ways, against the database
+in DATABASE_URL:
+
+- sync:  a `def` endpoint on the sync SessionLocal (psycopg2), which FastAPI runs on
+         Starlette's threadpool
+- async: the real `/customer/by-email/{email}` endpoint on AsyncSession (asyncpg)
+
+Both apps are driven in process through httpx's ASGI transport, so the numbers compare
+the request paths rather than the network. Usage:
+
+    python -m benchmarks.async_vs_sync --requests 5000 --concurrency 50 100 200
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+import httpx
+from fastapi import Depends, FastAPI, HTTPException
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from src.data.async_database import async_engine
+from src.data.database import Base, engine, get_db
+from src.data.tables.customer import Customer
+from src.main import app as async_app
+from src.rest_api.schemas import CustomerResponse
+
+sync_app = FastAPI()
+
+
+@sync_app.get("/customer/by-email/{email}", response_model=CustomerResponse)
+def get_customer_by_email(email: str, db: Session = Depends(get_db)):
+    customer = db.scalar(select(Customer).filter(Customer.email == email))
+    if not customer:
+        raise HTTPException(status_code=404, detail="Customer not found")
+    return customer
+
+
+async def create_customer(email: str):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=async_app), base_url="http://bench") as client:
+        response = await client.post("/customer/", json={
+            "email": email,
+            "phone_number": uuid.uuid4().hex[:20],
+            "first_name": "Bench",
+            "last_name": "Mark",
+            "billing_address": {
+                "location_type": "billing",
+                "address_line_1": "1 Benchmark Way",
+                "city": "Loadville",
+                "state": "CA",
+                "zip_code": "90000"
+            }
+        })
+        response.raise_for_status()
+
+
+async def run(app, path: str, total_requests: int, concurrency: int) -> float:
+    """Issue total_requests GETs with `concurrency` in flight and return requests per second."""
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", limits=limits) as client:
+        remaining = iter(range(total_requests))
+
+        async def worker():
+            for _ in remaining:
+                response = await client.get(path)
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return total_requests / (time.perf_counter() - start)
+
+
+async def main(total_requests: int, concurrency_levels: list[int]):
+    Base.metadata.create_all(bind=engine)
+    email = f"bench-{uuid.uuid4().hex[:8]}@example.com"
+    await create_customer(email)
+    path = f"/customer/by-email/{email}"
+
+    print(f"{'concurrency':>12} {'sync req/s':>12} {'async req/s':>12} {'speedup':>8}")
+    for concurrency in concurrency_levels:
+        sync_rps = await run(sync_app, path, total_requests, concurrency)
+        async_rps = await run(async_app, path, total_requests, concurrency)
+        print(f"{concurrency:>12} {sync_rps:>12.0f} {async_rps:>12.0f} {async_rps / sync_rps:>7.2f}x")
+
+    await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50, 100, 200])
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency))
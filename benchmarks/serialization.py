@@ -0,0 +1,97 @@
+"""
+Time to turn a result of N rows into a response body, two ways:
+
+- fastapi: what a `response_model` endpoint does with the rows, validate them against the
+           response model, dump them to JSON compatible Python and encode that with the
+           stdlib json module (JSONResponse)
+- orjson:  what the analytics and customer/purchase endpoints do now, build the dicts
+           straight from the rows and encode them with orjson
+
+for an analytics shaped payload (dicts of a zip code and a count) and for CustomerResponse
+rows read from ORM objects. Nothing touches the database. Usage:
+
+    python -m benchmarks.serialization --rows 10000 100000 --repeat 5
+"""
+import argparse
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List
+
+import orjson
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+from src.rest_api.responses import model_fields
+from src.rest_api.schemas import CustomerResponse
+
+analytics_adapter = TypeAdapter(List[Dict[str, Any]])
+customer_adapter = TypeAdapter(List[CustomerResponse])
+
+
+def zip_order_counts(rows: int) -> list:
+    return [SimpleNamespace(zip_code=f"{index:05d}", order_count=rows - index) for index in range(rows)]
+
+
+def customers(rows: int) -> list:
+    return [
+        SimpleNamespace(
+            id=index,
+            email=f"customer{index}@example.com",
+            phone_number=f"555{index:07d}",
+            first_name="Bench",
+            last_name=f"Mark {index}",
+            billing_location_id=index % 1000
+        )
+        for index in range(rows)
+    ]
+
+
+def fastapi_analytics(rows: list) -> bytes:
+    content = [{"zip_code": row.zip_code, "order_count": row.order_count} for row in rows]
+    return JSONResponse(analytics_adapter.dump_python(analytics_adapter.validate_python(content), mode="json")).body
+
+
+def orjson_analytics(rows: list) -> bytes:
+    return orjson.dumps([{"zip_code": row.zip_code, "order_count": row.order_count} for row in rows])
+
+
+def fastapi_customers(rows: list) -> bytes:
+    validated = customer_adapter.validate_python(rows, from_attributes=True)
+    return JSONResponse(customer_adapter.dump_python(validated, mode="json")).body
+
+
+def orjson_customers(rows: list) -> bytes:
+    return orjson.dumps([model_fields(CustomerResponse, row) for row in rows])
+
+
+def best_time(render: Callable[[list], bytes], rows: list, repeat: int) -> float:
+    """Fastest of `repeat` runs, in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        render(rows)
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def main(row_counts: list[int], repeat: int):
+    payloads = [
+        ("analytics", zip_order_counts, fastapi_analytics, orjson_analytics),
+        ("customers", customers, fastapi_customers, orjson_customers)
+    ]
+    print(f"{'payload':>10} {'rows':>8} {'fastapi ms':>11} {'orjson ms':>10} {'speedup':>8}")
+    for name, make_rows, slow, fast in payloads:
+        for row_count in row_counts:
+            rows = make_rows(row_count)
+            assert orjson.loads(slow(rows)) == orjson.loads(fast(rows))
+            slow_ms = best_time(slow, rows, repeat)
+            fast_ms = best_time(fast, rows, repeat)
+            print(f"{name:>10} {row_count:>8} {slow_ms:>11.1f} {fast_ms:>10.1f} {slow_ms / fast_ms:>7.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    main(args.rows, args.repeat)
@@ -1,5 +1,9 @@
 from src.data.database import engine, get_db, Base
+from src.data.async_database import async_engine, get_async_db
+from src.data.read_replicas import get_read_db
+from src.data.schema_upgrades import create_schema
 
 
 def create_tables():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    with engine.begin() as connection:
+        create_schema(connection)
\ No newline at end of file
@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from typing import Any, Optional
+from sqlalchemy import event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool, QueuePool
+
+
+# Connection pool settings of the primary engines (and replicas, see read_replicas.py)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Seconds a checkout waits for a free connection before giving up with a TimeoutError
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Test connections with a round trip on checkout, dropping ones the server closed
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
+# Replace connections older than this many seconds, -1 keeps them forever
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "-1"))
+# Readiness reports degraded once this share of a pool's connections is checked out
+DB_POOL_DEGRADED_RATIO = float(os.getenv("DB_POOL_DEGRADED_RATIO", "0.9"))
+
+
+class PoolMetrics:
+    """Counters for one engine's pool, kept up to date by the instrumented pools and pool events."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.checkouts = 0
+        self.checkout_wait_seconds = 0.0
+        self.max_checkout_wait_seconds = 0.0
+        self.timeouts = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.soft_invalidations = 0
+
+    def start_wait(self):
+        with self._lock:
+            self.waiting += 1
+
+    def end_wait(self, seconds: float, timed_out: bool):
+        with self._lock:
+            self.waiting -= 1
+            if timed_out:
+                self.timeouts += 1
+                return
+            self.checkouts += 1
+            self.checkout_wait_seconds += seconds
+            self.max_checkout_wait_seconds = max(self.max_checkout_wait_seconds, seconds)
+
+    def count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "waiting": self.waiting,
+                "checkouts": self.checkouts,
+                "checkout_wait_seconds": {
+                    "total": round(self.checkout_wait_seconds, 6),
+                    "avg": round(self.checkout_wait_seconds / self.checkouts, 6) if self.checkouts else 0.0,
+                    "max": round(self.max_checkout_wait_seconds, 6)
+                },
+                "timeouts": self.timeouts,
+                "connects": self.connects,
+                "invalidations": self.invalidations,
+                "soft_invalidations": self.soft_invalidations
+            }
+
+
+class InstrumentedPoolMixin:
+    """
+    Times _do_get, ie how long a checkout waited for a connection: either for one to be
+    checked back in or, below pool_size + max_overflow, for a new one to connect.
+    """
+    metrics: Optional[PoolMetrics] = None
+
+    def _do_get(self):
+        if self.metrics is None:
+            return super()._do_get()
+        self.metrics.start_wait()
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self.metrics.end_wait(time.perf_counter() - start, timed_out)
+
+    def recreate(self):
+        # dispose() and invalidation replace the pool, the new one carries on counting
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncAdaptedQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def pool_options(asyncio: bool = False) -> dict[str, Any]:
+    """create_engine/create_async_engine keyword arguments for an instrumented pool configured from the environment."""
+    return {
+        "poolclass": InstrumentedAsyncAdaptedQueuePool if asyncio else InstrumentedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "pool_recycle": DB_POOL_RECYCLE
+    }
+
+
+class PoolRegistry:
+    """The engines whose pools are reported on by the health endpoints, by name."""
+
+    def __init__(self, degraded_ratio: float):
+        self.degraded_ratio = degraded_ratio
+        self.engines = {}
+        self.metrics: dict[str, PoolMetrics] = {}
+
+    def instrument(self, name: str, engine) -> PoolMetrics:
+        """
+        Start collecting metrics for a (sync or async) engine. Wait times are only measured
+        for the instrumented pool classes, the counters of pool events for any pool.
+        """
+        engine = getattr(engine, "sync_engine", engine)
+        metrics = PoolMetrics()
+        if isinstance(engine.pool, InstrumentedPoolMixin):
+            engine.pool.metrics = metrics
+        event.listen(engine, "connect", lambda *args: metrics.count("connects"))
+        event.listen(engine, "invalidate", lambda *args: metrics.count("invalidations"))
+        event.listen(engine, "soft_invalidate", lambda *args: metrics.count("soft_invalidations"))
+        self.engines[name] = engine
+        self.metrics[name] = metrics
+        return metrics
+
+    def remove(self, name: str):
+        self.engines.pop(name, None)
+        self.metrics.pop(name, None)
+
+    def _pool_stats(self, name: str) -> dict[str, Any]:
+        pool: Pool = self.engines[name].pool
+        stats = {"pool": type(pool).__name__}
+        if isinstance(pool, QueuePool):
+            capacity = pool.size() + pool._max_overflow if pool._max_overflow >= 0 else None
+            stats.update({
+                "size": pool.size(),
+                "max_overflow": pool._max_overflow,
+                "capacity": capacity,
+                "in_use": pool.checkedout(),
+                "idle": pool.checkedin(),
+                "overflow": max(pool.overflow(), 0)
+            })
+        stats.update(self.metrics[name].stats())
+        return stats
+
+    def saturated(self, stats: dict[str, Any]) -> bool:
+        """Whether checkouts are queueing, or about to, for a pool's connections."""
+        if stats["waiting"] > 0:
+            return True
+        capacity = stats.get("capacity")
+        return bool(capacity) and stats["in_use"] >= capacity * self.degraded_ratio
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        stats = {}
+        for name in list(self.engines):
+            pool_stats = self._pool_stats(name)
+            pool_stats["saturated"] = self.saturated(pool_stats)
+            stats[name] = pool_stats
+        return stats
+
+
+pool_registry = PoolRegistry(DB_POOL_DEGRADED_RATIO)
@@ -0,0 +1,147 @@
+import asyncio
+import itertools
+import math
+import os
+import threading
+import time
+from typing import Optional
+from fastapi import Depends, Request, Response
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from src.data.async_database import async_database_url, get_async_db
+from src.data.pool import pool_options, pool_registry
+
+
+# Comma separated database URLs of read replicas of DATABASE_URL. Without any, reads
+# go to the primary like everything else.
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+# How long a replica that failed to connect is skipped before it's tried again
+REPLICA_RETRY_SECONDS = float(os.getenv("REPLICA_RETRY_SECONDS", "30"))
+# How long after a write the same client keeps reading from the primary, to cover replication lag
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+
+READ_YOUR_WRITES_COOKIE = "read_primary_until"
+
+# Where get_read_db routed a session, kept in its info: to a replica, to the primary for
+# want of one, or to the primary for a client reading its own writes
+READ_TARGET = "read_target"
+REPLICA, PRIMARY, OWN_WRITES = "replica", "primary", "own_writes"
+
+
+class ReplicaRouter:
+    """
+    Hands out sessions on the read replicas, round-robin. A replica is health checked
+    when a session is opened on it (pool_pre_ping, then connecting): one that can't be
+    reached is skipped for REPLICA_RETRY_SECONDS and the next one is tried. With no
+    replica available the caller falls back to the primary.
+    """
+
+    def __init__(self, urls: list[str], retry_seconds: float):
+        self.retry_seconds = retry_seconds
+        self._lock = threading.Lock()
+        self.configure(urls)
+
+    def configure(self, urls: list[str], **engine_options):
+        """Replace the replicas. engine_options default to the pool settings of the primary."""
+        engine_options = {**(engine_options or pool_options(asyncio=True)), "pool_pre_ping": True}
+        self.engines: list[AsyncEngine] = [
+            create_async_engine(async_database_url(url), **engine_options) for url in urls
+        ]
+        for name in [name for name in pool_registry.engines if name.startswith("replica_")]:
+            pool_registry.remove(name)
+        for index, engine in enumerate(self.engines):
+            pool_registry.instrument(f"replica_{index}", engine)
+        self._turn = itertools.count()
+        self._down_until: dict[int, float] = {}
+        self.sessions = [0] * len(self.engines)
+        self.failures = [0] * len(self.engines)
+
+    async def dispose(self):
+        for engine in self.engines:
+            await engine.dispose()
+
+    def _candidates(self) -> list[int]:
+        """Replicas to try, in round-robin order starting from this call's turn, skipping ones that are down."""
+        if not self.engines:
+            return []
+        now = time.monotonic()
+        start = next(self._turn) % len(self.engines)
+        order = [(start + offset) % len(self.engines) for offset in range(len(self.engines))]
+        with self._lock:
+            return [index for index in order if self._down_until.get(index, 0) <= now]
+
+    def _mark_down(self, index: int):
+        with self._lock:
+            self._down_until[index] = time.monotonic() + self.retry_seconds
+            self.failures[index] += 1
+
+    async def session(self) -> Optional[AsyncSession]:
+        """A connected session on a healthy replica, or None if there isn't one."""
+        for index in self._candidates():
+            session = AsyncSession(bind=self.engines[index], autoflush=False, expire_on_commit=False)
+            try:
+                await session.connection()
+            except (DBAPIError, OSError, asyncio.TimeoutError):
+                await session.close()
+                self._mark_down(index)
+                continue
+            self.sessions[index] += 1
+            return session
+        return None
+
+    def stats(self) -> list[dict]:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "url": engine.url.render_as_string(hide_password=True),
+                    "healthy": self._down_until.get(index, 0) <= now,
+                    "sessions": self.sessions[index],
+                    "failures": self.failures[index]
+                }
+                for index, engine in enumerate(self.engines)
+            ]
+
+
+def remember_write(response: Response):
+    """Keep this client's reads on the primary until its write has had time to replicate."""
+    response.set_cookie(
+        READ_YOUR_WRITES_COOKIE,
+        f"{time.time() + READ_YOUR_WRITES_SECONDS:.3f}",
+        max_age=math.ceil(READ_YOUR_WRITES_SECONDS),
+        httponly=True
+    )
+
+
+def reads_own_writes(request: Request) -> bool:
+    try:
+        return float(request.cookies.get(READ_YOUR_WRITES_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def read_target(db: AsyncSession) -> str:
+    """REPLICA, PRIMARY or OWN_WRITES, where get_read_db routed db. Any other session is on the primary."""
+    return db.info.get(READ_TARGET, PRIMARY)
+
+
+async def get_read_db(request: Request, primary: AsyncSession = Depends(get_async_db)):
+    """
+    Session for read only endpoints: a replica when one is configured and healthy, the
+    primary otherwise or for a client that wrote within READ_YOUR_WRITES_SECONDS.
+    The primary session doesn't connect unless it's the one used.
+    """
+    if reads_own_writes(request):
+        primary.info[READ_TARGET] = OWN_WRITES
+        yield primary
+        return
+    replica = await replica_router.session()
+    if replica is None:
+        yield primary
+        return
+    replica.info[READ_TARGET] = REPLICA
+    async with replica:
+        yield replica
+
+
+replica_router = ReplicaRouter(DATABASE_REPLICA_URLS, REPLICA_RETRY_SECONDS)
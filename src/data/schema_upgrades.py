@@ -0,0 +1,119 @@
+from sqlalchemy import SmallInteger, bindparam, cast, delete, extract, inspect, select, text, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import CreateColumn
+from src.data.database import Base
+from src.data.tables.location import Location, location_fingerprint
+from src.data.tables.purchase_product import PurchaseProduct
+
+
+# Locations fingerprinted, and their duplicates merged, per round trip
+LOCATION_BACKFILL_BATCH_SIZE = 1000
+
+
+def create_schema(connection: Connection):
+    """
+    Create the tables and bring a database made by an earlier version up to date.
+    create_all only creates missing tables, so the columns and indexes later versions
+    added to existing tables are added here, and the columns backfilled. Every step
+    is a no-op on an up to date database, so this runs on every startup.
+    """
+    Base.metadata.create_all(connection)
+    _add_missing_columns(connection)
+    _backfill_location_fingerprints(connection)
+    _backfill_purchase_time_buckets(connection)
+    # After the backfill, which merges duplicates ahead of ix_location_fingerprint being unique
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def _add_missing_columns(connection: Connection):
+    """ALTER TABLE ... ADD COLUMN each column of an existing table that its model has and the table doesn't."""
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable and column.server_default is None:
+                raise RuntimeError(f"Can't add {table.name}.{column.name} to existing rows, it's NOT NULL without a default")
+            connection.execute(text(
+                f"ALTER TABLE {connection.dialect.identifier_preparer.format_table(table)} "
+                f"ADD COLUMN {CreateColumn(column).compile(dialect=connection.dialect)}"
+            ))
+
+
+def _backfill_location_fingerprints(connection: Connection):
+    """
+    Fingerprint locations inserted before location.fingerprint existed. An address already
+    in the table under another id is a duplicate: whatever references it is pointed at the
+    first row with its fingerprint and it's deleted, so the fingerprint can be unique.
+    """
+    location_id = Location.__table__.c.id
+    references = [
+        foreign_key.parent
+        for table in Base.metadata.sorted_tables
+        for foreign_key in table.foreign_keys
+        if foreign_key.column is location_id
+    ]
+    address_columns = (
+        Location.location_type, Location.address_line_1, Location.address_line_2,
+        Location.city, Location.state, Location.zip_code
+    )
+
+    while True:
+        rows = connection.execute(
+            select(Location.id, *address_columns)
+            .filter(Location.fingerprint.is_(None), Location.location_type.is_not(None))
+            .order_by(Location.id)
+            .limit(LOCATION_BACKFILL_BATCH_SIZE)
+        ).all()
+        if not rows:
+            return
+
+        fingerprints = {row.id: location_fingerprint(*row[1:]) for row in rows}
+        kept = {
+            row.fingerprint: row.id
+            for row in connection.execute(
+                select(Location.id, Location.fingerprint).filter(Location.fingerprint.in_(set(fingerprints.values())))
+            )
+        }
+        duplicates = {}
+        for row_id, fingerprint in fingerprints.items():
+            if fingerprint in kept:
+                duplicates[row_id] = kept[fingerprint]
+            else:
+                kept[fingerprint] = row_id
+
+        if duplicates:
+            merges = [{"duplicate_id": duplicate_id, "kept_id": kept_id} for duplicate_id, kept_id in duplicates.items()]
+            for column in references:
+                connection.execute(
+                    update(column.table).where(column == bindparam("duplicate_id"))
+                    .values({column.name: bindparam("kept_id")}),
+                    merges
+                )
+            connection.execute(delete(Location).filter(Location.id.in_(duplicates)))
+        fingerprinted = [
+            {"location_id": row_id, "location_fingerprint": fingerprint}
+            for row_id, fingerprint in fingerprints.items()
+            if row_id not in duplicates
+        ]
+        if fingerprinted:
+            connection.execute(
+                update(Location).where(Location.id == bindparam("location_id"))
+                .values(fingerprint=bindparam("location_fingerprint")),
+                fingerprinted
+            )
+
+
+def _backfill_purchase_time_buckets(connection: Connection):
+    """Bucket purchase products inserted before purchase_hour and purchase_day_of_week existed, see purchase_time_buckets."""
+    connection.execute(
+        update(PurchaseProduct)
+        .filter(PurchaseProduct.purchase_hour.is_(None), PurchaseProduct.created_at.is_not(None))
+        .values(
+            purchase_hour=cast(extract('hour', PurchaseProduct.created_at), SmallInteger),
+            purchase_day_of_week=cast(extract('dow', PurchaseProduct.created_at), SmallInteger)
+        )
+    )
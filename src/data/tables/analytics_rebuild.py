@@ -0,0 +1,13 @@
+from sqlalchemy import Column, Integer, DateTime
+from sqlalchemy.sql import func
+from src.data.database import Base
+
+
+# One row per run of AnalyticsRollupService.rebuild, which may change every analytics
+# result without adding a purchase. Its newest id is part of the analytics data version.
+
+class AnalyticsRebuild(Base):
+    __tablename__ = "analytics_rebuild"
+
+    id = Column(Integer, primary_key=True)
+    rebuilt_at = Column(DateTime(timezone=True), server_default=func.now())
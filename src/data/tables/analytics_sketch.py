@@ -0,0 +1,28 @@
+from sqlalchemy import Column, Integer, SmallInteger, String, Date, ForeignKey
+from src.data.database import Base
+
+
+# HyperLogLog sketches (src/services/hyperloglog.py) of order ids per key and UTC day,
+# for approximate distinct order counts over any range of days. A sketch is stored as
+# one row per non-zero register, so AnalyticsRollupService adds a purchase's orders with
+# a single upsert keeping the greater rank, in the same transaction as the purchase, and
+# a window merges in the database as max(rank) per key and register.
+
+class ShippingZipDaySketch(Base):
+    __tablename__ = "shipping_zip_day_sketch"
+
+    # orders with at least one product shipped to this zip code on this day
+    zip_code = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True, index=True)
+    register = Column(SmallInteger, primary_key=True)
+    rank = Column(SmallInteger, nullable=False)
+
+
+class CustomerStoreDaySketch(Base):
+    __tablename__ = "customer_store_day_sketch"
+
+    # the customer's orders with at least one store pickup on this day
+    customer_id = Column(Integer, ForeignKey('customer.id'), primary_key=True)
+    day = Column(Date, primary_key=True, index=True)
+    register = Column(SmallInteger, primary_key=True)
+    rank = Column(SmallInteger, nullable=False)
@@ -1,4 +1,5 @@
 from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from src.data.database import Base
 
@@ -13,4 +14,7 @@ class Customer(Base):
     first_name = Column(String, unique=False, index=True, nullable=False)
     last_name = Column(String, unique=False, index=True, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
\ No newline at end of file
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+    # raises unless eager loaded, see PurchaseRollup
+    billing_location = relationship("Location", lazy="raise")
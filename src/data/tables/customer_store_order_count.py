@@ -0,0 +1,22 @@
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, Index
+from sqlalchemy.sql import func
+from src.data.database import Base
+
+
+class CustomerStoreOrderCount(Base):
+    """
+    Number of store pickup orders per customer, ie purchase rollups with at least one
+    product shipped to a STORE location. Kept up to date by AnalyticsRollupService in the
+    same transaction as each purchase.
+    """
+    __tablename__ = "customer_store_order_count"
+
+    customer_id = Column(Integer, ForeignKey('customer.id'), primary_key=True)
+    store_order_count = Column(Integer, nullable=False, default=0)
+
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    # Matches the leaderboard's ORDER BY, so a page is a range scan of the index
+    __table_args__ = (
+        Index("ix_customer_store_order_count_leaderboard", store_order_count.desc(), customer_id),
+    )
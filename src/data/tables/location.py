@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, DateTime, Enum as SQLEnum
+import hashlib
+from sqlalchemy import Column, Integer, String, DateTime, Enum as SQLEnum, event
 from sqlalchemy.sql import func
 from src.data.database import Base
 from enum import Enum
@@ -10,6 +11,17 @@ class LocationType(Enum):
     STORE = "store"
 
 
+def location_fingerprint(location_type: LocationType, address_line_1: str, address_line_2: str,
+                         city: str, state: str, zip_code: str) -> str:
+    """
+    Content address of a location: a hash of its type and normalized address, so the same
+    address typed with different case or spacing maps to the same row.
+    """
+    parts = [location_type.value, address_line_1, address_line_2 or "", city, state, zip_code]
+    normalized = "\x1f".join(" ".join(part.split()).casefold() for part in parts)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
 class Location(Base):
     __tablename__ = "location"
 
@@ -20,5 +32,18 @@ class Location(Base):
     city = Column(String, unique=False, nullable=False)
     state = Column(String, unique=False, nullable=False)
     zip_code = Column(String, unique=False, nullable=False)
+
+    # see location_fingerprint, lets identical addresses share a single row
+    fingerprint = Column(String(64), unique=True, index=True, nullable=True)
+
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+
+@event.listens_for(Location, "before_insert")
+def _set_fingerprint(mapper, connection, location):
+    if location.fingerprint is None and location.location_type is not None:
+        location.fingerprint = location_fingerprint(
+            location.location_type, location.address_line_1, location.address_line_2,
+            location.city, location.state, location.zip_code
+        )
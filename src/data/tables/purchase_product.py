@@ -1,8 +1,21 @@
-from sqlalchemy import Column, Integer, DateTime, ForeignKey
+from datetime import datetime, timezone
+from sqlalchemy import Column, Integer, SmallInteger, DateTime, ForeignKey, Index, event
+from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from src.data.database import Base
 
 
+def purchase_time_buckets(purchased_at: datetime) -> dict[str, int]:
+    """
+    Hour of day and day of week columns for a purchase time. Day of week follows
+    SQL's extract('dow'), 0 is Sunday.
+    """
+    return {
+        "purchase_hour": purchased_at.hour,
+        "purchase_day_of_week": (purchased_at.weekday() + 1) % 7
+    }
+
+
 class PurchaseProduct(Base):
     __tablename__ = "purchase_product"
 
@@ -18,5 +31,30 @@ class PurchaseProduct(Base):
     # buy this product
     purchase_rollup_id = Column(Integer, ForeignKey('purchase_rollup.id'))
 
+    # created_at bucketed at insert time (see purchase_time_buckets), so
+    # time of day analytics can group on a plain column
+    purchase_hour = Column(SmallInteger, index=True)
+    purchase_day_of_week = Column(SmallInteger)
+
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+    # see PurchaseRollup, these raise unless eager loaded
+    product = relationship("Product", lazy="raise")
+    shipping_location = relationship("Location", lazy="raise")
+    purchase_rollup = relationship("PurchaseRollup", back_populates="products", lazy="raise")
+
+    # Time windowed analytics range scan created_at and join on the shipping location
+    # and purchase rollup straight from the index entries
+    __table_args__ = (
+        Index("ix_purchase_product_created_at_shipping", created_at, shipping_location_id, purchase_rollup_id),
+    )
+
+
+@event.listens_for(PurchaseProduct, "before_insert")
+def _set_purchase_time_buckets(mapper, connection, purchase_product):
+    if purchase_product.created_at is None:
+        purchase_product.created_at = datetime.now(timezone.utc)
+    if purchase_product.purchase_hour is None:
+        for column, value in purchase_time_buckets(purchase_product.created_at).items():
+            setattr(purchase_product, column, value)
@@ -1,4 +1,6 @@
-from sqlalchemy import Column, Integer, DateTime, ForeignKey
+from datetime import datetime, timezone
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, Index, event
+from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from src.data.database import Base
 
@@ -17,3 +19,25 @@ class PurchaseRollup(Base):
 
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+    # Relationships only load when asked for with a loader option (selectinload etc),
+    # touching one that wasn't loaded raises rather than issuing a query per access
+    customer = relationship("Customer", lazy="raise")
+    products = relationship("PurchaseProduct", back_populates="purchase_rollup", lazy="raise",
+                            order_by="PurchaseProduct.id")
+
+    # Time windowed analytics range scan created_at and read the customer off the
+    # same index entries
+    __table_args__ = (
+        Index("ix_purchase_rollup_created_at_customer", created_at, customer_id, id),
+        # A customer's purchase history, newest first and keyset paginated on (created_at, id)
+        Index("ix_purchase_rollup_customer_created_at", customer_id, created_at, id),
+    )
+
+
+@event.listens_for(PurchaseRollup, "before_insert")
+def _set_created_at(mapper, connection, purchase_rollup):
+    # Set here rather than by the server default, so it has the same precision as the
+    # created_at of its purchase products and keyset cursors compare equal to it
+    if purchase_rollup.created_at is None:
+        purchase_rollup.created_at = datetime.now(timezone.utc)
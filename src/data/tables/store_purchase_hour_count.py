@@ -0,0 +1,17 @@
+from sqlalchemy import Column, Integer, SmallInteger, DateTime
+from sqlalchemy.sql import func
+from src.data.database import Base
+
+
+class StorePurchaseHourCount(Base):
+    """
+    Histogram of products bought for store pickup (shipped to a STORE location) by
+    purchase_product.purchase_hour. At most 24 rows, kept up to date by
+    AnalyticsRollupService in the same transaction as each purchase.
+    """
+    __tablename__ = "store_purchase_hour_count"
+
+    hour = Column(SmallInteger, primary_key=True)
+    purchase_count = Column(Integer, nullable=False, default=0)
+
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
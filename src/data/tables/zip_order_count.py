@@ -0,0 +1,40 @@
+from sqlalchemy import Column, Integer, String, DateTime, Index
+from sqlalchemy.sql import func
+from src.data.database import Base
+
+
+# Incrementally maintained order counts per zip code, so analytics don't have to
+# aggregate the whole purchase history on every read. Kept up to date by
+# AnalyticsRollupService in the same transaction as each purchase. Each has an index
+# per direction of the analytics keyset order, (order_count DESC, zip_code) for the
+# default descending pages and (order_count, zip_code) for ascending ones, so a page is
+# a range scan rather than a sort of every zip code.
+
+class BillingZipOrderCount(Base):
+    __tablename__ = "billing_zip_order_count"
+
+    # zip code of the billing location of the customer who placed the orders
+    zip_code = Column(String, primary_key=True)
+    order_count = Column(Integer, nullable=False, default=0)
+
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index("ix_billing_zip_order_count_descending", order_count.desc(), zip_code),
+        Index("ix_billing_zip_order_count_order_count", order_count, zip_code),
+    )
+
+
+class ShippingZipOrderCount(Base):
+    __tablename__ = "shipping_zip_order_count"
+
+    # number of distinct orders with at least one product shipped to this zip code
+    zip_code = Column(String, primary_key=True)
+    order_count = Column(Integer, nullable=False, default=0)
+
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index("ix_shipping_zip_order_count_descending", order_count.desc(), zip_code),
+        Index("ix_shipping_zip_order_count_order_count", order_count, zip_code),
+    )
@@ -1,20 +1,35 @@
 from fastapi import FastAPI
 from src.rest_api.customer_rest_api import customer_router
 from src.rest_api.purchase_rest_api import purchase_router
+from src.rest_api.product_rest_api import product_router
 from src.rest_api.analytics_rest_api import analytics_router
-from src.data.database import Base, engine
+from src.rest_api.export_rest_api import export_router
+from src.rest_api.health_rest_api import health_router
+from src.rest_api.metrics_rest_api import metrics_router
+from src.rest_api.admin_rest_api import admin_router
+from src.data.async_database import async_engine
+from src.data.schema_upgrades import create_schema
+from src.monitoring import MetricsMiddleware, TracingMiddleware
 
 app = FastAPI()
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 
 
 @app.on_event("startup")
-def create_tables():
-    Base.metadata.create_all(bind=engine)
+async def create_tables():
+    async with async_engine.begin() as conn:
+        await conn.run_sync(create_schema)
 
 
 app.include_router(customer_router)
 app.include_router(purchase_router)
+app.include_router(product_router)
 app.include_router(analytics_router)
+app.include_router(export_router)
+app.include_router(health_router)
+app.include_router(metrics_router)
+app.include_router(admin_router)
 
 
 
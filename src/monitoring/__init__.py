@@ -0,0 +1,7 @@
+from src.monitoring.db_profiler import QueryStats, active_query_stats
+from src.monitoring.metrics import RequestMetrics, request_metrics
+from src.monitoring.middleware import MetricsMiddleware, TracingMiddleware
+from src.monitoring.query_budget import QueryBudget, QueryBudgetExceeded, QueryBudgetWarning
+from src.monitoring.service_calls import current_service_call, instrument_service
+from src.monitoring.slow_queries import SlowQueryLog, slow_query_log
+from src.monitoring.tracing import InMemorySpanExporter, FileSpanExporter, Span, TracedRoute, Tracer, current_span, tracer
@@ -0,0 +1,78 @@
+import time
+from contextvars import ContextVar
+from typing import Optional
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from src.monitoring.slow_queries import slow_query_log
+from src.monitoring.tracing import SPAN_KIND_CLIENT, current_span, tracer
+
+
+class QueryStats:
+    """
+    Counts the statements executed, and the time spent executing them, while it's entered:
+    a request (see MetricsMiddleware), a service call, a block of a test. Entered stats
+    nest, a statement counts towards every one that's active. With record_statements
+    the SQL of each statement is kept too.
+    """
+
+    def __init__(self, record_statements: bool = False):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.statements: Optional[list[str]] = [] if record_statements else None
+        self._token = None
+
+    def __enter__(self) -> "QueryStats":
+        self._token = active_query_stats.set((*active_query_stats.get(), self))
+        return self
+
+    def __exit__(self, *exc_info):
+        active_query_stats.reset(self._token)
+
+    def record(self, statement: str, seconds: float):
+        self.queries += 1
+        self.db_seconds += seconds
+        if self.statements is not None:
+            self.statements.append(statement)
+
+
+# The QueryStats entered in the current context, outermost first. SQLAlchemy runs async
+# statements in a greenlet that shares the calling task's context, so queries made on an
+# AsyncSession are counted against the request or call that made them.
+active_query_stats: ContextVar[tuple[QueryStats, ...]] = ContextVar("active_query_stats", default=())
+
+
+def _statement_span(conn, statement: str, parameters, executemany: bool):
+    """A span for a statement, named after its operation (SELECT, INSERT...), with its SQL but not its parameters."""
+    words = statement.split()
+    attributes = {"db.system": conn.dialect.name, "db.statement": " ".join(words)}
+    if executemany:
+        attributes["db.operation.batch.size"] = len(parameters)
+    return tracer.start_span(words[0].upper() if words else "SQL", SPAN_KIND_CLIENT, attributes)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is None:
+        return
+    context._trace_span = _statement_span(conn, statement, parameters, executemany) if current_span.get() else None
+    context._profiler_started_at = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    started_at = getattr(context, "_profiler_started_at", None)
+    if started_at is None:
+        return
+    seconds = time.perf_counter() - started_at
+    if context._trace_span is not None:
+        context._trace_span.end()
+    for stats in active_query_stats.get():
+        stats.record(statement, seconds)
+    slow_query_log.observe(conn, statement, parameters, executemany, seconds)
+
+
+@event.listens_for(Engine, "handle_error")
+def _end_failed_query_span(exception_context):
+    span = getattr(exception_context.execution_context, "_trace_span", None)
+    if span is not None:
+        span.end(exception_context.original_exception)
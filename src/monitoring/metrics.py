@@ -0,0 +1,142 @@
+import bisect
+import os
+import threading
+from collections import deque
+from typing import Iterable
+
+
+# Upper bounds of the latency histogram buckets, Prometheus' defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# p50/p95/p99 are over the latest this many requests of each route
+MONITORING_LATENCY_WINDOW = int(os.getenv("MONITORING_LATENCY_WINDOW", "1000"))
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class RouteMetrics:
+    """Request counts, errors, latency and database use of one (method, route)."""
+
+    def __init__(self, window: int):
+        self.requests_by_status: dict[int, int] = {}
+        self.errors = 0
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.recent_latencies = deque(maxlen=window)
+        self.queries = 0
+        self.db_seconds = 0.0
+
+    @property
+    def requests(self) -> int:
+        return sum(self.requests_by_status.values())
+
+    def observe(self, status: int, seconds: float, queries: int, db_seconds: float):
+        self.requests_by_status[status] = self.requests_by_status.get(status, 0) + 1
+        if status >= 500:
+            self.errors += 1
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        if index < len(LATENCY_BUCKETS):
+            self.bucket_counts[index] += 1
+        self.latency_sum += seconds
+        self.recent_latencies.append(seconds)
+        self.queries += queries
+        self.db_seconds += db_seconds
+
+    def quantiles(self) -> dict[float, float]:
+        latencies = sorted(self.recent_latencies)
+        if not latencies:
+            return {}
+        return {q: latencies[min(int(q * len(latencies)), len(latencies) - 1)] for q in QUANTILES}
+
+
+def _labels(**labels) -> str:
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class RequestMetrics:
+    """Per route request metrics, rendered in the Prometheus text exposition format."""
+
+    def __init__(self, window: int):
+        self.window = window
+        self._lock = threading.Lock()
+        self.routes: dict[tuple[str, str], RouteMetrics] = {}
+
+    def observe(self, method: str, route: str, status: int, seconds: float, queries: int = 0, db_seconds: float = 0.0):
+        with self._lock:
+            metrics = self.routes.get((method, route))
+            if metrics is None:
+                metrics = self.routes[(method, route)] = RouteMetrics(self.window)
+            metrics.observe(status, seconds, queries, db_seconds)
+
+    def clear(self):
+        with self._lock:
+            self.routes.clear()
+
+    def render(self) -> Iterable[str]:
+        with self._lock:
+            routes = sorted(self.routes.items())
+            yield "# HELP http_requests_total Requests handled, by route and status code."
+            yield "# TYPE http_requests_total counter"
+            for (method, route), metrics in routes:
+                for status, count in sorted(metrics.requests_by_status.items()):
+                    yield f"http_requests_total{_labels(method=method, route=route, status=status)} {count}"
+
+            yield "# HELP http_request_errors_total Requests that failed with a 5xx or an unhandled exception."
+            yield "# TYPE http_request_errors_total counter"
+            for (method, route), metrics in routes:
+                yield f"http_request_errors_total{_labels(method=method, route=route)} {metrics.errors}"
+
+            yield "# HELP http_request_duration_seconds Time from receiving a request to sending the last of its response."
+            yield "# TYPE http_request_duration_seconds histogram"
+            for (method, route), metrics in routes:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, metrics.bucket_counts):
+                    cumulative += count
+                    yield f"http_request_duration_seconds_bucket{_labels(method=method, route=route, le=bound)} {cumulative}"
+                yield f"http_request_duration_seconds_bucket{_labels(method=method, route=route, le='+Inf')} {metrics.requests}"
+                yield f"http_request_duration_seconds_sum{_labels(method=method, route=route)} {metrics.latency_sum}"
+                yield f"http_request_duration_seconds_count{_labels(method=method, route=route)} {metrics.requests}"
+
+            yield "# HELP http_request_duration_quantile_seconds Latency quantiles over each route's most recent requests."
+            yield "# TYPE http_request_duration_quantile_seconds gauge"
+            for (method, route), metrics in routes:
+                for q, seconds in metrics.quantiles().items():
+                    yield f"http_request_duration_quantile_seconds{_labels(method=method, route=route, quantile=q)} {seconds}"
+
+            yield "# HELP http_request_db_queries_total SQL statements executed while handling requests."
+            yield "# TYPE http_request_db_queries_total counter"
+            for (method, route), metrics in routes:
+                yield f"http_request_db_queries_total{_labels(method=method, route=route)} {metrics.queries}"
+
+            yield "# HELP http_request_db_seconds_total Time spent executing SQL statements while handling requests."
+            yield "# TYPE http_request_db_seconds_total counter"
+            for (method, route), metrics in routes:
+                yield f"http_request_db_seconds_total{_labels(method=method, route=route)} {metrics.db_seconds}"
+
+
+request_metrics = RequestMetrics(MONITORING_LATENCY_WINDOW)
+
+
+# Gauges/counters exported for each connection pool (see src/data/pool.py), with the key in its stats
+POOL_METRICS = (
+    ("db_pool_connections_in_use", "gauge", "Connections checked out of the pool.", "in_use"),
+    ("db_pool_connections_idle", "gauge", "Connections idle in the pool.", "idle"),
+    ("db_pool_overflow", "gauge", "Connections open beyond pool_size.", "overflow"),
+    ("db_pool_waiting", "gauge", "Checkouts waiting for a connection.", "waiting"),
+    ("db_pool_checkouts_total", "counter", "Connections checked out of the pool.", "checkouts"),
+    ("db_pool_timeouts_total", "counter", "Checkouts that gave up waiting for a connection.", "timeouts"),
+    ("db_pool_invalidations_total", "counter", "Connections invalidated.", "invalidations"),
+)
+
+
+def render_pool_stats(pool_stats: dict[str, dict]) -> Iterable[str]:
+    for name, kind, help_text, key in POOL_METRICS:
+        yield f"# HELP {name} {help_text}"
+        yield f"# TYPE {name} {kind}"
+        for pool, stats in sorted(pool_stats.items()):
+            if key in stats:
+                yield f"{name}{_labels(pool=pool)} {stats[key]}"
+    yield "# HELP db_pool_checkout_wait_seconds_total Time checkouts spent waiting for a connection."
+    yield "# TYPE db_pool_checkout_wait_seconds_total counter"
+    for pool, stats in sorted(pool_stats.items()):
+        yield f"db_pool_checkout_wait_seconds_total{_labels(pool=pool)} {stats['checkout_wait_seconds']['total']}"
@@ -0,0 +1,98 @@
+import time
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from src.monitoring.db_profiler import QueryStats
+from src.monitoring.metrics import RequestMetrics, request_metrics
+from src.monitoring.tracing import SPAN_KIND_SERVER, Tracer, tracer as default_tracer
+
+
+class MetricsMiddleware:
+    """
+    Records every HTTP request's latency, status and SQL statements against its route
+    template (eg /customer/by-email/{email}, "unmatched" for 404s that hit no route), and
+    adds a Server-Timing header with the time and queries spent up to the response headers.
+    Latency runs until the last body chunk is sent, so streamed responses count in full.
+    """
+
+    def __init__(self, app: ASGIApp, metrics: RequestMetrics = request_metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats()
+        started_at = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                elapsed_ms = (time.perf_counter() - started_at) * 1000
+                headers = MutableHeaders(scope=message)
+                headers.append(
+                    "Server-Timing",
+                    f'app;dur={elapsed_ms:.1f}, db;dur={stats.db_seconds * 1000:.1f};desc="{stats.queries} queries"'
+                )
+            await send(message)
+
+        try:
+            with stats:
+                await self.app(scope, receive, send_with_timing)
+        except Exception:
+            status = 500
+            raise
+        finally:
+            route = scope.get("route")
+            self.metrics.observe(
+                scope["method"], getattr(route, "path", "unmatched"), status,
+                time.perf_counter() - started_at, stats.queries, stats.db_seconds
+            )
+
+
+class TracingMiddleware:
+    """
+    Starts a trace for each sampled HTTP request, with a server span covering the whole
+    request named after its route template (eg POST /purchase/), and exports it once the
+    response is sent. Sampled responses carry a traceparent header naming the trace, the
+    id to look it up by in GET /admin/traces/{trace_id}.
+    """
+
+    def __init__(self, app: ASGIApp, tracer: Tracer = default_tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = next((value.decode("latin-1") for name, value in scope["headers"] if name == b"traceparent"), None)
+        root = self.tracer.start_trace(
+            scope["method"], SPAN_KIND_SERVER,
+            {"http.request.method": scope["method"], "url.path": scope["path"]}, traceparent
+        )
+        if root is None:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_traceparent(message: Message):
+            if message["type"] == "http.response.start":
+                root.attributes["http.response.status_code"] = message["status"]
+                if message["status"] >= 500:
+                    root.set_error(f"HTTP {message['status']}")
+                MutableHeaders(scope=message).append("traceparent", root.traceparent)
+            await send(message)
+
+        try:
+            with root:
+                await self.app(scope, receive, send_with_traceparent)
+        finally:
+            route = scope.get("route")
+            if route is not None:
+                root.name = f"{scope['method']} {route.path}"
+                root.attributes["http.route"] = route.path
+            self.tracer.export(root)
@@ -0,0 +1,74 @@
+import logging
+import os
+import warnings
+from typing import Optional
+from fastapi import Request
+from src.monitoring.db_profiler import QueryStats
+
+logger = logging.getLogger(__name__)
+
+# What happens when a route or call runs more statements than its budget: "log" a
+# warning with the statements, "warn" with a QueryBudgetWarning, or "raise" a
+# QueryBudgetExceeded (the tests run with raise, see tests/conftest.py)
+QUERY_BUDGET_MODE = os.getenv("QUERY_BUDGET_MODE", "log")
+QUERY_BUDGET_MODES = ("log", "warn", "raise")
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryBudgetWarning(UserWarning):
+    pass
+
+
+class QueryBudget:
+    """
+    Upper bound on the SQL statements a route or a block of code executes, to catch a
+    query per row slipping in. As a route dependency it covers the endpoint and its other
+    dependencies, up to the response being returned (not a streamed body):
+
+        @router.get("/...", dependencies=[Depends(QueryBudget(3))])
+
+    and as a context manager the block inside it:
+
+        with QueryBudget(2, "CustomerService.query_customers_by_emails"):
+            ...
+    """
+
+    def __init__(self, max_queries: int, name: Optional[str] = None, mode: Optional[str] = None):
+        if mode is not None and mode not in QUERY_BUDGET_MODES:
+            raise ValueError(f"mode must be one of {QUERY_BUDGET_MODES}")
+        self.max_queries = max_queries
+        self.name = name
+        self.mode = mode
+        self._stats: list[QueryStats] = []
+
+    def __enter__(self) -> QueryStats:
+        stats = QueryStats(record_statements=True).__enter__()
+        self._stats.append(stats)
+        return stats
+
+    def __exit__(self, exc_type, exc, traceback):
+        stats = self._stats.pop()
+        stats.__exit__(exc_type, exc, traceback)
+        if exc_type is None:
+            self.check(stats, self.name)
+
+    async def __call__(self, request: Request):
+        route = request.scope.get("route")
+        with QueryStats(record_statements=True) as stats:
+            yield stats
+        self.check(stats, self.name or f"{request.method} {getattr(route, 'path', request.url.path)}")
+
+    def check(self, stats: QueryStats, name: Optional[str]):
+        if stats.queries <= self.max_queries:
+            return
+        message = f"{name} ran {stats.queries} queries, over its budget of {self.max_queries}"
+        mode = self.mode or QUERY_BUDGET_MODE
+        if mode == "raise":
+            raise QueryBudgetExceeded(message + ":\n" + "\n".join(stats.statements))
+        if mode == "warn":
+            warnings.warn(message, QueryBudgetWarning, stacklevel=3)
+        else:
+            logger.warning("%s:\n%s", message, "\n".join(stats.statements))
@@ -0,0 +1,91 @@
+import functools
+import inspect
+from contextvars import ContextVar
+from typing import Optional
+from src.monitoring.tracing import current_span, tracer
+
+
+# Qualified name of the innermost instrumented service method running in this context,
+# eg "AnalyticsService.get_order_count_by_shipping_zip_code", for attributing SQL to it
+current_service_call: ContextVar[Optional[str]] = ContextVar("current_service_call", default=None)
+
+
+def _instrument_coroutine(method, name: str):
+    @functools.wraps(method)
+    async def instrumented(*args, **kwargs):
+        token = current_service_call.set(name)
+        try:
+            span = tracer.start_span(name)
+            if span is None:
+                return await method(*args, **kwargs)
+            with span:
+                return await method(*args, **kwargs)
+        finally:
+            current_service_call.reset(token)
+    return instrumented
+
+
+def _instrument_async_generator(method, name: str):
+    @functools.wraps(method)
+    async def instrumented(*args, **kwargs):
+        # Only while the generator itself runs, not while its consumer handles a row. Its
+        # span lasts from the first row asked for to the generator closing, consumer included.
+        rows = method(*args, **kwargs)
+        span = tracer.start_span(name)
+        error = None
+        try:
+            while True:
+                token = current_service_call.set(name)
+                span_token = current_span.set(span) if span is not None else None
+                try:
+                    row = await rows.__anext__()
+                except StopAsyncIteration:
+                    return
+                except Exception as e:
+                    error = e
+                    raise
+                finally:
+                    if span_token is not None:
+                        current_span.reset(span_token)
+                    current_service_call.reset(token)
+                yield row
+        finally:
+            await rows.aclose()
+            if span is not None:
+                span.end(error)
+    return instrumented
+
+
+def _instrument_function(method, name: str):
+    @functools.wraps(method)
+    def instrumented(*args, **kwargs):
+        token = current_service_call.set(name)
+        try:
+            span = tracer.start_span(name)
+            if span is None:
+                return method(*args, **kwargs)
+            with span:
+                return method(*args, **kwargs)
+        finally:
+            current_service_call.reset(token)
+    return instrumented
+
+
+def instrument_service(cls):
+    """
+    Class decorator for services: while one of the class's methods (sync, async or async
+    generators) runs, current_service_call names it. Methods calling each other nest,
+    the innermost one wins. Every method, public or private, sync or async, is also a
+    span of the current trace when the request is sampled (see tracing.py).
+    """
+    for attribute, method in list(vars(cls).items()):
+        if attribute.startswith("__") or not inspect.isfunction(method):
+            continue
+        name = f"{cls.__name__}.{attribute}"
+        if inspect.iscoroutinefunction(method):
+            setattr(cls, attribute, _instrument_coroutine(method, name))
+        elif inspect.isasyncgenfunction(method):
+            setattr(cls, attribute, _instrument_async_generator(method, name))
+        else:
+            setattr(cls, attribute, _instrument_function(method, name))
+    return cls
@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Optional
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from src.monitoring.service_calls import current_service_call
+from src.monitoring.token_bucket import TokenBucket
+from src.utils.cache import CACHE_MISS, LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Statements taking at least this long are logged
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "200"))
+# How many of the latest slow queries GET /admin/slow-queries can show
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", "200"))
+# Capture the plan of slow SELECTs: EXPLAIN (ANALYZE, BUFFERS) on Postgres, which runs
+# the statement a second time, EXPLAIN QUERY PLAN on SQLite
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "false").lower() in ("1", "true", "yes")
+# At most one plan per distinct statement in this many seconds, remembered for this many
+# of the most recently explained statements
+SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS = float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS", "300"))
+SLOW_QUERY_EXPLAIN_STATEMENTS = int(os.getenv("SLOW_QUERY_EXPLAIN_STATEMENTS", "1000"))
+# And at most this many plans a minute across all statements, in bursts of as many
+SLOW_QUERY_EXPLAIN_PER_MINUTE = float(os.getenv("SLOW_QUERY_EXPLAIN_PER_MINUTE", "10"))
+# Slow queries waiting for their plan, past this they go without one
+EXPLAIN_QUEUE_SIZE = 100
+
+EXPLAIN_PREFIXES = {
+    "postgresql": "EXPLAIN (ANALYZE, BUFFERS) ",
+    "sqlite": "EXPLAIN QUERY PLAN "
+}
+# Plan lines that read a whole table: Postgres' "Seq Scan on purchase_product p" and
+# SQLite's "SCAN purchase_product" (rather than "SCAN ... USING INDEX ...")
+SEQ_SCAN_PATTERNS = (
+    re.compile(r"Seq Scan on (\w+)"),
+    re.compile(r"^\s*SCAN (?:TABLE )?(\w+)(?!.*\bUSING\b)")
+)
+# SQLite plans a subquery as a CO-ROUTINE or MATERIALIZE step and then SCANs that, not a table
+SUBQUERY_PATTERN = re.compile(r"^\s*(?:CO-ROUTINE|MATERIALIZE) (\w+)")
+
+
+def _value_shape(values) -> list[str]:
+    """Type names of a sequence of values, runs collapsed: ["int", "int", "str"] is ["int×2", "str"]."""
+    shape = []
+    previous, count = None, 0
+    for value in values:
+        name = type(value).__name__
+        if name == previous:
+            count += 1
+            continue
+        if previous is not None:
+            shape.append(previous if count == 1 else f"{previous}×{count}")
+        previous, count = name, 1
+    if previous is not None:
+        shape.append(previous if count == 1 else f"{previous}×{count}")
+    return shape
+
+
+def parameter_shape(parameters, executemany: bool = False) -> Any:
+    """
+    The types of a statement's bound parameters without their values, which may be
+    personal data. An executemany is described by its row count and first row.
+    """
+    if executemany:
+        rows = list(parameters)
+        return {"rows": len(rows), "row": parameter_shape(rows[0]) if rows else None}
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return _value_shape(parameters)
+    return type(parameters).__name__
+
+
+def seq_scans(plan: list[str]) -> list[str]:
+    """Tables a query plan reads in full."""
+    subqueries = {match.group(1) for line in plan if (match := SUBQUERY_PATTERN.search(line))}
+    scanned = {match.group(1) for line in plan for pattern in SEQ_SCAN_PATTERNS if (match := pattern.search(line))}
+    return sorted(scanned - subqueries)
+
+
+class SlowQueryLog:
+    """
+    The latest statements that took at least the threshold, with the SQL, the shape of its
+    parameters, the service method that ran it and, when enabled, its query plan. Fed by
+    the statement timer in db_profiler.py.
+
+    Plans are captured off the request path: a slow statement is queued, and a worker
+    thread EXPLAINs it on a connection of its own and fills in the entry's plan.
+    """
+
+    def __init__(self, threshold_ms: float, size: int, explain: bool, explain_interval_seconds: float,
+                 explain_statements: int, explain_per_minute: float):
+        self.threshold_ms = threshold_ms
+        self.explain = explain
+        self._lock = threading.Lock()
+        self.entries = deque(maxlen=size)
+        # statement -> True while it was explained less than explain_interval_seconds ago
+        self._explained = LRUCache(explain_statements, explain_interval_seconds)
+        self._explain_budget = TokenBucket(explain_per_minute)
+        self._explain_queue: queue.Queue = queue.Queue(maxsize=EXPLAIN_QUEUE_SIZE)
+        self._explainer: Optional[threading.Thread] = None
+        self.slow_queries = 0
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self._explained.clear()
+            self._explain_budget = TokenBucket(self._explain_budget.per_minute)
+            self.slow_queries = 0
+
+    def _should_explain(self, dialect: str, statement: str, executemany: bool) -> bool:
+        if not self.explain or executemany or dialect not in EXPLAIN_PREFIXES:
+            return False
+        # EXPLAIN ANALYZE executes the statement, never do that to a write
+        if not statement.lstrip().upper().startswith("SELECT"):
+            return False
+        with self._lock:
+            if self._explained.get(statement) is not CACHE_MISS or not self._explain_budget.take():
+                return False
+            self._explained.set(statement, True)
+            return True
+
+    def _queue_explain(self, conn, entry: dict, statement: str, parameters):
+        with self._lock:
+            if self._explainer is None:
+                self._explainer = threading.Thread(target=self._explain_worker, name="slow-query-explain", daemon=True)
+                self._explainer.start()
+        parameters = dict(parameters) if isinstance(parameters, dict) else tuple(parameters)
+        try:
+            self._explain_queue.put_nowait((entry, conn.engine.url, conn.dialect.is_async, statement, parameters))
+        except queue.Full:
+            logger.warning("Slow query EXPLAIN queue is full, not explaining: %s", entry["statement"])
+
+    def _explain_worker(self):
+        """Explains queued slow queries one at a time, on NullPool engines of its own."""
+        loop = asyncio.new_event_loop()
+        engines = LRUCache(8, float("inf"))
+        while True:
+            entry, url, is_async, statement, parameters = self._explain_queue.get()
+            try:
+                engine = engines.get(url)
+                if engine is CACHE_MISS:
+                    engine = create_async_engine(url, poolclass=NullPool) if is_async else create_engine(url, poolclass=NullPool)
+                    engines.set(url, engine)
+                if is_async:
+                    plan = loop.run_until_complete(self._explain_async(engine, statement, parameters))
+                else:
+                    plan = self._explain(engine, statement, parameters)
+                with self._lock:
+                    entry["plan"] = plan
+                    entry["seq_scans"] = seq_scans(plan)
+                if entry["seq_scans"]:
+                    logger.warning("Slow query in %s scans %s: %s", entry["service_call"], entry["seq_scans"], entry["statement"])
+            except Exception:
+                logger.warning("Could not EXPLAIN slow query", exc_info=True)
+            finally:
+                self._explain_queue.task_done()
+
+    @staticmethod
+    def _plan_lines(dialect: str, rows) -> list[str]:
+        if dialect == "sqlite":
+            # (id, parent, notused, detail)
+            return [row[-1] for row in rows]
+        return [row[0] for row in rows]
+
+    @classmethod
+    def _explain(cls, engine, statement: str, parameters) -> list[str]:
+        """
+        The plan of statement, as the driver got it, on a connection of its own whose
+        transaction is rolled back, so EXPLAIN ANALYZE leaves nothing behind.
+        """
+        with engine.connect() as conn:
+            conn = conn.execution_options(log_slow_queries=False)
+            rows = conn.exec_driver_sql(EXPLAIN_PREFIXES[engine.dialect.name] + statement, parameters).all()
+            conn.rollback()
+        return cls._plan_lines(engine.dialect.name, rows)
+
+    @classmethod
+    async def _explain_async(cls, engine, statement: str, parameters) -> list[str]:
+        """_explain on an AsyncEngine."""
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(log_slow_queries=False)
+            rows = (await conn.exec_driver_sql(EXPLAIN_PREFIXES[engine.dialect.name] + statement, parameters)).all()
+            await conn.rollback()
+        return cls._plan_lines(engine.dialect.name, rows)
+
+    def wait_for_plans(self):
+        """Block until every queued slow query has been explained."""
+        self._explain_queue.join()
+
+    def observe(self, conn, statement: str, parameters, executemany: bool, seconds: float):
+        duration_ms = seconds * 1000
+        if duration_ms < self.threshold_ms or not conn.get_execution_options().get("log_slow_queries", True):
+            return
+        entry = {
+            "at": datetime.now(timezone.utc).isoformat(),
+            "duration_ms": round(duration_ms, 3),
+            "statement": " ".join(statement.split()),
+            "parameters": parameter_shape(parameters, executemany),
+            "executemany": executemany,
+            "service_call": current_service_call.get(),
+            "plan": None,
+            "seq_scans": None
+        }
+        if self._should_explain(conn.dialect.name, entry["statement"], executemany):
+            self._queue_explain(conn, entry, statement, parameters)
+
+        with self._lock:
+            self.entries.append(entry)
+            self.slow_queries += 1
+        logger.warning(
+            "Slow query (%.1f ms) in %s: %s parameters=%s", duration_ms, entry["service_call"], entry["statement"],
+            entry["parameters"]
+        )
+
+    def stats(self, limit: Optional[int] = None) -> dict[str, Any]:
+        with self._lock:
+            entries = [dict(entry) for entry in reversed(self.entries)]
+            return {
+                "threshold_ms": self.threshold_ms,
+                "explain": self.explain,
+                "slow_queries": self.slow_queries,
+                "entries": entries[:limit] if limit is not None else entries
+            }
+
+
+slow_query_log = SlowQueryLog(
+    SLOW_QUERY_THRESHOLD_MS, SLOW_QUERY_LOG_SIZE, SLOW_QUERY_EXPLAIN, SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS,
+    SLOW_QUERY_EXPLAIN_STATEMENTS, SLOW_QUERY_EXPLAIN_PER_MINUTE
+)
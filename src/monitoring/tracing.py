@@ -0,0 +1,348 @@
+import functools
+import inspect
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar, Token
+from typing import Any, Optional
+import orjson
+from fastapi.routing import APIRoute
+from src.monitoring.token_bucket import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Share of requests traced, decided from the trace id like OpenTelemetry's
+# TraceIdRatioBased sampler. A request with a W3C traceparent header follows the
+# caller's decision instead, so 0 (the default) only traces what a caller asks for.
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "0"))
+# Any client can send a sampled traceparent, so at most this many requests a minute are
+# traced because their caller asked for it, the rest go by TRACE_SAMPLE_RATIO
+TRACE_PARENT_SAMPLED_PER_MINUTE = float(os.getenv("TRACE_PARENT_SAMPLED_PER_MINUTE", "60"))
+# Where finished traces go: "memory" keeps the latest TRACE_BUFFER_SIZE for
+# GET /admin/traces, "file" appends them to TRACE_FILE, one OTLP/JSON document a line
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "memory")
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "100"))
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+# Traces waiting to be written to TRACE_FILE, past this they're dropped (and counted)
+TRACE_FILE_QUEUE_SIZE = int(os.getenv("TRACE_FILE_QUEUE_SIZE", "1000"))
+# Spans past this many in one trace are dropped (and counted), bounding a trace's memory
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "2000"))
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "radiantgraph")
+
+# OTLP span kinds and status codes
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+STATUS_CODE_UNSET = 0
+STATUS_CODE_ERROR = 2
+
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+_TRACE_ID_BOUND = 2 ** 64
+
+
+def _otlp_value(value) -> dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # int64s are strings in OTLP/JSON
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_attributes(attributes: dict[str, Any]) -> list[dict[str, Any]]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[tuple[str, str, bool]]:
+    """(trace id, parent span id, sampled) of a W3C traceparent header, None if it isn't a valid one."""
+    match = TRACEPARENT_PATTERN.match(header.strip().lower()) if header else None
+    if not match or set(match.group(1)) == {"0"} or set(match.group(2)) == {"0"}:
+        return None
+    return match.group(1), match.group(2), bool(int(match.group(3), 16) & 1)
+
+
+class Span:
+    """
+    A timed operation in a trace. Entering it makes it the parent of the spans started
+    while it runs, exiting ends it, recording the exception it exited with if any.
+    """
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "attributes", "start_ns", "end_ns",
+                 "status_code", "status_message", "_token")
+
+    def __init__(self, trace: "Trace", parent_id: Optional[str], name: str, kind: int,
+                 attributes: Optional[dict[str, Any]] = None):
+        self.trace = trace
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes if attributes is not None else {}
+        self.status_code = STATUS_CODE_UNSET
+        self.status_message = None
+        self.end_ns = None
+        self._token: Optional[Token] = None
+        self.start_ns = time.time_ns()
+
+    def __enter__(self) -> "Span":
+        self._token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        current_span.reset(self._token)
+        self.end(exc)
+
+    def set_error(self, message: str):
+        self.status_code = STATUS_CODE_ERROR
+        self.status_message = message
+
+    def end(self, exc: Optional[BaseException] = None):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if isinstance(exc, Exception):
+            self.attributes["exception.type"] = type(exc).__name__
+            self.set_error(str(exc))
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace.trace_id}-{self.span_id}-01"
+
+    def to_otlp(self) -> dict[str, Any]:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns if self.end_ns is not None else time.time_ns()),
+            "attributes": otlp_attributes(self.attributes),
+            "status": {"code": self.status_code}
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        if self.status_message is not None:
+            span["status"]["message"] = self.status_message
+        return span
+
+
+class Trace:
+    """The spans of one sampled request, in the order they started."""
+    __slots__ = ("trace_id", "spans", "max_spans", "dropped_spans")
+
+    def __init__(self, trace_id: str, max_spans: int):
+        self.trace_id = trace_id
+        self.spans: list[Span] = []
+        self.max_spans = max_spans
+        self.dropped_spans = 0
+
+    def start_span(self, parent_id: Optional[str], name: str, kind: int,
+                   attributes: Optional[dict[str, Any]] = None) -> Optional[Span]:
+        if len(self.spans) >= self.max_spans:
+            self.dropped_spans += 1
+            return None
+        span = Span(self, parent_id, name, kind, attributes)
+        self.spans.append(span)
+        return span
+
+
+# The innermost span entered in this context, None when the request isn't sampled (or
+# there's no request). Like active_query_stats in db_profiler.py, it follows async
+# SQLAlchemy into its greenlets, so statements become children of the service call
+# that ran them.
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class InMemorySpanExporter:
+    """Keeps the latest traces, for GET /admin/traces."""
+
+    def __init__(self, size: int):
+        self._lock = threading.Lock()
+        self._traces: deque[tuple[str, dict[str, Any]]] = deque(maxlen=size)
+
+    def export(self, trace_id: str, document: dict[str, Any]):
+        with self._lock:
+            self._traces.append((trace_id, document))
+
+    def traces(self, limit: Optional[int] = None) -> list[dict[str, Any]]:
+        with self._lock:
+            documents = [document for _, document in reversed(self._traces)]
+        return documents[:limit] if limit is not None else documents
+
+    def get(self, trace_id: str) -> Optional[dict[str, Any]]:
+        with self._lock:
+            return next((document for id_, document in self._traces if id_ == trace_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._traces.clear()
+
+
+class FileSpanExporter:
+    """
+    Appends each trace to a file as one line of OTLP/JSON, the format of the OpenTelemetry
+    Collector's file exporter, so the collector (or anything reading OTLP) can load it.
+    Traces are queued and written by a thread of its own, export never waits on the disk.
+    """
+
+    def __init__(self, path: str, queue_size: int = TRACE_FILE_QUEUE_SIZE):
+        self.path = path
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._writer: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.dropped_traces = 0
+
+    def export(self, trace_id: str, document: dict[str, Any]):
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write, name="trace-file-writer", daemon=True)
+                self._writer.start()
+        try:
+            self._queue.put_nowait(document)
+        except queue.Full:
+            with self._lock:
+                self.dropped_traces += 1
+
+    def _write(self):
+        """Writes whatever is queued in one go, then waits for more."""
+        while True:
+            documents = [self._queue.get()]
+            while True:
+                try:
+                    documents.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with open(self.path, "ab") as file:
+                    file.write(b"".join(orjson.dumps(document) + b"\n" for document in documents))
+            except Exception:
+                logger.warning("Could not write %d trace(s) to %s", len(documents), self.path, exc_info=True)
+            finally:
+                for _ in documents:
+                    self._queue.task_done()
+
+    def flush(self):
+        """Block until every trace exported so far has been written."""
+        self._queue.join()
+
+
+class Tracer:
+    """
+    Starts traces for sampled requests (see TracingMiddleware) and the spans inside them.
+    When the current request isn't sampled start_span returns None straight away, so
+    the cost of tracing off is a context variable lookup per span that would have been.
+    """
+
+    def __init__(self, sample_ratio: float, exporter, max_spans: int, service_name: str,
+                 parent_sampled_per_minute: float = TRACE_PARENT_SAMPLED_PER_MINUTE):
+        self.sample_ratio = sample_ratio
+        self.exporter = exporter
+        self.max_spans = max_spans
+        self.service_name = service_name
+        self.parent_sampled = TokenBucket(parent_sampled_per_minute)
+
+    def sampled(self, trace_id: str) -> bool:
+        return int(trace_id[16:], 16) < self.sample_ratio * _TRACE_ID_BOUND
+
+    def start_trace(self, name: str, kind: int = SPAN_KIND_SERVER, attributes: Optional[dict[str, Any]] = None,
+                    traceparent: Optional[str] = None) -> Optional[Span]:
+        """
+        The root span of a new trace, continuing the caller's from its traceparent header; None
+        if not sampled. The caller's sampled flag is followed up to parent_sampled's rate, past
+        that its trace is sampled like any other.
+        """
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            trace_id, parent_id, parent_sampled = parent
+            sampled = parent_sampled and (self.sampled(trace_id) or self.parent_sampled.take())
+        else:
+            trace_id, parent_id = f"{random.getrandbits(128):032x}", None
+            sampled = self.sampled(trace_id)
+        if not sampled:
+            return None
+        return Trace(trace_id, self.max_spans).start_span(parent_id, name, kind, attributes)
+
+    def start_span(self, name: str, kind: int = SPAN_KIND_INTERNAL,
+                   attributes: Optional[dict[str, Any]] = None) -> Optional[Span]:
+        """A child of the current span, which the caller enters or ends; None when there's no trace to add it to."""
+        parent = current_span.get()
+        if parent is None:
+            return None
+        return parent.trace.start_span(parent.span_id, name, kind, attributes)
+
+    def export(self, root: Span):
+        """Export the trace root is the root span of, once it's ended."""
+        trace = root.trace
+        if trace.dropped_spans:
+            root.attributes["trace.dropped_spans"] = trace.dropped_spans
+        document = {
+            "resourceSpans": [{
+                "resource": {"attributes": otlp_attributes({"service.name": self.service_name})},
+                "scopeSpans": [{
+                    "scope": {"name": __name__},
+                    "spans": [span.to_otlp() for span in trace.spans]
+                }]
+            }]
+        }
+        try:
+            self.exporter.export(trace.trace_id, document)
+        except Exception:
+            logger.warning("Could not export trace %s", trace.trace_id, exc_info=True)
+
+
+def span_exporter(kind: str):
+    if kind == "memory":
+        return InMemorySpanExporter(TRACE_BUFFER_SIZE)
+    if kind == "file":
+        return FileSpanExporter(TRACE_FILE)
+    raise ValueError(f"TRACE_EXPORTER must be memory or file, not {kind!r}")
+
+
+tracer = Tracer(TRACE_SAMPLE_RATIO, span_exporter(TRACE_EXPORTER), TRACE_MAX_SPANS, TRACE_SERVICE_NAME)
+
+
+def _traced_endpoint(endpoint, name: str):
+    attributes = {"code.namespace": endpoint.__module__, "code.function": endpoint.__name__}
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def traced(*args, **kwargs):
+            span = tracer.start_span(name, attributes=dict(attributes))
+            if span is None:
+                return await endpoint(*args, **kwargs)
+            with span:
+                return await endpoint(*args, **kwargs)
+    else:
+        @functools.wraps(endpoint)
+        def traced(*args, **kwargs):
+            span = tracer.start_span(name, attributes=dict(attributes))
+            if span is None:
+                return endpoint(*args, **kwargs)
+            with span:
+                return endpoint(*args, **kwargs)
+    traced.__traced__ = True
+    return traced
+
+
+class TracedRoute(APIRoute):
+    """
+    Route class that puts the endpoint function in a span of its own, named after its
+    module and function (eg purchase_rest_api.create_purchase). What comes before it in
+    the request's span is parsing and validating the request and solving dependencies,
+    what comes after is serializing the response.
+
+        APIRouter(prefix="/purchase", route_class=TracedRoute)
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        # include_router builds the app's routes again from these routes' (already traced) endpoints
+        if not getattr(endpoint, "__traced__", False):
+            name = f"{endpoint.__module__.rsplit('.', 1)[-1]}.{endpoint.__name__}"
+            # functools.wraps keeps the signature FastAPI reads parameters and response_model from
+            endpoint = _traced_endpoint(endpoint, name)
+        super().__init__(path, endpoint, **kwargs)
@@ -0,0 +1,20 @@
+import os
+import secrets
+from typing import Optional
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+
+
+# Bearer token for the /admin and /export endpoints. They're off entirely without one,
+# exports hand out customer addresses and traces and slow queries show what's being run.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+_bearer = HTTPBearer(auto_error=False)
+
+
+def require_admin(credentials: Optional[HTTPAuthorizationCredentials] = Depends(_bearer)):
+    """Router dependency letting through only requests with `Authorization: Bearer <ADMIN_TOKEN>`."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled, set ADMIN_TOKEN to enable them")
+    if credentials is None or not secrets.compare_digest(credentials.credentials.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Admin token required", headers={"WWW-Authenticate": "Bearer"})
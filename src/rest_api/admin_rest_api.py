@@ -0,0 +1,54 @@
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from src.monitoring.slow_queries import slow_query_log
+from src.monitoring.tracing import InMemorySpanExporter, tracer
+from src.rest_api.admin_auth import require_admin
+
+admin_router = APIRouter(
+    prefix="/admin",
+    tags=["admin"],
+    dependencies=[Depends(require_admin)]
+)
+
+
+@admin_router.get("/slow-queries")
+async def get_slow_queries(limit: Optional[int] = Query(None, ge=1, description="Most recent entries to return, all if not given")):
+    """
+    Statements that took at least SLOW_QUERY_THRESHOLD_MS, newest first, with the shape
+    of their parameters, the service method that ran them and, with SLOW_QUERY_EXPLAIN,
+    their plan and the tables it scans in full.
+    """
+    return slow_query_log.stats(limit)
+
+
+@admin_router.delete("/slow-queries")
+async def clear_slow_queries():
+    slow_query_log.clear()
+    return {"cleared": True}
+
+
+def _trace_buffer() -> InMemorySpanExporter:
+    if not isinstance(tracer.exporter, InMemorySpanExporter):
+        raise HTTPException(status_code=404, detail="Traces are exported to a file, set TRACE_EXPORTER=memory to keep them here")
+    return tracer.exporter
+
+
+@admin_router.get("/traces")
+async def get_traces(limit: Optional[int] = Query(20, ge=1, description="Most recent traces to return")):
+    """The latest sampled traces, newest first, each an OTLP/JSON ExportTraceServiceRequest."""
+    return {"sample_ratio": tracer.sample_ratio, "traces": _trace_buffer().traces(limit)}
+
+
+@admin_router.get("/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    """A trace by the id in its response's traceparent header."""
+    trace = _trace_buffer().get(trace_id.lower())
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return trace
+
+
+@admin_router.delete("/traces")
+async def clear_traces():
+    _trace_buffer().clear()
+    return {"cleared": True}
@@ -1,53 +1,252 @@
-from fastapi import APIRouter, Depends, Query
-from sqlalchemy.orm import Session
-from src.data.database import get_db
-from src.services.analytics_service import AnalyticsService
-from typing import List, Dict, Any
+import os
+from datetime import datetime
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.data.read_replicas import OWN_WRITES, get_read_db, read_target
+from src.monitoring.query_budget import QueryBudget
+from src.monitoring.tracing import TracedRoute
+from src.services.analytics_cache import analytics_cache
+from src.rest_api.pagination import NEXT_CURSOR_HEADER, decode_cursor, encode_cursor
+from src.services.analytics_service import (
+    STREAM_BATCH_SIZE, AnalyticsService, analytics_single_flight, as_utc, whole_days
+)
+from src.services.columnar_analytics import ColumnarAnalyticsService
+from src.services.hyperloglog import HyperLogLog
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
 
 analytics_router = APIRouter(
     prefix="/analytics",
-    tags=["analytics"]
+    tags=["analytics"],
+    route_class=TracedRoute
 )
 
+# Sent with approximate=true results, the relative standard error of the estimates.
+# Each row also carries an absolute error_bound of two standard errors.
+APPROXIMATE_ERROR_HEADER = "X-Approximate-Relative-Error"
+APPROXIMATE_RELATIVE_ERROR = f"{HyperLogLog().relative_error:.4f}"
+
+# "sql" aggregates on the database, "columnar" on an in memory snapshot of the
+# purchase facts (see src/services/columnar_analytics.py) to keep load off the primary
+ANALYTICS_BACKEND = os.getenv("ANALYTICS_BACKEND", "sql")
+
+
+def analytics_service(db: AsyncSession):
+    # The snapshot may not have caught up with the write of a client reading its own writes
+    if ANALYTICS_BACKEND == "columnar" and read_target(db) != OWN_WRITES:
+        return ColumnarAnalyticsService(db)
+    return AnalyticsService(db)
+
+
+def time_window(
+    start: Optional[datetime] = Query(None, description="Only count purchases made at or after this time (UTC if no offset)"),
+    end: Optional[datetime] = Query(None, description="Only count purchases made before this time (UTC if no offset)")
+) -> tuple[Optional[datetime], Optional[datetime]]:
+    start = as_utc(start) if start is not None else None
+    end = as_utc(end) if end is not None else None
+    if start is not None and end is not None and start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    return start, end
+
+
+def approximate_window(window: tuple[Optional[datetime], Optional[datetime]]):
+    """The sketches behind approximate=true are per UTC day, so they can only answer whole days."""
+    if not whole_days(*window):
+        raise HTTPException(status_code=400, detail="approximate=true needs start and end at midnight UTC")
+
+
+async def _cached_response(request: Request, service, key: Hashable, compute: Callable[[], Awaitable[list]],
+                           limit: Optional[int] = None, next_cursor: Callable[[Any], str] = None,
+                           extra_headers: Optional[dict[str, str]] = None) -> Response:
+    """
+    Serve an analytics result through the analytics cache with an ETag. A request whose
+    If-None-Match is the ETag of the result it would be sent gets a 304 instead, without
+    a query when the result is cached and the worker read the data version recently.
+    For a page of `limit` rows, compute fetches one row more; if it's there, the cursor
+    of the last row on the page is sent in the X-Next-Cursor header.
+
+    The rows are encoded with orjson once, when they're computed, and the cache holds the
+    JSON bytes, so a hit is sent as is and nothing goes through response_model validation.
+
+    Results are cached per read target, one read on a lagging replica is never served to
+    a request routed to the primary, at the result_version of the service computing them
+    (the data version, or the watermark of the columnar snapshot). A client reading its
+    own writes skips the cache.
+    """
+    headers = {"Cache-Control": "no-cache", **(extra_headers or {})}
+
+    async def render() -> tuple[bytes, Optional[str]]:
+        rows = await compute()
+        cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            cursor = next_cursor(rows[-1])
+        return orjson.dumps(rows), cursor
+
+    target = read_target(service.db)
+    key = (target, key)
+    if target == OWN_WRITES:
+        # A cached (or old, while another request recomputes it) result may predate this client's write
+        body, cursor = await render()
+        etag = analytics_cache.etag(key, body)
+    else:
+        version = await service.result_version()
+        (body, cursor), etag = await analytics_cache.get_or_compute(key, version, render)
+    if cursor is not None:
+        headers[NEXT_CURSOR_HEADER] = cursor
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={**headers, "ETag": etag})
+    return Response(body, media_type="application/json", headers={**headers, "ETag": etag})
+
+
+def _zip_order_count(row) -> dict[str, Any]:
+    return {"zip_code": row.zip_code, "order_count": row.order_count}
+
+
+async def _zip_order_counts_response(request: Request, endpoint: str, method: str, ascending: bool,
+                                     window: tuple, limit: Optional[int], cursor: Optional[str], stream: bool,
+                                     db: AsyncSession) -> Response:
+    """
+    Shared by the two zip code endpoints. Pages are keyset paginated on (order_count, zip_code).
+    With stream=true the rows are written as NDJSON as the database cursor produces them,
+    rather than collected into one cached JSON list.
+    """
+    after = decode_cursor(cursor, ascending=ascending)
+    if after is not None:
+        if not isinstance(after.get("order_count"), int) or not isinstance(after.get("zip_code"), str):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        after = (after["order_count"], after["zip_code"])
+    service = analytics_service(db)
+
+    if stream:
+        rows = getattr(service, f"stream_{method}")(ascending, *window, limit, after)
+
+        async def lines():
+            try:
+                buffer = []
+                async for row in rows:
+                    buffer.append(orjson.dumps(_zip_order_count(row)))
+                    if len(buffer) >= STREAM_BATCH_SIZE:
+                        yield b"\n".join(buffer) + b"\n"
+                        buffer = []
+                if buffer:
+                    yield b"\n".join(buffer) + b"\n"
+            finally:
+                await db.close()
 
-@analytics_router.get("/orders-by-billing-zip", response_model=List[Dict[str, Any]])
-def get_orders_by_billing_zip(
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    async def compute():
+        results = await getattr(service, f"get_{method}")(ascending, *window, limit + 1 if limit else None, after)
+        return [_zip_order_count(result) for result in results]
+
+    return await _cached_response(
+        request, service, (endpoint, ascending, *window, limit, after), compute, limit,
+        lambda row: encode_cursor({"ascending": ascending, **row})
+    )
+
+
+@analytics_router.get("/orders-by-billing-zip", response_model=List[Dict[str, Any]], dependencies=[Depends(QueryBudget(3))])
+async def get_orders_by_billing_zip(
+    request: Request,
     ascending: bool = Query(False, description="Sort in ascending order if True, descending if False"),
-    db: Session = Depends(get_db)
+    window: tuple[Optional[datetime], Optional[datetime]] = Depends(time_window),
+    limit: Optional[int] = Query(None, ge=1, le=10000, description="Page size, all zip codes if not given"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    stream: bool = Query(False, description="Stream the rows as NDJSON"),
+    db: AsyncSession = Depends(get_read_db)
 ):
-    analytics_service = AnalyticsService(db)
-    results = analytics_service.get_order_count_by_billing_zip_code(ascending=ascending)
-    return [{"zip_code": result.zip_code, "order_count": result.order_count} for result in results]
+    return await _zip_order_counts_response(
+        request, "orders-by-billing-zip", "order_count_by_billing_zip_code", ascending, window, limit, cursor, stream, db
+    )
 
 
-@analytics_router.get("/orders-by-shipping-zip", response_model=List[Dict[str, Any]])
-def get_orders_by_shipping_zip(
+@analytics_router.get("/orders-by-shipping-zip", response_model=List[Dict[str, Any]], dependencies=[Depends(QueryBudget(3))])
+async def get_orders_by_shipping_zip(
+    request: Request,
     ascending: bool = Query(False, description="Sort in ascending order if True, descending if False"),
-    db: Session = Depends(get_db)
+    window: tuple[Optional[datetime], Optional[datetime]] = Depends(time_window),
+    limit: Optional[int] = Query(None, ge=1, le=10000, description="Page size, all zip codes if not given"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    stream: bool = Query(False, description="Stream the rows as NDJSON"),
+    approximate: bool = Query(False, description="Estimate the counts from HyperLogLog sketches"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    if approximate:
+        if limit is not None or cursor is not None or stream:
+            raise HTTPException(status_code=400, detail="approximate can't be combined with limit, cursor or stream")
+        approximate_window(window)
+
+        service = AnalyticsService(db)
+
+        async def compute():
+            results = await service.get_approximate_order_count_by_shipping_zip_code(ascending, *window)
+            return [{**_zip_order_count(result), "error_bound": result.error_bound} for result in results]
+
+        return await _cached_response(
+            request, service, ("orders-by-shipping-zip", "approximate", ascending, *window), compute,
+            extra_headers={APPROXIMATE_ERROR_HEADER: APPROXIMATE_RELATIVE_ERROR}
+        )
+
+    return await _zip_order_counts_response(
+        request, "orders-by-shipping-zip", "order_count_by_shipping_zip_code", ascending, window, limit, cursor, stream, db
+    )
+
+
+@analytics_router.get("/store-purchase-times", response_model=List[Dict[str, Any]], dependencies=[Depends(QueryBudget(3))])
+async def get_store_purchase_times(
+    request: Request,
+    window: tuple[Optional[datetime], Optional[datetime]] = Depends(time_window),
+    db: AsyncSession = Depends(get_read_db)
+):
+    service = analytics_service(db)
+
+    async def compute():
+        results = await service.get_most_purchase_time_of_day(*window)
+        return [{"hour": int(result.hour), "purchase_count": result.purchase_count} for result in results]
+
+    return await _cached_response(request, service, ("store-purchase-times", *window), compute)
+
+
+@analytics_router.get("/top-store-pickup-users", response_model=List[Dict[str, Any]], dependencies=[Depends(QueryBudget(3))])
+async def get_top_store_pickup_users(
+    request: Request,
+    limit: int = Query(5, ge=1, le=5000, description="Number of users to return"),
+    offset: int = Query(0, ge=0, description="Number of top users to skip"),
+    window: tuple[Optional[datetime], Optional[datetime]] = Depends(time_window),
+    approximate: bool = Query(False, description="Rank by order counts estimated from HyperLogLog sketches"),
+    db: AsyncSession = Depends(get_read_db)
 ):
-    analytics_service = AnalyticsService(db)
-    results = analytics_service.get_order_count_by_shipping_zip_code(ascending=ascending)
-    return [{"zip_code": result.zip_code, "order_count": result.order_count} for result in results]
-
-
-@analytics_router.get("/store-purchase-times", response_model=List[Dict[str, Any]])
-def get_store_purchase_times(db: Session = Depends(get_db)):
-    analytics_service = AnalyticsService(db)
-    results = analytics_service.get_most_purchase_time_of_day()
-    return [{"hour": int(result.hour), "purchase_count": result.purchase_count} for result in results]
-
-
-@analytics_router.get("/top-store-pickup-users", response_model=List[Dict[str, Any]])
-def get_top_store_pickup_users(db: Session = Depends(get_db)):
-    analytics_service = AnalyticsService(db)
-    results = analytics_service.get_users_with_most_store_pickups()
-    return [
-        {
-            "customer_id": result.id,
-            "first_name": result.first_name,
-            "last_name": result.last_name,
-            "email": result.email,
-            "store_order_count": result.store_order_count
-        }
-        for result in results
-    ]
\ No newline at end of file
+    if approximate:
+        approximate_window(window)
+        service = AnalyticsService(db)
+    else:
+        service = analytics_service(db)
+
+    async def compute():
+        if approximate:
+            results = await service.get_approximate_users_with_most_store_pickups(limit, offset, *window)
+        else:
+            results = await service.get_users_with_most_store_pickups(limit, offset, *window)
+        return [
+            {
+                "customer_id": result.id,
+                "first_name": result.first_name,
+                "last_name": result.last_name,
+                "email": result.email,
+                "store_order_count": result.store_order_count,
+                **({"error_bound": result.error_bound} if approximate else {})
+            }
+            for result in results
+        ]
+
+    return await _cached_response(
+        request, service, ("top-store-pickup-users", limit, offset, *window, approximate), compute,
+        extra_headers={APPROXIMATE_ERROR_HEADER: APPROXIMATE_RELATIVE_ERROR} if approximate else None
+    )
+
+
+@analytics_router.get("/cache-stats")
+async def get_analytics_cache_stats():
+    return {**analytics_cache.stats(), "single_flight": analytics_single_flight.stats()}
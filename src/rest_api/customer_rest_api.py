@@ -1,36 +1,105 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from src.data.database import get_db
+from datetime import datetime
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.data.async_database import get_async_db
+from src.data.read_replicas import get_read_db, remember_write
+from src.data.tables.customer import Customer
+from src.monitoring.query_budget import QueryBudget
+from src.monitoring.tracing import TracedRoute
+from src.rest_api.pagination import NEXT_CURSOR_HEADER, decode_cursor, encode_cursor
+from src.rest_api.purchase_rest_api import purchase_detail, purchase_expansions
+from src.rest_api.responses import lookup_results, model_response
+from src.services.analytics_service import as_utc
 from src.services.customer_service import CustomerService
-from src.rest_api.schemas import CustomerCreate, CustomerResponse
+from src.services.purchase_service import PurchaseService
+from src.rest_api.schemas import (
+    CustomerCreate, CustomerLookup, CustomerLookupResponse, CustomerPurchaseResponse, CustomerResponse
+)
 
 customer_router = APIRouter(
     prefix="/customer",
-    tags=["customer"]
+    tags=["customer"],
+    route_class=TracedRoute
 )
 
 
-@customer_router.post("/", response_model=CustomerResponse)
-def new_customer(request: CustomerCreate, db: Session = Depends(get_db)):
+@customer_router.post("/", response_model=CustomerResponse, dependencies=[Depends(QueryBudget(5))])
+async def new_customer(request: CustomerCreate, db: AsyncSession = Depends(get_async_db)):
     customer_service = CustomerService(db)
-    return customer_service.new_customer(request)
+    customer = await customer_service.new_customer(request)
+    response = model_response(CustomerResponse, customer)
+    remember_write(response)
+    return response
 
 
-@customer_router.get("/by-phone/{phone_number}", response_model=CustomerResponse)
-def get_customer_by_phone(phone_number: str, db: Session = Depends(get_db)):
+@customer_router.get("/by-phone/{phone_number}", response_model=CustomerResponse, dependencies=[Depends(QueryBudget(1))])
+async def get_customer_by_phone(phone_number: str, db: AsyncSession = Depends(get_read_db)):
     customer_service = CustomerService(db)
-    customer = customer_service.query_customer_by_phone(phone_number)
+    customer = await customer_service.query_customer_by_phone(phone_number)
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
-    return customer
+    return model_response(CustomerResponse, customer)
 
 
-@customer_router.get("/by-email/{email}", response_model=CustomerResponse)
-def get_customer_by_email(email: str, db: Session = Depends(get_db)):
+@customer_router.get("/by-email/{email}", response_model=CustomerResponse, dependencies=[Depends(QueryBudget(1))])
+async def get_customer_by_email(email: str, db: AsyncSession = Depends(get_read_db)):
     customer_service = CustomerService(db)
-    customer = customer_service.query_customer_by_email(email)
+    customer = await customer_service.query_customer_by_email(email)
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
-    return customer
+    return model_response(CustomerResponse, customer)
+
+
+@customer_router.post("/lookup", response_model=CustomerLookupResponse, dependencies=[Depends(QueryBudget(2))])
+async def lookup_customers(request: CustomerLookup, db: AsyncSession = Depends(get_read_db)):
+    """
+    Resolve many customers by email and/or phone number in one request, one IN query per
+    key type. Every requested key is in the result, null when there's no such customer.
+    """
+    customer_service = CustomerService(db)
+    by_email = await customer_service.query_customers_by_emails(request.emails)
+    by_phone = await customer_service.query_customers_by_phones(request.phone_numbers)
+    return ORJSONResponse({
+        "by_email": lookup_results(CustomerResponse, request.emails, by_email),
+        "by_phone": lookup_results(CustomerResponse, request.phone_numbers, by_phone)
+    })
 
 
+@customer_router.get("/{customer_id}/purchases", response_model=list[CustomerPurchaseResponse], dependencies=[Depends(QueryBudget(5))])
+async def get_customer_purchases(
+    customer_id: int,
+    limit: int = Query(50, ge=1, le=1000, description="Page size"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    expand: set[str] = Depends(purchase_expansions),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    The customer's purchases, newest first, a page at a time. Pages are keyset paginated on
+    (created_at, id): when there are more, the cursor for the next page is sent in the
+    X-Next-Cursor header. expand embeds line items like GET /purchase/{id}.
+    """
+    after = decode_cursor(cursor, customer_id=customer_id)
+    if after is not None:
+        try:
+            after = (as_utc(datetime.fromisoformat(after["created_at"])), int(after["id"]))
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    purchases = await PurchaseService(db).get_customer_purchases(customer_id, limit + 1, after, expand)
+    if not purchases and after is None and await db.get(Customer, customer_id) is None:
+        raise HTTPException(status_code=404, detail="Customer not found")
+
+    headers = {}
+    if len(purchases) > limit:
+        purchases = purchases[:limit]
+        headers[NEXT_CURSOR_HEADER] = encode_cursor({
+            "customer_id": customer_id,
+            "created_at": as_utc(purchases[-1].created_at).isoformat(),
+            "id": purchases[-1].id
+        })
+    return ORJSONResponse(
+        [{**purchase_detail(purchase, expand), "created_at": as_utc(purchase.created_at)} for purchase in purchases],
+        headers=headers
+    )
@@ -0,0 +1,67 @@
+from datetime import datetime
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.data.read_replicas import get_read_db
+from src.monitoring.tracing import TracedRoute
+from src.rest_api.admin_auth import require_admin
+from src.services.export_service import (
+    EXPORT_BATCH_SIZE, EXPORT_FORMATS, ChunkSink, aiter_record_batches, arrow_schema, export_query,
+    export_sources, open_writer
+)
+
+export_router = APIRouter(
+    prefix="/export",
+    tags=["export"],
+    route_class=TracedRoute,
+    dependencies=[Depends(require_admin)]
+)
+
+MEDIA_TYPES = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream"
+}
+
+
+@export_router.get("/{name}")
+async def export(
+    name: str,
+    export_format: str = Query("parquet", alias="format", pattern="^(parquet|arrow)$"),
+    since_id: Optional[int] = Query(None, description="Only export rows with a greater id"),
+    since: Optional[datetime] = Query(None, description="Only export rows created at or after this time"),
+    lag_seconds: Optional[float] = Query(
+        None, ge=0, description="Stop before the first row created this recently, so the next export can continue "
+                                "after the last id without missing rows that committed late"
+    ),
+    batch_size: int = Query(EXPORT_BATCH_SIZE, ge=1, le=1_000_000, description="Rows per record batch / row group"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Stream a table (or the denormalized purchase_fact view) as a Parquet file or an Arrow IPC
+    stream, ordered by id. Rows are read through a server side cursor and sent a record
+    batch at a time, so neither side holds the whole table.
+    """
+    sources = export_sources()
+    if name not in sources:
+        raise HTTPException(status_code=404, detail=f"Unknown export {name}, expected one of {sorted(sources)}")
+    query = export_query(sources[name], since_id, since, lag_seconds)
+
+    async def body():
+        try:
+            sink = ChunkSink()
+            writer = open_writer(sink, arrow_schema(query), export_format)
+            async for batch in aiter_record_batches(db, query, batch_size):
+                writer.write_batch(batch)
+                yield sink.drain()
+            writer.close()
+            yield sink.drain()
+        finally:
+            await db.close()
+
+    filename = f"{name}{EXPORT_FORMATS[export_format]}"
+    return StreamingResponse(
+        body(),
+        media_type=MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
@@ -0,0 +1,28 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from src.data.pool import pool_registry
+from src.data.read_replicas import replica_router
+
+health_router = APIRouter(
+    prefix="/health",
+    tags=["health"]
+)
+
+
+@health_router.get("/pool")
+async def get_pool_metrics():
+    """Connection pool usage, checkout wait times and invalidations per engine, plus replica health."""
+    return {"pools": pool_registry.stats(), "replicas": replica_router.stats()}
+
+
+@health_router.get("/ready")
+async def readiness():
+    """
+    Readiness probe. Degraded (503) while any pool is saturated, ie checkouts are waiting
+    for a connection or DB_POOL_DEGRADED_RATIO of its connections are in use, so the
+    load balancer can send traffic elsewhere rather than queue it behind the pool.
+    """
+    saturated = [name for name, stats in pool_registry.stats().items() if stats["saturated"]]
+    if saturated:
+        return JSONResponse({"status": "degraded", "saturated_pools": saturated}, status_code=503)
+    return {"status": "ok", "saturated_pools": []}
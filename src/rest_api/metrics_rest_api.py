@@ -0,0 +1,15 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from src.data.pool import pool_registry
+from src.monitoring.metrics import render_pool_stats, request_metrics
+
+metrics_router = APIRouter(tags=["monitoring"])
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@metrics_router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Request and connection pool metrics in the Prometheus text exposition format."""
+    lines = [*request_metrics.render(), *render_pool_stats(pool_registry.stats())]
+    return PlainTextResponse("\n".join(lines) + "\n", media_type=PROMETHEUS_CONTENT_TYPE)
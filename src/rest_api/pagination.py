@@ -0,0 +1,28 @@
+import base64
+import json
+from typing import Any, Optional
+from fastapi import HTTPException
+
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(values: dict[str, Any]) -> str:
+    """Opaque keyset cursor: the sort key of the last row of a page, plus whatever it's only valid for."""
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str], **expected) -> Optional[dict[str, Any]]:
+    """
+    Decode a cursor from encode_cursor, or None if there isn't one. Cursors that don't
+    decode, or were made for a different ordering than `expected`, are a 400.
+    """
+    if cursor is None:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, dict) or any(values.get(key) != value for key, value in expected.items()):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
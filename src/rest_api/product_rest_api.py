@@ -1,34 +1,60 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from src.data.database import get_db
+from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.data.async_database import get_async_db
+from src.data.read_replicas import get_read_db, remember_write
+from src.monitoring.query_budget import QueryBudget
+from src.monitoring.tracing import TracedRoute
 from src.services.product_service import ProductService
-from src.rest_api.schemas import ProductCreate, ProductResponse
+from src.services.product_cache import product_cache
+from src.rest_api.responses import lookup_results
+from src.rest_api.schemas import IdLookup, ProductCreate, ProductResponse
+from typing import Optional
 
 product_router = APIRouter(
     prefix="/product",
-    tags=["customer"]
+    tags=["customer"],
+    route_class=TracedRoute
 )
 
 
-@product_router.post("/products/", response_model=ProductResponse)
-def create_product(request: ProductCreate, db: Session = Depends(get_db)):
+@product_router.post("/products/", response_model=ProductResponse, dependencies=[Depends(QueryBudget(3))])
+async def create_product(request: ProductCreate, response: Response, db: AsyncSession = Depends(get_async_db)):
     product_service = ProductService(db)
-    return product_service.create_product(request)
+    product = await product_service.create_product(request)
+    remember_write(response)
+    return product
 
 
-@product_router.get("/products/{product_id}", response_model=ProductResponse)
-def get_product_by_id(product_id: int, db: Session = Depends(get_db)):
+@product_router.get("/products/{product_id}", response_model=ProductResponse, dependencies=[Depends(QueryBudget(1))])
+async def get_product_by_id(product_id: int, db: AsyncSession = Depends(get_read_db)):
     product_service = ProductService(db)
-    product = product_service.get_product_by_id(product_id)
+    product = await product_service.get_product_by_id(product_id)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     return product
 
 
-@product_router.get("/products/by-name/{name}", response_model=ProductResponse)
-def get_product_by_name(name: str, db: Session = Depends(get_db)):
+@product_router.get("/products/by-name/{name}", response_model=ProductResponse, dependencies=[Depends(QueryBudget(1))])
+async def get_product_by_name(name: str, db: AsyncSession = Depends(get_read_db)):
     product_service = ProductService(db)
-    product = product_service.get_product_by_name(name)
+    product = await product_service.get_product_by_name(name)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     return product
+
+
+@product_router.post("/products/lookup", response_model=dict[int, Optional[ProductResponse]], dependencies=[Depends(QueryBudget(1))])
+async def lookup_products(request: IdLookup, db: AsyncSession = Depends(get_read_db)):
+    """
+    Resolve many products by id in one request, from the product cache and one IN query for
+    the rest. Every requested id is in the result, null when there's no such product.
+    """
+    product_service = ProductService(db)
+    products = await product_service.get_products_by_ids(request.ids)
+    return ORJSONResponse(lookup_results(ProductResponse, request.ids, products))
+
+
+@product_router.get("/cache-stats")
+async def get_product_cache_stats():
+    return product_cache.stats()
@@ -1,29 +1,238 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from src.data.database import get_db
+import logging
+from typing import Any, AsyncIterator, Optional
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.data.async_database import get_async_db
+from src.data.read_replicas import get_read_db, remember_write
+from src.data.tables.purchase_rollup import PurchaseRollup
+from src.monitoring.db_profiler import QueryStats
+from src.monitoring.query_budget import QueryBudget, QueryBudgetExceeded
+from src.monitoring.tracing import TracedRoute
+from src.rest_api.responses import lookup_results, model_fields, model_response
 from src.services.purchase_service import PurchaseService
-from src.rest_api.schemas import PurchaseCreate, PurchaseRollupResponse
+from src.rest_api.schemas import (
+    CustomerResponse, IdLookup, LocationResponse, ProductResponse, PurchaseCreate, PurchaseDetailResponse,
+    PurchaseProductResponse, PurchaseRollupResponse
+)
+
 
+logger = logging.getLogger(__name__)
 
 purchase_router = APIRouter(
     prefix="/purchase",
-    tags=["purchase"]
+    tags=["purchase"],
+    route_class=TracedRoute
 )
 
+# Statements one chunk of POST /purchase/batch may run: the customer, product and location
+# lookups, the inline location upsert and the select of addresses that already existed,
+# the purchase_rollup and purchase_product inserts and the six rollup and sketch upserts
+BATCH_CHUNK_QUERY_BUDGET = 13
+
+# What GET /purchase/{id}?expand= can load along with the purchase
+EXPANSIONS = ("products", "locations", "customer")
+
+
+class RequestBodyStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse whose body iterator is still consuming the request body. Starlette's
+    disconnect listener would compete with it for receive(), so it streams directly instead.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+async def _iter_lines(request: Request) -> AsyncIterator[tuple[int, bytes]]:
+    """Yield (line_number, line) for each non-blank line of the request body as it arrives."""
+    buffer = b""
+    line_number = 0
+    async for data in request.stream():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield line_number, line
+    if buffer.strip():
+        yield line_number + 1, buffer
+
+
+def batch_chunk_query_budget(db: AsyncSession, requests: list[PurchaseCreate]) -> int:
+    """
+    The query budget of a chunk. An INSERT ... RETURNING is sent a page of rows at a time,
+    so the purchase_rollup, inline location and purchase_product inserts of a large chunk
+    take a statement for each further page on top of BATCH_CHUNK_QUERY_BUDGET.
+    """
+    page_size = db.get_bind().dialect.insertmanyvalues_page_size
+    line_items = sum(len(request.products) for request in requests)
+    inline_locations = sum(item.shipping_location is not None for request in requests for item in request.products)
+    return BATCH_CHUNK_QUERY_BUDGET + sum(
+        max(0, (rows - 1) // page_size) for rows in (len(requests), inline_locations, line_items)
+    )
+
+
+async def _write_purchases(purchase_service: PurchaseService, parsed: list[tuple[int, PurchaseCreate]]) -> list:
+    """
+    Write parsed purchases in one transaction, returning the created rollup or the ValueError
+    for each. If the transaction fails, each purchase is retried in its own transaction, so
+    only the lines that can't be written are reported as errors.
+    """
+    first_line, last_line = parsed[0][0], parsed[-1][0]
+    requests = [request for _, request in parsed]
+    budget = QueryBudget(
+        batch_chunk_query_budget(purchase_service.db, requests), f"POST /purchase/batch lines {first_line}-{last_line}"
+    )
+    try:
+        with QueryStats(record_statements=True) as stats:
+            results = await purchase_service.create_purchases(requests)
+    except SQLAlchemyError:
+        await purchase_service.db.rollback()
+    else:
+        # Checked once the chunk has committed, so going over budget is reported without
+        # turning purchases that were written into errors or cutting the response short
+        try:
+            budget.check(stats, budget.name)
+        except QueryBudgetExceeded:
+            logger.exception("Batch chunk went over its query budget")
+        return results
+    if len(parsed) == 1:
+        return [ValueError(f"Could not write purchase on line {first_line}")]
+    results = []
+    for purchase in parsed:
+        results.extend(await _write_purchases(purchase_service, [purchase]))
+    return results
+
+
+async def _create_purchase_chunk(purchase_service: PurchaseService, chunk: list[tuple[int, bytes]]) -> bytes:
+    """Parse, validate and write one chunk of NDJSON purchases, returning the NDJSON results."""
+    results = {}
+    parsed = []
+    for line_number, line in chunk:
+        try:
+            parsed.append((line_number, PurchaseCreate.model_validate_json(line)))
+        except ValidationError as e:
+            results[line_number] = {
+                "line": line_number,
+                "status": "error",
+                "detail": e.errors(include_url=False, include_context=False, include_input=False)
+            }
 
-@purchase_router.post("/", response_model=PurchaseRollupResponse)
-def new_purchase(request: PurchaseCreate, db: Session = Depends(get_db)):
+    if parsed:
+        created = await _write_purchases(purchase_service, parsed)
+        for (line_number, _), result in zip(parsed, created):
+            if isinstance(result, ValueError):
+                results[line_number] = {"line": line_number, "status": "error", "detail": str(result)}
+            else:
+                results[line_number] = {
+                    "line": line_number,
+                    "status": "created",
+                    "purchase": model_fields(PurchaseRollupResponse, result)
+                }
+
+    return b"".join(orjson.dumps(results[line_number]) + b"\n" for line_number, _ in chunk)
+
+
+@purchase_router.post("/", response_model=PurchaseRollupResponse, dependencies=[Depends(QueryBudget(16))])
+async def new_purchase(request: PurchaseCreate, db: AsyncSession = Depends(get_async_db)):
     purchase_service = PurchaseService(db)
     try:
-        return purchase_service.create_purchase(request)
+        purchase = await purchase_service.create_purchase(request)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    response = model_response(PurchaseRollupResponse, purchase)
+    remember_write(response)
+    return response
+
+
+@purchase_router.post("/batch")
+async def new_purchase_batch(
+    request: Request,
+    chunk_size: int = Query(500, ge=1, le=5000, description="Number of purchases validated and written per transaction"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Bulk purchase ingestion. The body is NDJSON, one PurchaseCreate per line. Purchases are
+    validated and written a chunk at a time, and one NDJSON result per input line is streamed
+    back as each chunk commits, so memory use doesn't depend on the size of the batch.
+    """
+    purchase_service = PurchaseService(db)
+
+    async def results():
+        try:
+            chunk = []
+            async for line_number, line in _iter_lines(request):
+                chunk.append((line_number, line))
+                if len(chunk) >= chunk_size:
+                    yield await _create_purchase_chunk(purchase_service, chunk)
+                    chunk = []
+            if chunk:
+                yield await _create_purchase_chunk(purchase_service, chunk)
+        finally:
+            await db.close()
+
+    response = RequestBodyStreamingResponse(results(), media_type="application/x-ndjson")
+    remember_write(response)
+    return response
+
+
+@purchase_router.post("/lookup", response_model=dict[int, Optional[PurchaseRollupResponse]], dependencies=[Depends(QueryBudget(1))])
+async def lookup_purchases(request: IdLookup, db: AsyncSession = Depends(get_read_db)):
+    """
+    Resolve many purchases by id in one request with a single IN query. Every requested
+    id is in the result, null when there's no such purchase.
+    """
+    purchase_service = PurchaseService(db)
+    purchases = await purchase_service.get_purchases_by_ids(request.ids)
+    return ORJSONResponse(lookup_results(PurchaseRollupResponse, request.ids, purchases))
+
+
+def purchase_expansions(
+    expand: Optional[str] = Query(None, description="Comma separated, any of " + ",".join(EXPANSIONS))
+) -> set[str]:
+    expansions = {name.strip() for name in (expand or "").split(",") if name.strip()}
+    unknown = expansions - set(EXPANSIONS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown expand {sorted(unknown)}, expected any of {list(EXPANSIONS)}")
+    return expansions
+
+
+def purchase_detail(purchase: PurchaseRollup, expand: set[str]) -> dict[str, Any]:
+    detail = model_fields(PurchaseRollupResponse, purchase)
+    if "products" in expand or "locations" in expand:
+        detail["products"] = []
+        for line_item in purchase.products:
+            item = model_fields(PurchaseProductResponse, line_item)
+            if "products" in expand:
+                item["product"] = model_fields(ProductResponse, line_item.product)
+            if "locations" in expand:
+                item["shipping_location"] = model_fields(LocationResponse, line_item.shipping_location)
+            detail["products"].append(item)
+    if "customer" in expand:
+        detail["customer"] = model_fields(CustomerResponse, purchase.customer)
+    return detail
 
 
-@purchase_router.get("/{purchase_id}", response_model=PurchaseRollupResponse)
-def get_purchase(purchase_id: int, db: Session = Depends(get_db)):
+@purchase_router.get("/{purchase_id}", response_model=PurchaseDetailResponse, dependencies=[Depends(QueryBudget(5))])
+async def get_purchase(purchase_id: int, expand: set[str] = Depends(purchase_expansions),
+                       db: AsyncSession = Depends(get_read_db)):
+    """
+    A purchase, optionally with its line items and their product ("products") and/or
+    shipping location ("locations"), and its "customer", loaded in a fixed number of queries.
+    """
     purchase_service = PurchaseService(db)
-    purchase = purchase_service.get_purchase_by_id(purchase_id)
+    if expand:
+        purchase = await purchase_service.get_purchase_detail(purchase_id, expand)
+    else:
+        purchase = await purchase_service.get_purchase_by_id(purchase_id)
     if not purchase:
         raise HTTPException(status_code=404, detail="Purchase not found")
-    return purchase
+    if expand:
+        return ORJSONResponse(purchase_detail(purchase, expand))
+    return model_response(PurchaseRollupResponse, purchase)
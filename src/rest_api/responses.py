@@ -0,0 +1,22 @@
+from typing import Any, Hashable, Iterable, Mapping
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+
+def model_fields(model: type[BaseModel], obj: Any) -> dict[str, Any]:
+    """The attributes of obj that model declares, as a plain dict."""
+    return {name: getattr(obj, name) for name in model.model_fields}
+
+
+def model_response(model: type[BaseModel], obj: Any) -> ORJSONResponse:
+    """
+    Render an ORM object as `model` straight to JSON with orjson. Values loaded from the
+    database don't need validating again, so this skips FastAPI's response_model
+    validation and serialization; the endpoint keeps response_model for the schema.
+    """
+    return ORJSONResponse(model_fields(model, obj))
+
+
+def lookup_results(model: type[BaseModel], keys: Iterable[Hashable], found: Mapping[Hashable, Any]) -> dict:
+    """Each key, in request order, mapped to its object rendered as `model`, or None if it wasn't found."""
+    return {key: model_fields(model, found[key]) if key in found else None for key in keys}
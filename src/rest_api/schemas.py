@@ -1,4 +1,5 @@
-from pydantic import BaseModel, EmailStr, validator
+from pydantic import BaseModel, EmailStr, Field, validator
+from datetime import datetime
 from typing import Optional
 from enum import Enum
 
@@ -109,3 +110,37 @@ class PurchaseRollupResponse(BaseModel):
     
     class Config:
         from_attributes = True
+
+
+class PurchaseLineItemResponse(PurchaseProductResponse):
+    product: Optional[ProductResponse] = None
+    shipping_location: Optional[LocationResponse] = None
+
+
+class PurchaseDetailResponse(PurchaseRollupResponse):
+    """A purchase with whatever GET /purchase/{id}?expand= asked for"""
+    products: Optional[list[PurchaseLineItemResponse]] = None
+    customer: Optional[CustomerResponse] = None
+
+
+class CustomerPurchaseResponse(PurchaseDetailResponse):
+    created_at: datetime
+
+
+# Most keys a batch lookup endpoint resolves in one request
+MAX_LOOKUP_KEYS = 5000
+
+
+class CustomerLookup(BaseModel):
+    emails: list[str] = Field(default_factory=list, max_length=MAX_LOOKUP_KEYS)
+    phone_numbers: list[str] = Field(default_factory=list, max_length=MAX_LOOKUP_KEYS)
+
+
+class CustomerLookupResponse(BaseModel):
+    """Each requested email/phone number mapped to its customer, or null if there isn't one"""
+    by_email: dict[str, Optional[CustomerResponse]]
+    by_phone: dict[str, Optional[CustomerResponse]]
+
+
+class IdLookup(BaseModel):
+    ids: list[int] = Field(max_length=MAX_LOOKUP_KEYS)
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import time
+from typing import Any, Awaitable, Callable, Hashable
+from sqlalchemy import event, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from src.data.tables.analytics_rebuild import AnalyticsRebuild
+from src.data.tables.customer import Customer
+from src.data.tables.purchase_rollup import PurchaseRollup
+from src.utils.cache import CACHE_MISS, LRUCache
+
+
+ANALYTICS_CACHE_MAX_SIZE = int(os.getenv("ANALYTICS_CACHE_MAX_SIZE", "1000"))
+# Upper bound on how stale a result can get, see DataVersion
+ANALYTICS_CACHE_TTL_SECONDS = float(os.getenv("ANALYTICS_CACHE_TTL_SECONDS", "10"))
+# How long a worker reuses the data version before reading it again, see DataVersion
+ANALYTICS_DATA_VERSION_TTL_SECONDS = float(os.getenv("ANALYTICS_DATA_VERSION_TTL_SECONDS", "1"))
+
+
+class DataVersion:
+    """
+    Version of the data analytics are computed from, read from the database so every
+    worker (and the rollup rebuild CLI) sees the same one: the newest purchase, customer
+    and rollup rebuild ids, in one statement of primary key maxima. A purchase that
+    commits after one with a higher id doesn't change it, so a result can miss such a
+    purchase until its cache entry expires (ANALYTICS_CACHE_TTL_SECONDS).
+
+    Each worker reuses the version it read from a database for ttl_seconds, so a cache
+    hit or a 304 costs no round trip. A commit that wrote anything in this worker makes
+    it read the version again, writes made by other workers are seen up to ttl_seconds late.
+    """
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        # database URL -> (monotonic time read, version)
+        self._versions: dict[str, tuple[float, str]] = {}
+        self._generation = 0
+
+    @staticmethod
+    def query():
+        return select(
+            select(func.max(PurchaseRollup.id)).scalar_subquery(),
+            select(func.max(Customer.id)).scalar_subquery(),
+            select(func.max(AnalyticsRebuild.id)).scalar_subquery()
+        )
+
+    async def read(self, db: AsyncSession) -> str:
+        """The version of db's database, read at most once per transaction and ttl_seconds."""
+        version = db.info.get(_SESSION_DATA_VERSION)
+        if version is None:
+            database = str(db.get_bind().url)
+            cached = self._versions.get(database)
+            if cached is not None and time.monotonic() - cached[0] < self.ttl_seconds:
+                version = cached[1]
+            else:
+                generation, read_at = self._generation, time.monotonic()
+                row = (await db.execute(self.query())).one()
+                version = ".".join(str(value or 0) for value in row)
+                # Unless a write committed meanwhile, which this version may predate
+                if generation == self._generation:
+                    self._versions[database] = (read_at, version)
+            db.info[_SESSION_DATA_VERSION] = version
+        return version
+
+    def invalidate(self):
+        """Read the version again on next use, after this worker committed a write."""
+        self._generation += 1
+        self._versions.clear()
+
+    clear = invalidate
+
+
+_SESSION_DATA_VERSION = "analytics_data_version"
+_SESSION_WROTE = "analytics_data_written"
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _forget_data_version(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(_SESSION_DATA_VERSION, None)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _note_executed_write(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info[_SESSION_WROTE] = True
+
+
+@event.listens_for(Session, "after_flush")
+def _note_flushed_write(session, flush_context):
+    session.info[_SESSION_WROTE] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_data_version(session):
+    if session.info.pop(_SESSION_WROTE, False):
+        data_version.invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_write(session):
+    session.info.pop(_SESSION_WROTE, None)
+
+
+class AnalyticsCache:
+    """
+    Cache of analytics results keyed by endpoint and parameters, tagged with the data
+    version they were computed at. A result from an older version is recomputed by the
+    caller that finds it, and while that caller is recomputing it every other caller gets
+    the old result instead of starting the same query. Nothing recomputes in the
+    background: with no request for a key, its entry stays as it is until it expires.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self._entries = LRUCache(max_size, ttl_seconds)
+        self._refreshing: set[Hashable] = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def etag(key: Hashable, result: Any) -> str:
+        """
+        ETag of a result, a hash of its content: a client that has it is up to date however
+        the result came to be recomputed, and one that hasn't never gets a 304.
+        """
+        digest = hashlib.sha1(repr(key).encode())
+        digest.update(result if isinstance(result, bytes) else repr(result).encode())
+        return f'"{digest.hexdigest()[:20]}"'
+
+    async def get_or_compute(self, key: Hashable, version: str, compute: Callable[[], Awaitable[Any]]) -> tuple[Any, str]:
+        """Return the result for key at the data version and its ETag, calling compute only when needed."""
+        cached = self._entries.get(key)
+        if cached is not CACHE_MISS:
+            cached_version, result, etag = cached
+            if cached_version == version:
+                self.hits += 1
+                return result, etag
+            if key in self._refreshing:
+                self.stale_hits += 1
+                return result, etag
+
+        self.misses += 1
+        self._refreshing.add(key)
+        try:
+            result = await compute()
+        finally:
+            self._refreshing.discard(key)
+        # Stored under the version read before computing, a write that lands meanwhile
+        # makes the next call recompute
+        etag = self.etag(key, result)
+        self._entries.set(key, (version, result, etag))
+        return result, etag
+
+    def clear(self):
+        self._entries.clear()
+        self._refreshing.clear()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "size": self._entries.stats()["size"],
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses
+        }
+
+
+data_version = DataVersion(ANALYTICS_DATA_VERSION_TTL_SECONDS)
+analytics_cache = AnalyticsCache(ANALYTICS_CACHE_MAX_SIZE, ANALYTICS_CACHE_TTL_SECONDS)
@@ -0,0 +1,223 @@
+import asyncio
+from collections import Counter, defaultdict
+from datetime import date
+from typing import NamedTuple, Optional
+import numpy as np
+from sqlalchemy import delete, insert, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.data.async_database import AsyncSessionLocal, async_engine
+from src.data.database import upsert
+from src.data.schema_upgrades import create_schema
+from src.data.tables.analytics_rebuild import AnalyticsRebuild
+from src.data.tables.analytics_sketch import CustomerStoreDaySketch, ShippingZipDaySketch
+from src.data.tables.customer_store_order_count import CustomerStoreOrderCount
+from src.data.tables.location import Location, LocationType
+from src.data.tables.purchase_product import PurchaseProduct
+from src.data.tables.purchase_rollup import PurchaseRollup
+from src.data.tables.store_purchase_hour_count import StorePurchaseHourCount
+from src.data.tables.zip_order_count import BillingZipOrderCount, ShippingZipOrderCount
+from src.services.analytics_service import (
+    as_utc,
+    billing_zip_order_counts_query,
+    customer_store_order_counts_query,
+    shipping_zip_order_counts_query,
+    store_purchase_hour_counts_query
+)
+from src.services.hyperloglog import HyperLogLog
+from src.monitoring.service_calls import instrument_service
+
+
+class PurchaseFacts(NamedTuple):
+    """What the rollups need to know about a new purchase."""
+    purchase_rollup_id: int
+    customer_id: int
+    # zip code of the customer's billing location, None without one
+    billing_zip_code: Optional[str]
+    # purchase_product.purchase_hour of the purchase's products
+    purchase_hour: int
+    # UTC day the purchase was made, for the per day sketches
+    purchase_day: date
+    # (zip code, location type) each of the purchase's products ships to
+    shipping_locations: list[tuple[str, LocationType]]
+
+
+# The rollup tables, in the order record_purchases writes them
+ROLLUP_TABLES = (
+    BillingZipOrderCount, ShippingZipOrderCount, StorePurchaseHourCount, CustomerStoreOrderCount,
+    ShippingZipDaySketch, CustomerStoreDaySketch
+)
+
+
+@instrument_service
+class AnalyticsRollupService:
+    """
+    Maintains the analytics rollup tables. record_purchases runs inside the purchase
+    transaction so the rollups commit or roll back together with the purchase, rebuild
+    recomputes them from scratch (backfill, or repair after a manual data fix).
+    """
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def _increment(self, table, key_column, value_column, increments: Counter):
+        """Add each count in increments to its row, creating missing rows, in one upsert."""
+        if not increments:
+            return
+        statement = upsert(self.db, table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[key_column],
+            set_={value_column.key: value_column + getattr(statement.excluded, value_column.key)}
+        )
+        # Sorted so concurrent purchases lock the same rows in the same order
+        await self.db.execute(
+            statement,
+            [{key_column.key: key, value_column.key: count} for key, count in sorted(increments.items())]
+        )
+
+    async def _add_to_sketches(self, table, key_columns: list, additions: dict[tuple, set[int]]):
+        """
+        Add order ids to the sketch of each (key..., day) in additions, in one upsert that
+        only raises a register's rank. Rows are never read, so nothing is locked beyond the
+        registers the orders land in.
+        """
+        if not additions:
+            return
+        key_names = [column.key for column in key_columns]
+        ranks = {}
+        for key, order_ids in additions.items():
+            for order_id in order_ids:
+                register, rank = HyperLogLog.position(order_id)
+                ranks[(*key, register)] = max(rank, ranks.get((*key, register), 0))
+        statement = upsert(self.db, table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[*key_columns, table.register],
+            set_={"rank": statement.excluded.rank},
+            where=table.rank < statement.excluded.rank
+        )
+        # Sorted so concurrent purchases lock the same rows in the same order
+        await self.db.execute(statement, [
+            {**dict(zip(key_names, row_key)), "register": row_key[-1], "rank": rank}
+            for row_key, rank in sorted(ranks.items())
+        ])
+
+    async def record_purchases(self, purchases: list[PurchaseFacts]):
+        """Count new purchases into the rollups."""
+        billing_zip_counts = Counter()
+        shipping_zip_counts = Counter()
+        store_hour_counts = Counter()
+        customer_store_order_counts = Counter()
+        shipping_zip_day_orders = defaultdict(set)
+        customer_store_day_orders = defaultdict(set)
+        for purchase in purchases:
+            if purchase.billing_zip_code is not None:
+                billing_zip_counts[purchase.billing_zip_code] += 1
+            shipping_zip_codes = {zip_code for zip_code, _ in purchase.shipping_locations}
+            shipping_zip_counts.update(shipping_zip_codes)
+            for zip_code in shipping_zip_codes:
+                shipping_zip_day_orders[(zip_code, purchase.purchase_day)].add(purchase.purchase_rollup_id)
+            store_product_count = sum(
+                location_type == LocationType.STORE for _, location_type in purchase.shipping_locations
+            )
+            if store_product_count:
+                store_hour_counts[purchase.purchase_hour] += store_product_count
+                customer_store_order_counts[purchase.customer_id] += 1
+                customer_store_day_orders[(purchase.customer_id, purchase.purchase_day)].add(purchase.purchase_rollup_id)
+
+        await self._increment(BillingZipOrderCount, BillingZipOrderCount.zip_code, BillingZipOrderCount.order_count, billing_zip_counts)
+        await self._increment(ShippingZipOrderCount, ShippingZipOrderCount.zip_code, ShippingZipOrderCount.order_count, shipping_zip_counts)
+        await self._increment(StorePurchaseHourCount, StorePurchaseHourCount.hour, StorePurchaseHourCount.purchase_count, store_hour_counts)
+        await self._increment(
+            CustomerStoreOrderCount, CustomerStoreOrderCount.customer_id, CustomerStoreOrderCount.store_order_count,
+            customer_store_order_counts
+        )
+        await self._add_to_sketches(
+            ShippingZipDaySketch, [ShippingZipDaySketch.zip_code, ShippingZipDaySketch.day], shipping_zip_day_orders
+        )
+        await self._add_to_sketches(
+            CustomerStoreDaySketch, [CustomerStoreDaySketch.customer_id, CustomerStoreDaySketch.day], customer_store_day_orders
+        )
+
+    async def _rebuild_sketches(self, table, key_column, query):
+        """
+        Replace table's sketches with ones built from query's (key, created_at, order id) rows.
+        The rows come off a server side cursor ordered by key, so only one key's sketches
+        are held in memory at a time.
+        """
+        await self.db.execute(delete(table))
+
+        async def write(key, sketches: dict[date, HyperLogLog]):
+            await self.db.execute(insert(table), [
+                {key_column.key: key, "day": day, "register": int(register), "rank": int(sketch.registers[register])}
+                for day, sketch in sorted(sketches.items())
+                for register in np.flatnonzero(sketch.registers)
+            ])
+
+        current_key, sketches = None, {}
+        async for key, created_at, purchase_rollup_id in await self.db.stream(query.execution_options(yield_per=10000)):
+            if key != current_key and sketches:
+                await write(current_key, sketches)
+                sketches = {}
+            current_key = key
+            day = as_utc(created_at).date()
+            sketches.setdefault(day, HyperLogLog()).add(purchase_rollup_id)
+        if sketches:
+            await write(current_key, sketches)
+
+    async def _lock_rollups(self):
+        """
+        Lock the rollup tables against writes, not reads, until the rebuild commits. A
+        purchase that already counted itself in commits first and is read by the rebuild,
+        one that hasn't waits and counts itself into the rebuilt rollups, so each purchase
+        is counted once. Only Postgres needs it, SQLite runs one write transaction at a time.
+        """
+        if self.db.get_bind().dialect.name != "postgresql":
+            return
+        tables = ", ".join(table.__tablename__ for table in ROLLUP_TABLES)
+        await self.db.execute(text(f"LOCK TABLE {tables} IN EXCLUSIVE MODE"))
+
+    async def rebuild(self):
+        """
+        Recompute every rollup table from the purchase history and commit. Purchase products
+        from before the bucket columns existed are bucketed by create_schema beforehand.
+        """
+        await self._lock_rollups()
+        for table, columns, query in (
+            (BillingZipOrderCount, ["zip_code", "order_count"], billing_zip_order_counts_query()),
+            (ShippingZipOrderCount, ["zip_code", "order_count"], shipping_zip_order_counts_query()),
+            (StorePurchaseHourCount, ["hour", "purchase_count"], store_purchase_hour_counts_query()),
+            (CustomerStoreOrderCount, ["customer_id", "store_order_count"], customer_store_order_counts_query()),
+        ):
+            await self.db.execute(delete(table))
+            await self.db.execute(insert(table).from_select(columns, query))
+
+        await self._rebuild_sketches(
+            ShippingZipDaySketch, ShippingZipDaySketch.zip_code,
+            select(Location.zip_code, PurchaseProduct.created_at, PurchaseProduct.purchase_rollup_id)
+            .join(Location, Location.id == PurchaseProduct.shipping_location_id)
+            .filter(PurchaseProduct.created_at.is_not(None), PurchaseProduct.purchase_rollup_id.is_not(None))
+            .order_by(Location.zip_code)
+        )
+        await self._rebuild_sketches(
+            CustomerStoreDaySketch, CustomerStoreDaySketch.customer_id,
+            select(PurchaseRollup.customer_id, PurchaseProduct.created_at, PurchaseProduct.purchase_rollup_id)
+            .join(PurchaseProduct, PurchaseProduct.purchase_rollup_id == PurchaseRollup.id)
+            .join(Location, Location.id == PurchaseProduct.shipping_location_id)
+            .filter(Location.location_type == LocationType.STORE, PurchaseProduct.created_at.is_not(None))
+            .order_by(PurchaseRollup.customer_id)
+        )
+        # Changes the analytics data version, so every worker's cached results are recomputed
+        self.db.add(AnalyticsRebuild())
+        await self.db.commit()
+
+
+async def rebuild_rollups():
+    async with async_engine.begin() as connection:
+        await connection.run_sync(create_schema)
+    async with AsyncSessionLocal() as db:
+        await AnalyticsRollupService(db).rebuild()
+    await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    # Backfill/repair: python -m src.services.analytics_rollup_service
+    asyncio.run(rebuild_rollups())
@@ -1,95 +1,383 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import func, extract
+import math
+from datetime import datetime, time, timezone
+from typing import AsyncIterator, NamedTuple, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import and_, func, or_, select
+from src.data.read_replicas import OWN_WRITES, read_target
+from src.data.tables.analytics_sketch import CustomerStoreDaySketch, ShippingZipDaySketch
 from src.data.tables.customer import Customer
+from src.data.tables.customer_store_order_count import CustomerStoreOrderCount
 from src.data.tables.location import Location, LocationType
 from src.data.tables.purchase_rollup import PurchaseRollup
 from src.data.tables.purchase_product import PurchaseProduct
+from src.data.tables.store_purchase_hour_count import StorePurchaseHourCount
+from src.data.tables.zip_order_count import BillingZipOrderCount, ShippingZipOrderCount
+from src.services.analytics_cache import data_version
+from src.services.hyperloglog import HyperLogLog
+from src.services.single_flight import SingleFlight
+from src.monitoring.service_calls import instrument_service
 
 
+def _read_scope(service) -> Optional[str]:
+    """
+    Calls on a replica and on the primary aren't coalesced together, and a client reading
+    its own writes isn't coalesced at all: a call already in flight may predate its write.
+    """
+    target = read_target(service.db)
+    return None if target == OWN_WRITES else target
+
+
+# Identical analytics calls in flight at the same time share one query
+analytics_single_flight = SingleFlight(scope=_read_scope)
+
+# Rows fetched per round trip when streaming results off a server side cursor
+STREAM_BATCH_SIZE = 1000
+
+
+class ApproximateZipOrderCount(NamedTuple):
+    zip_code: str
+    order_count: int
+    # order_count is within this of the exact count ~95% of the time (two standard errors)
+    error_bound: int
+
+
+class ApproximateStorePickupUser(NamedTuple):
+    id: int
+    first_name: str
+    last_name: str
+    email: str
+    store_order_count: int
+    error_bound: int
+
+
+def as_utc(value: datetime) -> datetime:
+    """created_at is stored in UTC, naive datetimes are taken to be UTC already."""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def whole_days(start: Optional[datetime] = None, end: Optional[datetime] = None) -> bool:
+    """Whether both bounds of [start, end) that are given fall on midnight UTC."""
+    return all(bound is None or as_utc(bound).time() == time.min for bound in (start, end))
+
+
+def in_window(query, column, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Restrict query to rows whose column falls in [start, end). Either bound may be left open."""
+    if start is not None:
+        query = query.filter(column >= as_utc(start))
+    if end is not None:
+        query = query.filter(column < as_utc(end))
+    return query
+
+
+def billing_zip_order_counts_query(start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Order count per billing zip code, over the full purchase history or orders placed in [start, end)."""
+    return in_window(
+        select(
+            Location.zip_code,
+            func.count(PurchaseRollup.id).label('order_count')
+        )
+        .join(Customer, Customer.billing_location_id == Location.id)
+        .join(PurchaseRollup, PurchaseRollup.customer_id == Customer.id)
+        .group_by(Location.zip_code),
+        PurchaseRollup.created_at, start, end
+    )
+
+
+def shipping_zip_order_counts_query(start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """
+    Distinct order count per shipping zip code, over the full purchase history or products
+    bought in [start, end). The order id is read off purchase_product itself, so a window
+    is answered from ix_purchase_product_created_at_shipping and location alone.
+    """
+    return in_window(
+        select(
+            Location.zip_code,
+            func.count(func.distinct(PurchaseProduct.purchase_rollup_id)).label('order_count')
+        )
+        .join(PurchaseProduct, PurchaseProduct.shipping_location_id == Location.id)
+        .group_by(Location.zip_code),
+        PurchaseProduct.created_at, start, end
+    )
+
+
+def store_purchase_hour_counts_query(start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Number of products bought for store pickup per purchase hour, over the full purchase history or [start, end)."""
+    return in_window(
+        select(
+            PurchaseProduct.purchase_hour.label('hour'),
+            func.count(PurchaseProduct.id).label('purchase_count')
+        )
+        .join(Location, Location.id == PurchaseProduct.shipping_location_id)
+        .filter(Location.location_type == LocationType.STORE)
+        .group_by(PurchaseProduct.purchase_hour),
+        PurchaseProduct.created_at, start, end
+    )
+
+
+def customer_store_order_counts_query(start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Number of store pickup orders per customer, over the full purchase history or products bought in [start, end)."""
+    return in_window(
+        select(
+            PurchaseRollup.customer_id,
+            func.count(func.distinct(PurchaseRollup.id)).label('store_order_count')
+        )
+        .join(PurchaseProduct, PurchaseProduct.purchase_rollup_id == PurchaseRollup.id)
+        .join(Location, Location.id == PurchaseProduct.shipping_location_id)
+        .filter(Location.location_type == LocationType.STORE)
+        .group_by(PurchaseRollup.customer_id),
+        PurchaseProduct.created_at, start, end
+    )
+
+
+@instrument_service
 class AnalyticsService:
+    """
+    Without a time window every query reads its rollup table. With `start` and/or `end`
+    (a half-open [start, end) range, naive datetimes are taken as UTC) it aggregates the
+    purchases in that window instead, range scanning the created_at indexes.
+    """
 
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
 
-    def get_order_count_by_billing_zip_code(self, ascending=False):
+    async def result_version(self) -> str:
+        """Version of the data the results are computed from, for the analytics cache."""
+        return await data_version.read(self.db)
+
+    @staticmethod
+    def _windowed(start: Optional[datetime], end: Optional[datetime]) -> bool:
+        return start is not None or end is not None
+
+    def _zip_order_counts_query(self, table, windowed_query, ascending: bool, start, end, limit, after):
+        """
+        Zip code order counts, from the rollup table or aggregated over [start, end), in
+        (order_count, zip_code) order. A page continues after the (order_count, zip_code)
+        keyset `after` rather than skipping an offset, so every page costs the same.
+        """
+        if self._windowed(start, end):
+            counts = windowed_query(start, end).subquery()
+            zip_code, order_count = counts.c.zip_code, counts.c.order_count
+            query = select(zip_code, order_count)
+        else:
+            zip_code, order_count = table.zip_code, table.order_count
+            query = select(zip_code, order_count).filter(order_count > 0)
+
+        if after is not None:
+            after_count, after_zip_code = after
+            next_count = order_count > after_count if ascending else order_count < after_count
+            query = query.filter(or_(next_count, and_(order_count == after_count, zip_code > after_zip_code)))
+        query = query.order_by(order_count.asc() if ascending else order_count.desc(), zip_code)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    async def _stream(self, query) -> AsyncIterator:
+        """Rows of query as the database cursor produces them, without buffering the result."""
+        result = await self.db.stream(query.execution_options(yield_per=STREAM_BATCH_SIZE))
+        async for row in result:
+            yield row
+
+    @analytics_single_flight.coalesce
+    async def get_order_count_by_billing_zip_code(self, ascending=False, start=None, end=None, limit=None, after=None):
         """
         Show a total count of orders aggregated by billing zip code, descending or
-        ascending.
+        ascending. Read from the billing_zip_order_count rollup, so the cost depends
+        on the number of zip codes rather than the number of orders.
         :param ascending:
+        :param start:
+        :param end:
+        :param limit:
+        :param after:
         :return:
         """
-        query = (
-            self.db.query(
-                Location.zip_code,
-                func.count(PurchaseRollup.id).label('order_count')
-            )
-            .join(Customer, Customer.billing_location_id == Location.id)
-            .join(PurchaseRollup, PurchaseRollup.customer_id == Customer.id)
-            .group_by(Location.zip_code)
-            .order_by(func.count(PurchaseRollup.id).asc() if ascending else func.count(PurchaseRollup.id).desc())
+        query = self._zip_order_counts_query(
+            BillingZipOrderCount, billing_zip_order_counts_query, ascending, start, end, limit, after
         )
-        return query.all()
+        return (await self.db.execute(query)).all()
 
-    def get_order_count_by_shipping_zip_code(self, ascending=False):
+    def stream_order_count_by_billing_zip_code(self, ascending=False, start=None, end=None, limit=None, after=None):
+        """get_order_count_by_billing_zip_code, streamed."""
+        return self._stream(self._zip_order_counts_query(
+            BillingZipOrderCount, billing_zip_order_counts_query, ascending, start, end, limit, after
+        ))
+
+    @analytics_single_flight.coalesce
+    async def get_order_count_by_shipping_zip_code(self, ascending=False, start=None, end=None, limit=None, after=None):
         """
         Show a total count of orders aggregated by shipping zip code, descending or
-        ascending
+        ascending. Read from the shipping_zip_order_count rollup.
         :param ascending:
+        :param start:
+        :param end:
+        :param limit:
+        :param after:
         :return:
         """
-        query = (
-            self.db.query(
-                Location.zip_code,
-                func.count(func.distinct(PurchaseRollup.id)).label('order_count')
-            )
-            .join(PurchaseProduct, PurchaseProduct.shipping_location_id == Location.id)
-            .join(PurchaseRollup, PurchaseRollup.id == PurchaseProduct.purchase_rollup_id)
-            .group_by(Location.zip_code)
-            .order_by(func.count(func.distinct(PurchaseRollup.id)).asc() if ascending else func.count(func.distinct(PurchaseRollup.id)).desc())
+        query = self._zip_order_counts_query(
+            ShippingZipOrderCount, shipping_zip_order_counts_query, ascending, start, end, limit, after
         )
-        return query.all()
+        return (await self.db.execute(query)).all()
+
+    def stream_order_count_by_shipping_zip_code(self, ascending=False, start=None, end=None, limit=None, after=None):
+        """get_order_count_by_shipping_zip_code, streamed."""
+        return self._stream(self._zip_order_counts_query(
+            ShippingZipOrderCount, shipping_zip_order_counts_query, ascending, start, end, limit, after
+        ))
 
-    def get_most_purchase_time_of_day(self):
+    @analytics_single_flight.coalesce
+    async def get_most_purchase_time_of_day(self, start=None, end=None):
         """
         Can you tell me what times of day most in-store purchases are made? An in store order is one
         where a roll-up order contained a product that was shipped to a location that has
         location_type equal to `STORE`. Use the `created_at` field of the `purchase_product`
-        table rounded to the hour.
+        table rounded to the hour. Read from the store_purchase_hour_count histogram, at most 24 rows.
+        :param start:
+        :param end:
         :return:
         """
-        query = (
-            self.db.query(
-                extract('hour', PurchaseProduct.created_at).label('hour'),
-                func.count(PurchaseProduct.id).label('purchase_count')
+        if self._windowed(start, end):
+            counts = store_purchase_hour_counts_query(start, end).subquery()
+            query = select(counts).order_by(counts.c.purchase_count.desc(), counts.c.hour)
+        else:
+            query = (
+                select(StorePurchaseHourCount.hour, StorePurchaseHourCount.purchase_count)
+                .filter(StorePurchaseHourCount.purchase_count > 0)
+                .order_by(StorePurchaseHourCount.purchase_count.desc(), StorePurchaseHourCount.hour)
             )
-            .join(Location, Location.id == PurchaseProduct.shipping_location_id)
-            .filter(Location.location_type == LocationType.STORE)
-            .group_by(extract('hour', PurchaseProduct.created_at))
-            .order_by(func.count(PurchaseProduct.id).desc())
-        )
-        return query.all()
+        return (await self.db.execute(query)).all()
 
-    def get_users_with_most_store_pickups(self):
+    @analytics_single_flight.coalesce
+    async def get_users_with_most_store_pickups(self, limit=5, offset=0, start=None, end=None):
         """
         List top 5 users with the most number of in-store orders. An in store order is one
         where a roll-up order contained a product that was shipped to a location that has
-        location_type equal to `STORE`.
+        location_type equal to `STORE`. Read from the customer_store_order_count rollup,
+        a page of `limit` users starting at `offset` is a range scan of its leaderboard index.
+        :param limit:
+        :param offset:
+        :param start:
+        :param end:
         :return:
         """
+        if self._windowed(start, end):
+            counts = customer_store_order_counts_query(start, end).subquery()
+            customer_id, store_order_count = counts.c.customer_id, counts.c.store_order_count
+        else:
+            counts = CustomerStoreOrderCount
+            customer_id, store_order_count = counts.customer_id, counts.store_order_count
         query = (
-            self.db.query(
+            select(
                 Customer.id,
                 Customer.first_name,
                 Customer.last_name,
                 Customer.email,
-                func.count(func.distinct(PurchaseRollup.id)).label('store_order_count')
+                store_order_count
             )
-            .join(PurchaseRollup, PurchaseRollup.customer_id == Customer.id)
-            .join(PurchaseProduct, PurchaseProduct.purchase_rollup_id == PurchaseRollup.id)
-            .join(Location, Location.id == PurchaseProduct.shipping_location_id)
-            .filter(Location.location_type == LocationType.STORE)
-            .group_by(Customer.id, Customer.first_name, Customer.last_name, Customer.email)
-            .order_by(func.count(func.distinct(PurchaseRollup.id)).desc())
-            .limit(5)
+            .join(Customer, Customer.id == customer_id)
+            .filter(store_order_count > 0)
+            .order_by(store_order_count.desc(), customer_id)
+            .limit(limit)
+            .offset(offset)
         )
-        return query.all()
+        return (await self.db.execute(query)).all()
+
+    async def _merged_sketches(self, table, key_column, start, end) -> dict:
+        """
+        Merge the per day sketches of every key over the days in [start, end), in the database,
+        reading one row per key and non-zero register. Sketches are per UTC day, so the window
+        has to be whole days: widening it would count orders the error bound doesn't cover.
+        """
+        if not whole_days(start, end):
+            raise ValueError("An approximate window has to start and end at midnight UTC")
+        query = select(key_column, table.register, func.max(table.rank)).group_by(key_column, table.register)
+        if start is not None:
+            query = query.filter(table.day >= as_utc(start).date())
+        if end is not None:
+            query = query.filter(table.day < as_utc(end).date())
+
+        sketches = {}
+        async for key, register, rank in await self.db.stream(query.execution_options(yield_per=STREAM_BATCH_SIZE)):
+            if key not in sketches:
+                sketches[key] = HyperLogLog()
+            sketches[key].registers[register] = rank
+        return sketches
+
+    @staticmethod
+    def _error_bound(sketch: HyperLogLog, estimate: int) -> int:
+        return math.ceil(2 * sketch.relative_error * estimate)
+
+    @analytics_single_flight.coalesce
+    async def get_approximate_order_count_by_shipping_zip_code(self, ascending=False, start=None, end=None):
+        """
+        get_order_count_by_shipping_zip_code estimated from the per zip code and day
+        HyperLogLog sketches instead of count(distinct) over the purchases, for any window of whole UTC days.
+        Without a window the shipping_zip_order_count rollup is exact, and read instead.
+        :param ascending:
+        :param start:
+        :param end:
+        :return:
+        """
+        if not self._windowed(start, end):
+            query = self._zip_order_counts_query(
+                ShippingZipOrderCount, shipping_zip_order_counts_query, ascending, None, None, None, None
+            )
+            return [ApproximateZipOrderCount(zip_code, order_count, 0) for zip_code, order_count in await self.db.execute(query)]
+
+        sketches = await self._merged_sketches(ShippingZipDaySketch, ShippingZipDaySketch.zip_code, start, end)
+        results = []
+        for zip_code, sketch in sketches.items():
+            estimate = sketch.count()
+            if estimate > 0:
+                results.append(ApproximateZipOrderCount(zip_code, estimate, self._error_bound(sketch, estimate)))
+        if ascending:
+            return sorted(results, key=lambda result: (result.order_count, result.zip_code))
+        return sorted(results, key=lambda result: (-result.order_count, result.zip_code))
+
+    @analytics_single_flight.coalesce
+    async def get_approximate_users_with_most_store_pickups(self, limit=5, offset=0, start=None, end=None):
+        """
+        get_users_with_most_store_pickups ranked by the per customer and day HyperLogLog
+        sketches instead of count(distinct) over the purchases, for any window of whole UTC days.
+        Without a window the customer_store_order_count rollup is exact, and read instead.
+        :param limit:
+        :param offset:
+        :param start:
+        :param end:
+        :return:
+        """
+        if not self._windowed(start, end):
+            return [
+                ApproximateStorePickupUser(*user, 0)
+                for user in await self.get_users_with_most_store_pickups(limit, offset)
+            ]
+
+        sketches = await self._merged_sketches(CustomerStoreDaySketch, CustomerStoreDaySketch.customer_id, start, end)
+        estimates = sorted(
+            ((customer_id, sketch.count(), sketch) for customer_id, sketch in sketches.items()),
+            key=lambda estimate: (-estimate[1], estimate[0])
+        )
+        page = [estimate for estimate in estimates if estimate[1] > 0][offset:offset + limit]
+        if not page:
+            return []
+
+        customers = {
+            customer.id: customer
+            for customer in await self.db.execute(
+                select(Customer.id, Customer.first_name, Customer.last_name, Customer.email)
+                .filter(Customer.id.in_([customer_id for customer_id, _, _ in page]))
+            )
+        }
+        return [
+            ApproximateStorePickupUser(
+                customer_id,
+                customers[customer_id].first_name,
+                customers[customer_id].last_name,
+                customers[customer_id].email,
+                estimate,
+                self._error_bound(sketch, estimate)
+            )
+            for customer_id, estimate, sketch in page
+            if customer_id in customers
+        ]
@@ -0,0 +1,359 @@
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import AsyncIterator, Awaitable, Callable, NamedTuple, Optional
+import numpy as np
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from src.data.tables.customer import Customer
+from src.data.tables.location import Location, LocationType
+from src.data.tables.purchase_product import PurchaseProduct
+from src.data.tables.purchase_rollup import PurchaseRollup
+from src.services.analytics_cache import data_version
+from src.services.analytics_service import STREAM_BATCH_SIZE, as_utc
+from src.services.single_flight import SingleFlight
+from src.monitoring.service_calls import instrument_service
+
+
+# The snapshot refreshes on the next read once the data version changes, and at least
+# this often, which picks up rows that committed behind a higher id
+ANALYTICS_SNAPSHOT_REFRESH_SECONDS = float(os.getenv("ANALYTICS_SNAPSHOT_REFRESH_SECONDS", "5"))
+# Rows committed up to this long after rows with higher ids still make it into the snapshot
+ANALYTICS_SNAPSHOT_LAG_SECONDS = float(os.getenv("ANALYTICS_SNAPSHOT_LAG_SECONDS", "30"))
+
+
+class ZipOrderCount(NamedTuple):
+    zip_code: str
+    order_count: int
+
+
+class HourPurchaseCount(NamedTuple):
+    hour: int
+    purchase_count: int
+
+
+class StorePickupUser(NamedTuple):
+    id: int
+    first_name: str
+    last_name: str
+    email: str
+    store_order_count: int
+
+
+class IdWatermark:
+    """
+    Which rows of a table a snapshot has, by id. Ids are handed out before commit, so a row
+    can become visible after rows with higher ids: rather than read past the highest id
+    seen, a refresh reads past the highest id seen lag_seconds ago (a row that commits
+    within lag_seconds of getting its id was visible by then) and skips the ids it has.
+    """
+
+    def __init__(self, lag_seconds: float):
+        self.lag_seconds = lag_seconds
+        # ids up to this are all in the snapshot, those past it are in recent_ids
+        self.settled_id = 0
+        self.recent_ids: set[int] = set()
+        self._checkpoints: deque[tuple[float, int]] = deque()
+
+    def scan_from(self, now: float) -> int:
+        """The id to read past, settling the ids seen at least lag_seconds ago."""
+        settled_id = self.settled_id
+        while self._checkpoints and now - self._checkpoints[0][0] >= self.lag_seconds:
+            settled_id = max(settled_id, self._checkpoints.popleft()[1])
+        if settled_id != self.settled_id:
+            self.settled_id = settled_id
+            self.recent_ids = {id_ for id_ in self.recent_ids if id_ > settled_id}
+        return settled_id
+
+    def add(self, now: float, ids: list[int]):
+        self.recent_ids.update(ids)
+        self._checkpoints.append((now, max(self.recent_ids, default=self.settled_id)))
+
+
+def _datetime64(value: Optional[datetime]):
+    """created_at as a naive UTC numpy datetime, NULL becomes NaT which no window matches."""
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+_SESSION_SNAPSHOT_REFRESHED = "purchase_fact_snapshot_refreshed"
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _forget_snapshot_refresh(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(_SESSION_SNAPSHOT_REFRESHED, None)
+
+
+class PurchaseFactSnapshot:
+    """
+    In memory, column oriented copy of the purchase facts the analytics aggregate, so
+    they can be answered with vectorized group-bys instead of GROUP BYs on the primary.
+    Two tables of NumPy arrays:
+      orders:   rollup id, customer id, billing zip, created_at (one row per purchase_rollup)
+      products: rollup id, customer id, shipping zip, is store, purchase hour, created_at
+                (one row per purchase_product)
+    Zip codes are dictionary encoded. Each refresh only reads the rows that may be new
+    (see IdWatermark), off a server side cursor a batch at a time, and replaces the
+    columns in one assignment so readers always see a consistent snapshot.
+    """
+
+    def __init__(self, refresh_seconds: float, lag_seconds: float):
+        self.refresh_seconds = refresh_seconds
+        self.lag_seconds = lag_seconds
+        self._single_flight = SingleFlight()
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.zip_codes: list[str] = []
+            self._zip_index: dict[str, int] = {}
+            self.orders = {
+                "rollup_id": np.empty(0, dtype=np.int64),
+                "customer_id": np.empty(0, dtype=np.int64),
+                "billing_zip": np.empty(0, dtype=np.int32),
+                "created_at": np.empty(0, dtype="datetime64[us]"),
+            }
+            self.products = {
+                "rollup_id": np.empty(0, dtype=np.int64),
+                "customer_id": np.empty(0, dtype=np.int64),
+                "shipping_zip": np.empty(0, dtype=np.int32),
+                "is_store": np.empty(0, dtype=bool),
+                "purchase_hour": np.empty(0, dtype=np.int8),
+                "created_at": np.empty(0, dtype="datetime64[us]"),
+            }
+            self._order_watermark = IdWatermark(self.lag_seconds)
+            self._product_watermark = IdWatermark(self.lag_seconds)
+            self._version = None
+            self._refreshed_at = float("-inf")
+
+    def _zip_code(self, zip_code: str) -> int:
+        code = self._zip_index.get(zip_code)
+        if code is None:
+            code = self._zip_index[zip_code] = len(self.zip_codes)
+            self.zip_codes.append(zip_code)
+        return code
+
+    @staticmethod
+    def _append(columns: dict, batches: list[dict]) -> dict:
+        return {
+            name: np.concatenate([column, *(np.array(batch[name], dtype=column.dtype) for batch in batches)])
+            for name, column in columns.items()
+        }
+
+    @property
+    def watermark(self) -> str:
+        """
+        Which rows the snapshot holds. Rows are only ever appended, so this changes with every
+        refresh that finds new ones, including rows that committed behind a higher id.
+        """
+        with self._lock:
+            return f"{len(self.orders['rollup_id'])}.{len(self.products['rollup_id'])}"
+
+    def is_stale(self, version: str) -> bool:
+        return self._version != version or time.monotonic() - self._refreshed_at >= self.refresh_seconds
+
+    async def refresh(self, db: AsyncSession):
+        """
+        Bring the snapshot up to date if it might be behind, once per transaction of db, so the
+        cache's result_version and the computation use the same snapshot. Concurrent refreshes share one.
+        """
+        if db.info.get(_SESSION_SNAPSHOT_REFRESHED) is self:
+            return
+        version = await data_version.read(db)
+        if self.is_stale(version):
+            await self._single_flight.do_async("refresh", lambda: self._refresh(db, version))
+        db.info[_SESSION_SNAPSHOT_REFRESHED] = self
+
+    async def _read_new(self, db: AsyncSession, query, id_column, watermark: IdWatermark,
+                        columns: Callable[[list], dict]) -> tuple[list[int], list[dict]]:
+        """Ids and column batches of query's rows past the watermark that aren't in the snapshot yet."""
+        ids, batches = [], []
+        result = await db.stream(
+            query.filter(id_column > watermark.scan_from(time.monotonic())).execution_options(yield_per=STREAM_BATCH_SIZE)
+        )
+        async for partition in result.partitions():
+            rows = [row for row in partition if row[0] not in watermark.recent_ids]
+            if rows:
+                ids.extend(row[0] for row in rows)
+                batches.append(columns(rows))
+        return ids, batches
+
+    def _order_columns(self, rows: list) -> dict:
+        return {
+            "rollup_id": [row.id for row in rows],
+            "customer_id": [row.customer_id for row in rows],
+            "billing_zip": [self._zip_code(row.zip_code) for row in rows],
+            "created_at": [_datetime64(row.created_at) for row in rows],
+        }
+
+    def _product_columns(self, rows: list) -> dict:
+        return {
+            "rollup_id": [row.purchase_rollup_id if row.purchase_rollup_id is not None else -1 for row in rows],
+            "customer_id": [row.customer_id if row.customer_id is not None else -1 for row in rows],
+            "shipping_zip": [self._zip_code(row.zip_code) for row in rows],
+            "is_store": [row.location_type == LocationType.STORE for row in rows],
+            "purchase_hour": [row.purchase_hour if row.purchase_hour is not None else -1 for row in rows],
+            "created_at": [_datetime64(row.created_at) for row in rows],
+        }
+
+    async def _refresh(self, db: AsyncSession, version: str):
+        refreshed_at = time.monotonic()
+
+        order_ids, orders = await self._read_new(
+            db,
+            select(PurchaseRollup.id, PurchaseRollup.customer_id, Location.zip_code, PurchaseRollup.created_at)
+            .join(Customer, Customer.id == PurchaseRollup.customer_id)
+            .join(Location, Location.id == Customer.billing_location_id),
+            PurchaseRollup.id, self._order_watermark, self._order_columns
+        )
+        product_ids, products = await self._read_new(
+            db,
+            select(
+                PurchaseProduct.id,
+                PurchaseProduct.purchase_rollup_id,
+                PurchaseRollup.customer_id,
+                Location.zip_code,
+                Location.location_type,
+                PurchaseProduct.purchase_hour,
+                PurchaseProduct.created_at
+            )
+            .join(Location, Location.id == PurchaseProduct.shipping_location_id)
+            .outerjoin(PurchaseRollup, PurchaseRollup.id == PurchaseProduct.purchase_rollup_id),
+            PurchaseProduct.id, self._product_watermark, self._product_columns
+        )
+
+        with self._lock:
+            if orders:
+                self.orders = self._append(self.orders, orders)
+            if products:
+                self.products = self._append(self.products, products)
+            self._order_watermark.add(refreshed_at, order_ids)
+            self._product_watermark.add(refreshed_at, product_ids)
+            self._version = version
+            self._refreshed_at = refreshed_at
+
+
+def _window_mask(created_at, start: Optional[datetime], end: Optional[datetime]):
+    mask = np.ones(len(created_at), dtype=bool)
+    if start is not None:
+        mask &= created_at >= np.datetime64(_datetime64(as_utc(start)), "us")
+    if end is not None:
+        mask &= created_at < np.datetime64(_datetime64(as_utc(end)), "us")
+    return mask
+
+
+@instrument_service
+class ColumnarAnalyticsService:
+    """
+    AnalyticsService answered from the purchase fact snapshot rather than SQL, selected with
+    ANALYTICS_BACKEND=columnar. Same methods, arguments, ordering and results as AnalyticsService;
+    the database is only read to refresh the snapshot and for the names on the leaderboard page.
+    """
+
+    def __init__(self, db: AsyncSession, snapshot: Optional[PurchaseFactSnapshot] = None):
+        self.db = db
+        self.snapshot = snapshot or purchase_fact_snapshot
+
+    async def result_version(self) -> str:
+        """
+        The snapshot's watermark, for the analytics cache. The data version can be ahead of
+        a snapshot still missing late commits, and a result is only as new as the snapshot.
+        """
+        await self.snapshot.refresh(self.db)
+        return f"snapshot.{self.snapshot.watermark}"
+
+    def _zip_order_counts(self, counts, ascending: bool, limit, after) -> list[ZipOrderCount]:
+        results = [
+            ZipOrderCount(self.snapshot.zip_codes[code], int(counts[code]))
+            for code in np.flatnonzero(counts)
+        ]
+        if ascending:
+            results.sort(key=lambda result: (result.order_count, result.zip_code))
+        else:
+            results.sort(key=lambda result: (-result.order_count, result.zip_code))
+        if after is not None:
+            after_count, after_zip_code = after
+            results = [
+                result for result in results
+                if (result.order_count > after_count if ascending else result.order_count < after_count)
+                or (result.order_count == after_count and result.zip_code > after_zip_code)
+            ]
+        return results[:limit] if limit is not None else results
+
+    async def _stream(self, results: Awaitable[list]) -> AsyncIterator:
+        for row in await results:
+            yield row
+
+    async def get_order_count_by_billing_zip_code(self, ascending=False, start=None, end=None, limit=None, after=None):
+        await self.snapshot.refresh(self.db)
+        orders = self.snapshot.orders
+        billing_zip = orders["billing_zip"][_window_mask(orders["created_at"], start, end)]
+        counts = np.bincount(billing_zip, minlength=len(self.snapshot.zip_codes))
+        return self._zip_order_counts(counts, ascending, limit, after)
+
+    def stream_order_count_by_billing_zip_code(self, ascending=False, start=None, end=None, limit=None, after=None):
+        return self._stream(self.get_order_count_by_billing_zip_code(ascending, start, end, limit, after))
+
+    async def get_order_count_by_shipping_zip_code(self, ascending=False, start=None, end=None, limit=None, after=None):
+        await self.snapshot.refresh(self.db)
+        products = self.snapshot.products
+        mask = _window_mask(products["created_at"], start, end)
+        # Distinct (zip, order) pairs, then orders per zip
+        pairs = np.unique(np.stack([products["shipping_zip"][mask], products["rollup_id"][mask]]), axis=1)
+        counts = np.bincount(pairs[0].astype(np.int64), minlength=len(self.snapshot.zip_codes))
+        return self._zip_order_counts(counts, ascending, limit, after)
+
+    def stream_order_count_by_shipping_zip_code(self, ascending=False, start=None, end=None, limit=None, after=None):
+        return self._stream(self.get_order_count_by_shipping_zip_code(ascending, start, end, limit, after))
+
+    async def get_most_purchase_time_of_day(self, start=None, end=None):
+        await self.snapshot.refresh(self.db)
+        products = self.snapshot.products
+        mask = _window_mask(products["created_at"], start, end) & products["is_store"] & (products["purchase_hour"] >= 0)
+        counts = np.bincount(products["purchase_hour"][mask].astype(np.int64), minlength=24)
+        hours = np.flatnonzero(counts)
+        return [
+            HourPurchaseCount(int(hour), int(counts[hour]))
+            for hour in hours[np.lexsort((hours, -counts[hours]))]
+        ]
+
+    async def get_users_with_most_store_pickups(self, limit=5, offset=0, start=None, end=None):
+        await self.snapshot.refresh(self.db)
+        products = self.snapshot.products
+        mask = _window_mask(products["created_at"], start, end) & products["is_store"] & (products["customer_id"] >= 0)
+        pairs = np.unique(np.stack([products["customer_id"][mask], products["rollup_id"][mask]]), axis=1)
+        customer_ids, counts = np.unique(pairs[0], return_counts=True)
+        page = np.lexsort((customer_ids, -counts))[offset:offset + limit]
+        if not len(page):
+            return []
+
+        page_counts = {int(customer_ids[index]): int(counts[index]) for index in page}
+        customers = {
+            customer.id: customer
+            for customer in await self.db.execute(
+                select(Customer.id, Customer.first_name, Customer.last_name, Customer.email)
+                .filter(Customer.id.in_(page_counts))
+            )
+        }
+        return [
+            StorePickupUser(
+                customer_id,
+                customers[customer_id].first_name,
+                customers[customer_id].last_name,
+                customers[customer_id].email,
+                store_order_count
+            )
+            for customer_id, store_order_count in page_counts.items()
+            if customer_id in customers
+        ]
+
+
+purchase_fact_snapshot = PurchaseFactSnapshot(ANALYTICS_SNAPSHOT_REFRESH_SECONDS, ANALYTICS_SNAPSHOT_LAG_SECONDS)
@@ -1,27 +1,24 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from src.data.tables.customer import Customer
-from src.data.tables.location import Location, LocationType
+from src.data.tables.location import LocationType
 from src.rest_api.schemas import CustomerCreate
-from typing import Optional
+from src.services.location_service import LocationService
+from src.monitoring.service_calls import instrument_service
+from typing import Iterable, Optional
 
 
+@instrument_service
 class CustomerService:
 
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
 
-    def new_customer(self, request: CustomerCreate) -> Customer:
-        # Create billing address first
-        billing_location = Location(
-            location_type=LocationType.BILLING,
-            address_line_1=request.billing_address.address_line_1,
-            address_line_2=request.billing_address.address_line_2 or "",
-            city=request.billing_address.city,
-            state=request.billing_address.state,
-            zip_code=request.billing_address.zip_code
-        )
-        self.db.add(billing_location)
-        self.db.flush()
+    async def new_customer(self, request: CustomerCreate) -> Customer:
+        # Resolve billing address first, reusing the row if the address is already known
+        billing_location_id = (await LocationService(self.db).resolve_location_ids(
+            [request.billing_address], LocationType.BILLING
+        ))[0]
         
         # Create customer with billing location ID
         customer = Customer(
@@ -29,16 +26,32 @@ class CustomerService:
             phone_number=request.phone_number,
             first_name=request.first_name,
             last_name=request.last_name,
-            billing_location_id=billing_location.id
+            billing_location_id=billing_location_id
         )
         self.db.add(customer)
-        self.db.commit()
-        self.db.refresh(customer)
+        await self.db.commit()
+        await self.db.refresh(customer)
         
         return customer
 
-    def query_customer_by_phone(self, phone_number: str) -> Optional[Customer]:
-        return self.db.query(Customer).filter(Customer.phone_number == phone_number).first()
+    async def query_customer_by_phone(self, phone_number: str) -> Optional[Customer]:
+        return await self.db.scalar(select(Customer).filter(Customer.phone_number == phone_number))
     
-    def query_customer_by_email(self, email: str) -> Optional[Customer]:
-        return self.db.query(Customer).filter(Customer.email == email).first()
+    async def query_customer_by_email(self, email: str) -> Optional[Customer]:
+        return await self.db.scalar(select(Customer).filter(Customer.email == email))
+
+    async def query_customers_by_phones(self, phone_numbers: Iterable[str]) -> dict[str, Customer]:
+        """Look up customers by phone number in a single IN query, keyed by phone number."""
+        phone_numbers = set(phone_numbers)
+        if not phone_numbers:
+            return {}
+        customers = await self.db.scalars(select(Customer).filter(Customer.phone_number.in_(phone_numbers)))
+        return {customer.phone_number: customer for customer in customers}
+
+    async def query_customers_by_emails(self, emails: Iterable[str]) -> dict[str, Customer]:
+        """Look up customers by email in a single IN query, keyed by email."""
+        emails = set(emails)
+        if not emails:
+            return {}
+        customers = await self.db.scalars(select(Customer).filter(Customer.email.in_(emails)))
+        return {customer.email: customer for customer in customers}
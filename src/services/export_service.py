@@ -0,0 +1,265 @@
+import argparse
+import io
+import os
+import re
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+from pathlib import Path
+from typing import AsyncIterator, Iterator, NamedTuple, Optional
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import DateTime, Integer, Select, SmallInteger, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, aliased
+from src.data.database import SessionLocal
+from src.data.tables.customer import Customer
+from src.data.tables.location import Location
+from src.data.tables.product import Product
+from src.data.tables.purchase_product import PurchaseProduct
+from src.data.tables.purchase_rollup import PurchaseRollup
+from src.services.analytics_service import as_utc
+
+
+# Rows fetched from the server side cursor and converted per Arrow record batch (and so
+# per Parquet row group). Memory use is bounded by this, not by the size of the table.
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "50000"))
+EXPORT_ROWS_PER_FILE = int(os.getenv("EXPORT_ROWS_PER_FILE", "5000000"))
+# Ids are handed out when a row is inserted, not when it commits, so a row can become
+# visible after rows with higher ids. Incremental exports stop before the first row
+# created in the last EXPORT_LAG_SECONDS, so the next one continuing after the last
+# exported id doesn't skip rows whose transaction was still open.
+EXPORT_LAG_SECONDS = float(os.getenv("EXPORT_LAG_SECONDS", "30"))
+
+EXPORT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+
+class ExportSource(NamedTuple):
+    query: Select
+    # Exports are ordered by id, incremental exports continue after an id or from a created_at
+    id_column: object
+    created_at_column: object
+
+
+def purchase_fact_query() -> Select:
+    """One row per purchase_product, denormalized with its order, customer, product and both zip codes."""
+    billing_location = aliased(Location)
+    shipping_location = aliased(Location)
+    return (
+        select(
+            PurchaseProduct.id,
+            PurchaseProduct.purchase_rollup_id,
+            PurchaseRollup.customer_id,
+            PurchaseProduct.product_id,
+            Product.price,
+            billing_location.zip_code.label("billing_zip_code"),
+            shipping_location.zip_code.label("shipping_zip_code"),
+            shipping_location.location_type.label("shipping_location_type"),
+            PurchaseProduct.purchase_hour,
+            PurchaseProduct.purchase_day_of_week,
+            PurchaseProduct.created_at
+        )
+        .outerjoin(PurchaseRollup, PurchaseRollup.id == PurchaseProduct.purchase_rollup_id)
+        .outerjoin(Customer, Customer.id == PurchaseRollup.customer_id)
+        .outerjoin(billing_location, billing_location.id == Customer.billing_location_id)
+        .outerjoin(shipping_location, shipping_location.id == PurchaseProduct.shipping_location_id)
+        .outerjoin(Product, Product.id == PurchaseProduct.product_id)
+    )
+
+
+def export_sources() -> dict[str, ExportSource]:
+    sources = {
+        model.__tablename__: ExportSource(select(model.__table__), model.id, model.created_at)
+        for model in (PurchaseRollup, PurchaseProduct, Customer, Location, Product)
+    }
+    sources["purchase_fact"] = ExportSource(purchase_fact_query(), PurchaseProduct.id, PurchaseProduct.created_at)
+    return sources
+
+
+def export_query(source: ExportSource, since_id: Optional[int] = None, since: Optional[datetime] = None,
+                 lag_seconds: Optional[float] = None) -> Select:
+    """
+    Rows of source ordered by id, after since_id and/or created at or after since. With
+    lag_seconds, only up to (not including) the first row created in the last lag_seconds.
+    """
+    query = source.query
+    if since_id is not None:
+        query = query.filter(source.id_column > since_id)
+    if since is not None:
+        query = query.filter(source.created_at_column >= as_utc(since))
+    if lag_seconds is not None:
+        settled_before = datetime.now(timezone.utc) - timedelta(seconds=lag_seconds)
+        first_unsettled = select(func.min(source.id_column)).where(source.created_at_column >= settled_before)
+        if since_id is not None:
+            first_unsettled = first_unsettled.where(source.id_column > since_id)
+        # Not correlated, it reads the same table as the query it filters
+        first_unsettled = first_unsettled.correlate(None).scalar_subquery()
+        query = query.filter(or_(first_unsettled.is_(None), source.id_column < first_unsettled))
+    return query.order_by(source.id_column)
+
+
+def arrow_schema(query: Select) -> pa.Schema:
+    fields = []
+    for column in query.selected_columns:
+        if isinstance(column.type, SmallInteger):
+            arrow_type = pa.int16()
+        elif isinstance(column.type, Integer):
+            arrow_type = pa.int64()
+        elif isinstance(column.type, DateTime):
+            arrow_type = pa.timestamp("us", tz="UTC")
+        else:
+            # String, and Enum columns exported as their value
+            arrow_type = pa.string()
+        fields.append(pa.field(column.name, arrow_type))
+    return pa.schema(fields)
+
+
+def record_batch(rows, schema: pa.Schema) -> pa.RecordBatch:
+    """Convert a partition of result rows to an Arrow record batch, column by column."""
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+    arrays = []
+    for values, field in zip(columns, schema):
+        if pa.types.is_string(field.type):
+            values = [value.value if isinstance(value, Enum) else value for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def iter_record_batches(db: Session, query: Select, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[pa.RecordBatch]:
+    """Read query through a server side cursor (yield_per) one record batch at a time."""
+    schema = arrow_schema(query)
+    result = db.execute(query.execution_options(yield_per=batch_size))
+    for rows in result.partitions():
+        yield record_batch(rows, schema)
+
+
+async def aiter_record_batches(db: AsyncSession, query: Select, batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[pa.RecordBatch]:
+    """iter_record_batches on an AsyncSession."""
+    schema = arrow_schema(query)
+    result = await db.stream(query.execution_options(yield_per=batch_size))
+    async for rows in result.partitions():
+        yield record_batch(rows, schema)
+
+
+def open_writer(sink, schema: pa.Schema, export_format: str):
+    """Parquet file writer, or an Arrow IPC file (or stream, for sinks that can't seek) writer."""
+    if export_format == "parquet":
+        return pq.ParquetWriter(sink, schema)
+    if isinstance(sink, (str, Path)):
+        return pa.ipc.new_file(str(sink), schema)
+    return pa.ipc.new_stream(sink, schema)
+
+
+class ChunkSink(io.RawIOBase):
+    """Write-only file object that collects what a writer wrote since the last drain()."""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+_PART_FILE = re.compile(r"^part-(\d+)-(\d+)\.\w+$")
+
+
+def last_exported_id(out_dir: Path, name: str) -> Optional[int]:
+    """Highest id already exported to out_dir/name, read from the part file names."""
+    ids = [
+        int(match.group(2))
+        for path in (Path(out_dir) / name).glob("part-*")
+        if (match := _PART_FILE.match(path.name))
+    ]
+    return max(ids, default=None)
+
+
+def export_table(db: Session, name: str, out_dir: Path, export_format: str = "parquet",
+                 since_id: Optional[int] = None, since: Optional[datetime] = None,
+                 batch_size: int = EXPORT_BATCH_SIZE, rows_per_file: int = EXPORT_ROWS_PER_FILE,
+                 lag_seconds: Optional[float] = None) -> list[Path]:
+    """
+    Export one table (or the purchase_fact view) to out_dir/name, split into files of at most
+    rows_per_file rows named part-<first id>-<last id>. Files are written under a temporary
+    name and renamed once complete, so a part file name is always a finished export.
+    """
+    source = export_sources()[name]
+    query = export_query(source, since_id, since, lag_seconds)
+    schema = arrow_schema(query)
+    id_index = schema.get_field_index(source.id_column.name)
+    table_dir = Path(out_dir) / name
+    table_dir.mkdir(parents=True, exist_ok=True)
+
+    written = []
+    writer, temp_path, first_id, last_id, file_rows = None, None, None, None, 0
+
+    def close_file():
+        writer.close()
+        path = table_dir / f"part-{first_id:012d}-{last_id:012d}{EXPORT_FORMATS[export_format]}"
+        temp_path.rename(path)
+        written.append(path)
+
+    for batch in iter_record_batches(db, query, batch_size):
+        offset = 0
+        while offset < batch.num_rows:
+            if writer is None:
+                temp_path = table_dir / f".in-progress{EXPORT_FORMATS[export_format]}"
+                writer = open_writer(temp_path, schema, export_format)
+                first_id, file_rows = None, 0
+            part = batch.slice(offset, rows_per_file - file_rows)
+            writer.write_batch(part)
+            ids = part.column(id_index)
+            first_id = first_id if first_id is not None else ids[0].as_py()
+            last_id = ids[-1].as_py()
+            file_rows += part.num_rows
+            offset += part.num_rows
+            if file_rows >= rows_per_file:
+                close_file()
+                writer = None
+    if writer is not None:
+        close_file()
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export purchase tables to Parquet or Arrow IPC files")
+    parser.add_argument("out_dir", type=Path)
+    parser.add_argument("--tables", nargs="+", default=list(export_sources()), choices=list(export_sources()))
+    parser.add_argument("--format", dest="export_format", default="parquet", choices=list(EXPORT_FORMATS))
+    since = parser.add_mutually_exclusive_group()
+    since.add_argument("--since-id", type=int, help="Only export rows with a greater id")
+    since.add_argument("--since", type=datetime.fromisoformat, help="Only export rows created at or after this time")
+    since.add_argument("--incremental", action="store_true", help="Continue after the last id already in out_dir")
+    parser.add_argument("--lag-seconds", type=float, default=EXPORT_LAG_SECONDS,
+                        help="With --incremental, leave rows created this recently for the next export")
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE)
+    parser.add_argument("--rows-per-file", type=int, default=EXPORT_ROWS_PER_FILE)
+    args = parser.parse_args(argv)
+
+    with SessionLocal() as db:
+        for name in args.tables:
+            since_id = last_exported_id(args.out_dir, name) if args.incremental else args.since_id
+            lag_seconds = args.lag_seconds if args.incremental else None
+            paths = export_table(
+                db, name, args.out_dir, args.export_format, since_id, args.since, args.batch_size, args.rows_per_file,
+                lag_seconds
+            )
+            print(f"{name}: {len(paths)} file(s) written")
+
+
+if __name__ == "__main__":
+    # python -m src.services.export_service exports/ --incremental
+    main()
@@ -1,23 +1,93 @@
+import os
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from src.data.tables.location import Location, LocationType
+from src.data.database import upsert
+from src.data.tables.location import Location, LocationType, location_fingerprint
 from src.rest_api.schemas import LocationCreate
+from src.utils.cache import CACHE_MISS, LRUCache
+from src.monitoring.service_calls import instrument_service
 
 
+LOCATION_CACHE_MAX_SIZE = int(os.getenv("LOCATION_CACHE_MAX_SIZE", "50000"))
+LOCATION_CACHE_TTL_SECONDS = float(os.getenv("LOCATION_CACHE_TTL_SECONDS", "3600"))
+
+# fingerprint -> location id of recently used addresses. Locations are never deleted,
+# so an entry only goes stale if the transaction that created it rolled back, which is
+# why ids are only cached once the session commits.
+location_cache = LRUCache(LOCATION_CACHE_MAX_SIZE, LOCATION_CACHE_TTL_SECONDS)
+
+_PENDING_LOCATIONS = "pending_location_ids"
+
+
+@event.listens_for(Session, "after_commit")
+def _cache_committed_locations(session):
+    for fingerprint, location_id in session.info.pop(_PENDING_LOCATIONS, {}).items():
+        location_cache.set(fingerprint, location_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_rolled_back_locations(session):
+    session.info.pop(_PENDING_LOCATIONS, None)
+
+
+@instrument_service
 class LocationService:
 
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
 
-    def create_location(self, request: LocationCreate) -> Location:
-        location = Location(
-            location_type=request.location_type,
-            address_line_1=request.address_line_1,
-            address_line_2=request.address_line_2 or "",
-            city=request.city,
-            state=request.state,
-            zip_code=request.zip_code
-        )
-        self.db.add(location)
-        self.db.commit()
-        self.db.refresh(location)
-        return location
+    async def resolve_location_ids(self, locations: list[LocationCreate], location_type: LocationType) -> list[int]:
+        """
+        Return a location id for each address, in input order, reusing the existing row for
+        addresses that were seen before. Hot addresses come from the location cache, the rest
+        are inserted in a single INSERT ... ON CONFLICT DO NOTHING ... RETURNING, and the ids
+        of those that already existed selected in one query.
+        """
+        fingerprints = [
+            location_fingerprint(
+                location_type, location.address_line_1, location.address_line_2 or "",
+                location.city, location.state, location.zip_code
+            )
+            for location in locations
+        ]
+
+        ids_by_fingerprint = {}
+        rows = {}
+        for fingerprint, location in zip(fingerprints, locations):
+            if fingerprint in ids_by_fingerprint or fingerprint in rows:
+                continue
+            location_id = location_cache.get(fingerprint)
+            if location_id is not CACHE_MISS:
+                ids_by_fingerprint[fingerprint] = location_id
+                continue
+            rows[fingerprint] = {
+                "location_type": location_type,
+                "address_line_1": location.address_line_1,
+                "address_line_2": location.address_line_2 or "",
+                "city": location.city,
+                "state": location.state,
+                "zip_code": location.zip_code,
+                "fingerprint": fingerprint
+            }
+
+        if rows:
+            # Existing addresses are left alone rather than rewritten (and locked) to make
+            # RETURNING include them, their ids are selected afterwards instead
+            statement = upsert(self.db, Location).on_conflict_do_nothing(
+                index_elements=[Location.fingerprint]
+            ).returning(Location.id, Location.fingerprint)
+            resolved = {row.fingerprint: row.id for row in await self.db.execute(statement, list(rows.values()))}
+            existing = [fingerprint for fingerprint in rows if fingerprint not in resolved]
+            if existing:
+                query = select(Location.id, Location.fingerprint).where(Location.fingerprint.in_(existing))
+                resolved.update({row.fingerprint: row.id for row in await self.db.execute(query)})
+            ids_by_fingerprint.update(resolved)
+            self.db.info.setdefault(_PENDING_LOCATIONS, {}).update(resolved)
+
+        return [ids_by_fingerprint[fingerprint] for fingerprint in fingerprints]
+
+    async def create_location(self, request: LocationCreate) -> Location:
+        location_id = (await self.resolve_location_ids([request], LocationType(request.location_type.value)))[0]
+        await self.db.commit()
+        return await self.db.get(Location, location_id)
@@ -0,0 +1,59 @@
+import os
+from typing import Any, Iterable, Optional
+from src.rest_api.schemas import ProductResponse
+from src.utils.cache import LRUCache
+
+
+PRODUCT_CACHE_MAX_SIZE = int(os.getenv("PRODUCT_CACHE_MAX_SIZE", "10000"))
+PRODUCT_CACHE_TTL_SECONDS = float(os.getenv("PRODUCT_CACHE_TTL_SECONDS", "300"))
+# Unknown ids/names are remembered for less time, a product created by another
+# worker only becomes visible here once its negative entry expires
+PRODUCT_CACHE_NEGATIVE_TTL_SECONDS = float(os.getenv("PRODUCT_CACHE_NEGATIVE_TTL_SECONDS", "30"))
+
+
+class ProductCache:
+    """
+    Read through cache of the product catalog, keyed by id and by name. Entries are
+    ProductResponse snapshots rather than ORM objects so they can outlive the session
+    that loaded them. A cached None means the product is known not to exist.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float, negative_ttl_seconds: float):
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.by_id = LRUCache(max_size, ttl_seconds)
+        self.by_name = LRUCache(max_size, ttl_seconds)
+
+    def get_by_id(self, product_id: int) -> Any:
+        """Return the cached product, None if known missing, or CACHE_MISS."""
+        return self.by_id.get(product_id)
+
+    def get_by_name(self, name: str) -> Any:
+        """Return the cached product, None if known missing, or CACHE_MISS."""
+        return self.by_name.get(name)
+
+    def put(self, product: ProductResponse):
+        self.by_id.set(product.id, product)
+        self.by_name.set(product.name, product)
+
+    def put_missing_ids(self, product_ids: Iterable[int]):
+        for product_id in product_ids:
+            self.by_id.set(product_id, None, self.negative_ttl_seconds)
+
+    def put_missing_name(self, name: str):
+        self.by_name.set(name, None, self.negative_ttl_seconds)
+
+    def invalidate(self, product_id: Optional[int] = None, name: Optional[str] = None):
+        if product_id is not None:
+            self.by_id.delete(product_id)
+        if name is not None:
+            self.by_name.delete(name)
+
+    def clear(self):
+        self.by_id.clear()
+        self.by_name.clear()
+
+    def stats(self) -> dict[str, Any]:
+        return {"by_id": self.by_id.stats(), "by_name": self.by_name.stats()}
+
+
+product_cache = ProductCache(PRODUCT_CACHE_MAX_SIZE, PRODUCT_CACHE_TTL_SECONDS, PRODUCT_CACHE_NEGATIVE_TTL_SECONDS)
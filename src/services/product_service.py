@@ -1,27 +1,64 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from src.data.tables.product import Product
-from src.rest_api.schemas import ProductCreate
-from typing import Optional
+from src.rest_api.schemas import ProductCreate, ProductResponse
+from src.utils.cache import CACHE_MISS
+from src.services.product_cache import product_cache
+from src.monitoring.service_calls import instrument_service
+from typing import Iterable, Optional
 
 
+@instrument_service
 class ProductService:
 
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
 
-    def create_product(self, request: ProductCreate) -> Product:
+    async def create_product(self, request: ProductCreate) -> Product:
         product = Product(
             name=request.name,
             description=request.description,
             price=request.price
         )
         self.db.add(product)
-        self.db.commit()
-        self.db.refresh(product)
+        await self.db.commit()
+        await self.db.refresh(product)
+
+        # Write through, this also replaces any negative entries for the id or name
+        product_cache.put(ProductResponse.model_validate(product))
         return product
 
-    def get_product_by_id(self, product_id: int) -> Optional[Product]:
-        return self.db.query(Product).filter(Product.id == product_id).first()
-    
-    def get_product_by_name(self, name: str) -> Optional[Product]:
-        return self.db.query(Product).filter(Product.name == name).first()
\ No newline at end of file
+    async def get_product_by_id(self, product_id: int) -> Optional[ProductResponse]:
+        return (await self.get_products_by_ids([product_id])).get(product_id)
+
+    async def get_products_by_ids(self, product_ids: Iterable[int]) -> dict[int, ProductResponse]:
+        """Look up products by id, going to the database in one IN query for cache misses only."""
+        products = {}
+        missing_ids = set()
+        for product_id in set(product_ids):
+            cached = product_cache.get_by_id(product_id)
+            if cached is CACHE_MISS:
+                missing_ids.add(product_id)
+            elif cached is not None:
+                products[product_id] = cached
+
+        if missing_ids:
+            for product in await self.db.scalars(select(Product).filter(Product.id.in_(missing_ids))):
+                products[product.id] = ProductResponse.model_validate(product)
+                product_cache.put(products[product.id])
+            product_cache.put_missing_ids(missing_ids - products.keys())
+
+        return products
+
+    async def get_product_by_name(self, name: str) -> Optional[ProductResponse]:
+        cached = product_cache.get_by_name(name)
+        if cached is not CACHE_MISS:
+            return cached
+
+        product = await self.db.scalar(select(Product).filter(Product.name == name))
+        if not product:
+            product_cache.put_missing_name(name)
+            return None
+        product_response = ProductResponse.model_validate(product)
+        product_cache.put(product_response)
+        return product_response
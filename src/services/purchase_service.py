@@ -1,109 +1,339 @@
-from sqlalchemy.orm import Session
+from datetime import datetime, timezone
+from sqlalchemy import and_, insert, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 from src.data.tables.purchase_rollup import PurchaseRollup
-from src.data.tables.purchase_product import PurchaseProduct
+from src.data.tables.purchase_product import PurchaseProduct, purchase_time_buckets
 from src.data.tables.location import Location, LocationType
-from src.data.tables.product import Product
 from src.data.tables.customer import Customer
-from src.rest_api.schemas import PurchaseCreate
-from typing import Optional
+from src.rest_api.schemas import ProductResponse, PurchaseCreate
+from src.services.analytics_rollup_service import AnalyticsRollupService, PurchaseFacts
+from src.services.location_service import LocationService
+from src.services.product_service import ProductService
+from src.monitoring.service_calls import instrument_service
+from typing import Iterable, Optional, Union
 
 
+@instrument_service
 class PurchaseService:
 
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
 
-    def _validate_customer(self, customer_id: int) -> Customer:
+    async def _validate_customer(self, customer_id: int) -> Customer:
         """Validate that customer exists and return customer object."""
-        customer = self.db.query(Customer).filter(Customer.id == customer_id).first()
+        customer = await self.db.scalar(select(Customer).filter(Customer.id == customer_id))
         if not customer:
             raise ValueError(f"Customer with id {customer_id} not found")
         return customer
 
-    def _validate_product(self, product_id: int) -> Product:
+    async def _get_customers(self, customer_ids: Iterable[int]) -> dict[int, Customer]:
+        """Fetch every requested customer in a single IN query, keyed by id."""
+        customer_ids = set(customer_ids)
+        if not customer_ids:
+            return {}
+        customers = await self.db.scalars(select(Customer).filter(Customer.id.in_(customer_ids)))
+        return {customer.id: customer for customer in customers}
+
+    async def _get_products(self, product_ids: Iterable[int]) -> dict[int, ProductResponse]:
+        """Fetch every requested product, keyed by id. Served from the product cache where possible."""
+        return await ProductService(self.db).get_products_by_ids(product_ids)
+
+    async def _get_locations(self, location_ids: Iterable[int]) -> dict[int, tuple[str, LocationType]]:
+        """Fetch the zip code and type of every requested location in a single IN query, keyed by id."""
+        location_ids = set(location_ids)
+        if not location_ids:
+            return {}
+        rows = await self.db.execute(
+            select(Location.id, Location.zip_code, Location.location_type).filter(Location.id.in_(location_ids))
+        )
+        return {row.id: (row.zip_code, row.location_type) for row in rows}
+
+    def _validate_product(self, product_id: int, products: dict[int, ProductResponse]) -> ProductResponse:
         """Validate that product exists and return product object."""
-        product = self.db.query(Product).filter(Product.id == product_id).first()
+        product = products.get(product_id)
         if not product:
             raise ValueError(f"Product with id {product_id} not found")
         return product
 
-    def _resolve_shipping_location(self, item, customer: Customer) -> int:
-        """Resolve shipping location and return location ID."""
+    def _resolve_shipping_location(self, item, customer: Customer, locations: dict[int, tuple[str, LocationType]]) -> Optional[int]:
+        """
+        Resolve shipping location and return location ID. Returns None when the item
+        carries a new inline location, which is inserted later alongside the others.
+        """
         if item.ship_to_billing_address:
             # Use customer's billing address
             return customer.billing_location_id
         elif item.shipping_location_id:
             # Use existing location by ID
-            existing_location = self.db.query(Location).filter(Location.id == item.shipping_location_id).first()
-            if not existing_location:
+            if item.shipping_location_id not in locations:
                 raise ValueError(f"Location with id {item.shipping_location_id} not found")
             return item.shipping_location_id
         elif item.shipping_location:
-            # Create new shipping location
-            shipping_location = Location(
-                location_type=LocationType.SHIPPING,
-                address_line_1=item.shipping_location.address_line_1,
-                address_line_2=item.shipping_location.address_line_2 or "",
-                city=item.shipping_location.city,
-                state=item.shipping_location.state,
-                zip_code=item.shipping_location.zip_code
-            )
-            self.db.add(shipping_location)
-            self.db.flush()
-            return shipping_location.id
+            # New shipping location, resolved in bulk by _fill_new_shipping_locations
+            return None
         else:
             raise ValueError("No shipping location specified")
 
-    def _process_purchase_items(self, items, customer: Customer) -> tuple[int, list[tuple[int, int]]]:
-        """Process all purchase items and return total cost and product data."""
+    def _validate_purchase_items(self, items, customer: Customer, products: dict[int, ProductResponse],
+                                 locations: dict[int, tuple[str, LocationType]]) -> tuple[int, list[tuple[int, Optional[int]]]]:
+        """
+        Validate all purchase items against already fetched products and locations and
+        return total cost and product data. Items shipping to a new inline location have
+        a shipping location id of None until _fill_new_shipping_locations fills it in.
+        """
         total_cost = 0
         product_data = []
-        
+
         for item in items:
             # Validate product exists
-            product = self._validate_product(item.product_id)
-            
+            product = self._validate_product(item.product_id, products)
+
             # Resolve shipping location
-            shipping_location_id = self._resolve_shipping_location(item, customer)
-            
+            shipping_location_id = self._resolve_shipping_location(item, customer, locations)
+
             total_cost += product.price
             product_data.append((item.product_id, shipping_location_id))
-        
+
         return total_cost, product_data
 
-    def _create_purchase_records(self, customer_id: int, total_cost: int, product_data: list[tuple[int, int]]) -> PurchaseRollup:
-        """Create purchase rollup and purchase product records."""
-        # Create purchase rollup
-        purchase_rollup = PurchaseRollup(
-            customer_id=customer_id,
-            total_cost=total_cost
+    async def _insert_returning_ids(self, model, rows: list[dict], key_columns: tuple) -> list[int]:
+        """
+        Insert rows with one multi-row INSERT ... RETURNING and return their ids in input order.
+        Multi-row RETURNING order isn't guaranteed on every backend, so the returned ids are
+        matched back up by key_columns. Rows with identical keys are interchangeable.
+        """
+        if not rows:
+            return []
+        ids_by_key = {}
+        for row in await self.db.execute(insert(model).returning(model.id, *key_columns), rows):
+            ids_by_key.setdefault(tuple(row[1:]), []).append(row.id)
+        return [ids_by_key[tuple(row[column.key] for column in key_columns)].pop() for row in rows]
+
+    async def _fill_new_shipping_locations(self, purchases: list[tuple[list, list[tuple[int, Optional[int]]]]],
+                                           locations: dict[int, tuple[str, LocationType]]) -> list[list[tuple[int, int]]]:
+        """
+        Resolve the new inline shipping locations of every purchase, given as (items, product_data)
+        pairs, in one upsert and return each purchase's product data with the ids filled in.
+        The resolved locations are added to `locations`.
+        """
+        new_locations = [
+            item.shipping_location
+            for items, product_data in purchases
+            for item, (_, location_id) in zip(items, product_data)
+            if location_id is None
+        ]
+        new_location_ids = await LocationService(self.db).resolve_location_ids(new_locations, LocationType.SHIPPING)
+        for location, location_id in zip(new_locations, new_location_ids):
+            locations[location_id] = (location.zip_code, LocationType.SHIPPING)
+
+        new_location_ids = iter(new_location_ids)
+        return [
+            [
+                (product_id, location_id if location_id is not None else next(new_location_ids))
+                for product_id, location_id in product_data
+            ]
+            for _, product_data in purchases
+        ]
+
+    async def _process_purchase_items(self, items, customer: Customer) -> tuple[int, list[tuple[int, int]], dict[int, tuple[str, LocationType]]]:
+        """
+        Process all purchase items and return total cost, product data and the zip code and
+        type of every location involved. Products and referenced locations (including the
+        customer's billing location) are fetched with one query each however many items there are.
+        """
+        products = await self._get_products(item.product_id for item in items)
+        locations = await self._get_locations(
+            [item.shipping_location_id for item in items if item.shipping_location_id] + [customer.billing_location_id]
+        )
+
+        total_cost, product_data = self._validate_purchase_items(items, customer, products, locations)
+
+        # Create all new inline shipping locations at once
+        product_data = (await self._fill_new_shipping_locations([(items, product_data)], locations))[0]
+
+        return total_cost, product_data, locations
+
+    def _purchase_facts(self, purchase_rollup_id: int, customer: Customer, product_data: list[tuple[int, int]],
+                        locations: dict[int, tuple[str, LocationType]], purchased_at: datetime) -> PurchaseFacts:
+        """What AnalyticsRollupService needs to know about a new purchase."""
+        billing_location = locations.get(customer.billing_location_id)
+        return PurchaseFacts(
+            purchase_rollup_id=purchase_rollup_id,
+            customer_id=customer.id,
+            billing_zip_code=billing_location[0] if billing_location else None,
+            purchase_hour=purchased_at.hour,
+            purchase_day=purchased_at.date(),
+            shipping_locations=[locations[shipping_location_id] for _, shipping_location_id in product_data]
+        )
+
+    def _purchase_product_rows(self, purchase_rollup_id: int, product_data: list[tuple[int, int]],
+                               purchased_at: datetime) -> list[dict]:
+        time_buckets = purchase_time_buckets(purchased_at)
+        return [
+            {
+                "product_id": product_id,
+                "shipping_location_id": shipping_location_id,
+                "purchase_rollup_id": purchase_rollup_id,
+                "created_at": purchased_at,
+                **time_buckets
+            }
+            for product_id, shipping_location_id in product_data
+        ]
+
+    async def _insert_purchase_products(self, rows: list[dict]):
+        """
+        Insert purchase products with a multi-row INSERT ... RETURNING. Their ids aren't needed,
+        but only with RETURNING does SQLAlchemy send the rows as multi-row VALUES pages on every
+        driver, asyncpg would otherwise execute the INSERT once per row.
+        """
+        if rows:
+            await self.db.execute(insert(PurchaseProduct).returning(PurchaseProduct.id), rows)
+
+    async def _create_purchase_records(self, customer: Customer, total_cost: int, product_data: list[tuple[int, int]],
+                                       locations: dict[int, tuple[str, LocationType]]) -> PurchaseRollup:
+        """Create purchase rollup and purchase product records and count them into the analytics rollups."""
+        # Create purchase rollup, built from the inserted values rather than read back after the commit
+        purchased_at = datetime.now(timezone.utc)
+        rollup_row = {"customer_id": customer.id, "total_cost": total_cost, "created_at": purchased_at}
+        purchase_rollup_id = await self.db.scalar(insert(PurchaseRollup).returning(PurchaseRollup.id), rollup_row)
+
+        await self._insert_purchase_products(self._purchase_product_rows(purchase_rollup_id, product_data, purchased_at))
+
+        await AnalyticsRollupService(self.db).record_purchases(
+            [self._purchase_facts(purchase_rollup_id, customer, product_data, locations, purchased_at)]
         )
-        self.db.add(purchase_rollup)
-        self.db.flush()
-        
-        # Create purchase products
-        for product_id, shipping_location_id in product_data:
-            purchase_product = PurchaseProduct(
-                product_id=product_id,
-                shipping_location_id=shipping_location_id,
-                purchase_rollup_id=purchase_rollup.id
-            )
-            self.db.add(purchase_product)
-        
-        self.db.commit()
-        self.db.refresh(purchase_rollup)
-        return purchase_rollup
-
-    def create_purchase(self, request: PurchaseCreate) -> PurchaseRollup:
+
+        await self._commit()
+        return PurchaseRollup(id=purchase_rollup_id, **rollup_row)
+
+    async def _commit(self):
+        """Commit the purchases written so far."""
+        await self.db.commit()
+
+    async def create_purchase(self, request: PurchaseCreate) -> PurchaseRollup:
         """Create a new purchase with products and shipping locations."""
         # Validate customer exists
-        customer = self._validate_customer(request.customer_id)
-        
+        customer = await self._validate_customer(request.customer_id)
+
         # Process all purchase items
-        total_cost, product_data = self._process_purchase_items(request.products, customer)
-        
+        total_cost, product_data, locations = await self._process_purchase_items(request.products, customer)
+
         # Create purchase records
-        return self._create_purchase_records(request.customer_id, total_cost, product_data)
+        return await self._create_purchase_records(customer, total_cost, product_data, locations)
+
+    async def create_purchases(self, requests: list[PurchaseCreate]) -> list[Union[PurchaseRollup, ValueError]]:
+        """
+        Create a chunk of purchases with a fixed number of statements and a single commit.
+        Each purchase is validated against the same rules as create_purchase; the result for
+        each request is either the created rollup or the ValueError that rejected it.
+        """
+        customers = await self._get_customers(request.customer_id for request in requests)
+        products = await self._get_products(item.product_id for request in requests for item in request.products)
+        locations = await self._get_locations(
+            [
+                item.shipping_location_id
+                for request in requests
+                for item in request.products
+                if item.shipping_location_id
+            ] + [customer.billing_location_id for customer in customers.values()]
+        )
+
+        # Result of each request by its index, rejections first and created rollups once committed
+        results: dict[int, Union[PurchaseRollup, ValueError]] = {}
+        accepted = []
+        for index, request in enumerate(requests):
+            try:
+                customer = customers.get(request.customer_id)
+                if not customer:
+                    raise ValueError(f"Customer with id {request.customer_id} not found")
+                total_cost, product_data = self._validate_purchase_items(request.products, customer, products, locations)
+            except ValueError as e:
+                results[index] = e
+                continue
+            accepted.append((index, request, customer, total_cost, product_data))
+
+        if not accepted:
+            return [results[index] for index in range(len(requests))]
+
+        product_data_list = await self._fill_new_shipping_locations(
+            [(request.products, product_data) for _, request, _, _, product_data in accepted], locations
+        )
+
+        # Create all purchase rollups, then all of their purchase products
+        purchased_at = datetime.now(timezone.utc)
+        rollup_rows = [
+            {"customer_id": request.customer_id, "total_cost": total_cost, "created_at": purchased_at}
+            for _, request, _, total_cost, _ in accepted
+        ]
+        rollup_ids = await self._insert_returning_ids(
+            PurchaseRollup, rollup_rows, (PurchaseRollup.customer_id, PurchaseRollup.total_cost)
+        )
+        await self._insert_purchase_products([
+            row
+            for rollup_id, product_data in zip(rollup_ids, product_data_list)
+            for row in self._purchase_product_rows(rollup_id, product_data, purchased_at)
+        ])
+
+        await AnalyticsRollupService(self.db).record_purchases([
+            self._purchase_facts(rollup_id, customer, product_data, locations, purchased_at)
+            for (_, _, customer, _, _), rollup_id, product_data in zip(accepted, rollup_ids, product_data_list)
+        ])
+
+        await self._commit()
+
+        for (index, _, _, _, _), rollup_row, rollup_id in zip(accepted, rollup_rows, rollup_ids):
+            results[index] = PurchaseRollup(id=rollup_id, **rollup_row)
+        return [results[index] for index in range(len(requests))]
+
+    async def get_purchase_by_id(self, purchase_id: int) -> Optional[PurchaseRollup]:
+        return await self.db.scalar(select(PurchaseRollup).filter(PurchaseRollup.id == purchase_id))
+
+    async def get_purchase_detail(self, purchase_id: int, expand: set[str]) -> Optional[PurchaseRollup]:
+        """
+        A purchase with the relationships named in expand eager loaded: "customer", and the
+        line items with their "products" and/or shipping "locations". Each relationship is
+        one selectin query, so the number of queries doesn't depend on the size of the order.
+        """
+        return await self.db.scalar(
+            select(PurchaseRollup).filter(PurchaseRollup.id == purchase_id).options(*self._expand_options(expand))
+        )
+
+    def _expand_options(self, expand: set[str]) -> list:
+        """selectinload options for the relationships named in expand, see get_purchase_detail."""
+        options = []
+        if "customer" in expand:
+            options.append(selectinload(PurchaseRollup.customer))
+        if "products" in expand or "locations" in expand:
+            line_items = selectinload(PurchaseRollup.products)
+            options.append(line_items)
+            if "products" in expand:
+                options.append(line_items.selectinload(PurchaseProduct.product))
+            if "locations" in expand:
+                options.append(line_items.selectinload(PurchaseProduct.shipping_location))
+        return options
+
+    async def get_customer_purchases(self, customer_id: int, limit: int, after: Optional[tuple[datetime, int]] = None,
+                                     expand: set[str] = frozenset()) -> list[PurchaseRollup]:
+        """
+        A page of the customer's purchases, newest first. Keyset paginated on (created_at, id)
+        after the (created_at, id) of the previous page's last purchase, so every page is a
+        range scan of ix_purchase_rollup_customer_created_at and costs the same as the first.
+        """
+        query = select(PurchaseRollup).filter(PurchaseRollup.customer_id == customer_id)
+        if after is not None:
+            after_created_at, after_id = after
+            query = query.filter(or_(
+                PurchaseRollup.created_at < after_created_at,
+                and_(PurchaseRollup.created_at == after_created_at, PurchaseRollup.id < after_id)
+            ))
+        query = query.order_by(PurchaseRollup.created_at.desc(), PurchaseRollup.id.desc()).limit(limit)
+        return list(await self.db.scalars(query.options(*self._expand_options(expand))))
 
-    def get_purchase_by_id(self, purchase_id: int) -> Optional[PurchaseRollup]:
-        return self.db.query(PurchaseRollup).filter(PurchaseRollup.id == purchase_id).first()
+    async def get_purchases_by_ids(self, purchase_ids: Iterable[int]) -> dict[int, PurchaseRollup]:
+        """Look up purchases by id in a single IN query, keyed by id."""
+        purchase_ids = set(purchase_ids)
+        if not purchase_ids:
+            return {}
+        purchases = await self.db.scalars(select(PurchaseRollup).filter(PurchaseRollup.id.in_(purchase_ids)))
+        return {purchase.id: purchase for purchase in purchases}
@@ -0,0 +1,139 @@
+import asyncio
+import functools
+import inspect
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+
+class _LeaderCancelled(Exception):
+    """Set on a call whose leader was cancelled before it finished, for the followers to retry."""
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: the first caller for a key runs the call and
+    every caller arriving while it is in flight shares its result (or exception) instead
+    of running it again. The in-flight call is a concurrent.futures.Future, so threads
+    and coroutines on any event loop in the process can wait on the same one.
+    Nothing is kept once the call finishes, this is not a cache.
+
+    For coalesced methods, scope maps the instance a method is called on to part of the
+    key, so only calls in the same scope share an execution. A scope of None isn't
+    coalesced at all.
+    """
+
+    def __init__(self, scope: Optional[Callable[[Any], Optional[Hashable]]] = None):
+        self.scope = scope
+        self._calls: dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+
+    def _join(self, key: Hashable) -> tuple[Future, bool]:
+        """Return the in-flight call for key and whether the caller has to run it."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                return call, False
+            call = self._calls[key] = Future()
+            self.executed += 1
+            return call, True
+
+    def _finish(self, key: Hashable, call: Future, result: Any = None, error: BaseException = None):
+        with self._lock:
+            del self._calls[key]
+        if error is not None:
+            call.set_exception(error)
+        else:
+            call.set_result(result)
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        while True:
+            call, leader = self._join(key)
+            if not leader:
+                try:
+                    return call.result()
+                except _LeaderCancelled:
+                    continue
+            try:
+                result = fn()
+            except BaseException as e:
+                self._finish(key, call, error=e)
+                raise
+            self._finish(key, call, result)
+            return result
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Async version of do. The leader runs fn in a task of its own, which followers wait
+        on shielded. If the leader is cancelled (its client disconnected, say) the call is
+        cancelled with it, since it runs on the leader's session, and its followers start
+        over: one of them runs fn again as the new leader instead of failing too.
+        """
+        while True:
+            call, leader = self._join(key)
+            if not leader:
+                try:
+                    # Shielded so a follower giving up doesn't cancel the leader's call
+                    return await asyncio.shield(asyncio.wrap_future(call))
+                except _LeaderCancelled:
+                    continue
+
+            task = asyncio.ensure_future(fn())
+            try:
+                result = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                self._finish(key, call, error=_LeaderCancelled())
+                # Done with the session before the leader's request tears it down
+                task.cancel()
+                await asyncio.wait([task])
+                raise
+            except BaseException as e:
+                self._finish(key, call, error=e)
+                raise
+            self._finish(key, call, result)
+            return result
+
+    def coalesce(self, method: Callable) -> Callable:
+        """
+        Decorate a service method so concurrent calls with the same arguments share one
+        execution. `self` (and so the session) is left out of the key, the call is made
+        with the session of whichever caller got there first.
+        """
+        signature = inspect.signature(method)
+
+        def key_for(args, kwargs) -> Optional[Hashable]:
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            scope = self.scope(bound.arguments["self"]) if self.scope is not None else ()
+            if scope is None:
+                return None
+            arguments = [(name, value) for name, value in bound.arguments.items() if name != "self"]
+            return (method.__qualname__, scope, tuple(arguments))
+
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def coalesced_async(*args, **kwargs):
+                key = key_for(args, kwargs)
+                if key is None:
+                    return await method(*args, **kwargs)
+                return await self.do_async(key, lambda: method(*args, **kwargs))
+            return coalesced_async
+
+        @functools.wraps(method)
+        def coalesced(*args, **kwargs):
+            key = key_for(args, kwargs)
+            if key is None:
+                return method(*args, **kwargs)
+            return self.do(key, lambda: method(*args, **kwargs))
+        return coalesced
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "executed": self.executed,
+                "coalesced": self.coalesced
+            }
@@ -2,16 +2,34 @@
 Common test fixtures and utilities for all tests.
 This file is automatically discovered by pytest and makes fixtures available across all test files.
 """
+import asyncio
 import pytest
+from contextlib import contextmanager
 import uuid
 import os
+
+# Routes over their query budget fail the test rather than log (see src/monitoring/query_budget.py)
+os.environ.setdefault("QUERY_BUDGET_MODE", "raise")
+# The /admin and /export endpoints are off without a token
+os.environ.setdefault("ADMIN_TOKEN", "test-admin-token")
+
 from datetime import datetime
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 from src.data.database import get_db, Base
+from src.data.async_database import async_database_url, get_async_db
 from src.data.tables import *  # Import all models
 from src.main import app
+from src.monitoring import request_metrics, slow_query_log, tracer
+from src.services.analytics_cache import analytics_cache, data_version
+from src.services.columnar_analytics import purchase_fact_snapshot
+from src.services.product_cache import product_cache
+from src.services.location_service import location_cache
+from src.services.analytics_rollup_service import AnalyticsRollupService
 
 
 @pytest.fixture(scope="function")
@@ -29,6 +47,15 @@ def test_db():
             yield db
         finally:
             db.close()
+
+    # The app itself runs on an async engine over the same file. TestClient may use a new
+    # event loop per request, so connections aren't pooled across requests.
+    test_async_engine = create_async_engine(f"sqlite+aiosqlite:///./{db_filename}", poolclass=NullPool)
+    TestingAsyncSessionLocal = async_sessionmaker(bind=test_async_engine, autoflush=False, expire_on_commit=False)
+
+    async def override_get_async_db():
+        async with TestingAsyncSessionLocal() as db:
+            yield db
     
     # Ensure all models are imported before creating tables
     from src.data.tables.customer import Customer
@@ -42,6 +69,17 @@ def test_db():
     
     # Override dependency
     app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
+
+    # Every test starts from a fresh database, so nothing cached from a previous one applies
+    product_cache.clear()
+    location_cache.clear()
+    analytics_cache.clear()
+    data_version.clear()
+    purchase_fact_snapshot.clear()
+    request_metrics.clear()
+    slow_query_log.clear()
+    tracer.exporter.clear()
     
     yield TestingSessionLocal
     
@@ -49,6 +87,8 @@ def test_db():
     Base.metadata.drop_all(bind=test_engine)
     if get_db in app.dependency_overrides:
         del app.dependency_overrides[get_db]
+    if get_async_db in app.dependency_overrides:
+        del app.dependency_overrides[get_async_db]
     
     # Remove test database file
     if os.path.exists(db_filename):
@@ -61,6 +101,51 @@ def client(test_db):
     return TestClient(app)
 
 
+@pytest.fixture(scope="function")
+def admin_client(test_db):
+    """Test client sending the admin token, for the /admin and /export endpoints"""
+    return TestClient(app, headers={"Authorization": f"Bearer {os.environ['ADMIN_TOKEN']}"})
+
+
+@pytest.fixture(scope="function")
+def assert_max_queries():
+    """
+    `with assert_max_queries(max_queries) as statements:` fails if the block runs more than
+    max_queries SQL statements, on any engine. statements is the list of statements run so
+    far. Unlike QueryBudget, this also sees statements made on the TestClient's event loop thread.
+    """
+    @contextmanager
+    def max_queries_block(max_queries: int):
+        statements = []
+
+        def record_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(Engine, "before_cursor_execute", record_statement)
+        try:
+            yield statements
+        finally:
+            event.remove(Engine, "before_cursor_execute", record_statement)
+        assert len(statements) <= max_queries, (
+            f"{len(statements)} queries, expected at most {max_queries}:\n" + "\n".join(statements)
+        )
+
+    return max_queries_block
+
+
+def rebuild_analytics_rollups(test_db):
+    """Backfill the analytics rollup tables from rows the factory inserted directly"""
+    url = test_db.kw["bind"].url.render_as_string(hide_password=False)
+
+    async def rebuild():
+        rebuild_engine = create_async_engine(async_database_url(url), poolclass=NullPool)
+        async with async_sessionmaker(bind=rebuild_engine)() as db:
+            await AnalyticsRollupService(db).rebuild()
+        await rebuild_engine.dispose()
+
+    asyncio.run(rebuild())
+
+
 # Common test data creation utilities
 class TestDataFactory:
     """Factory class for creating common test data"""
@@ -313,6 +398,7 @@ def analytics_sample_data(test_db):
     )
     
     db.commit()
+    rebuild_analytics_rollups(test_db)
     
     data = {
         "customer_1_id": customer_1.id,
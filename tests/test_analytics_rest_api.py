@@ -114,6 +114,560 @@ class TestAnalyticsEndpoints:
         assert top_user["last_name"] == "Doe"
         assert top_user["store_order_count"] == 2
     
+    def test_zip_order_counts_follow_new_purchases(self, client, basic_sample_data, test_db):
+        """Test purchases update the zip code rollups in place, matching a full rebuild"""
+        from tests.conftest import rebuild_analytics_rollups
+        billing_item = {"product_id": basic_sample_data["product1_id"], "ship_to_billing_address": True}
+        shipping_item = {
+            "product_id": basic_sample_data["product2_id"],
+            "shipping_location_id": basic_sample_data["shipping_location_id"]
+        }
+        for products in ([billing_item], [billing_item, shipping_item, shipping_item], [shipping_item]):
+            response = client.post("/purchase/", json={"customer_id": basic_sample_data["customer_id"], "products": products})
+            assert response.status_code == 200
+
+        billing = client.get("/analytics/orders-by-billing-zip").json()
+        shipping = client.get("/analytics/orders-by-shipping-zip").json()
+        assert billing == [{"zip_code": "12345", "order_count": 3}]
+        assert shipping == [
+            {"zip_code": "12345", "order_count": 2},
+            {"zip_code": "54321", "order_count": 2}
+        ]
+
+        rebuild_analytics_rollups(test_db)
+        assert client.get("/analytics/orders-by-billing-zip").json() == billing
+        assert client.get("/analytics/orders-by-shipping-zip").json() == shipping
+    
+    def test_store_purchase_times_follow_new_purchases(self, client, basic_sample_data, test_db):
+        """Test store pickups are bucketed by purchase hour at insert time"""
+        from src.data.tables.purchase_product import PurchaseProduct
+        from tests.conftest import TestDataFactory
+        db = test_db()
+        store_location = TestDataFactory.create_store_location(db)
+        db.commit()
+        store_location_id = store_location.id
+        db.close()
+
+        store_item = {"product_id": basic_sample_data["product1_id"], "shipping_location_id": store_location_id}
+        billing_item = {"product_id": basic_sample_data["product2_id"], "ship_to_billing_address": True}
+        response = client.post("/purchase/", json={
+            "customer_id": basic_sample_data["customer_id"],
+            "products": [store_item, store_item, billing_item]
+        })
+        assert response.status_code == 200
+
+        db = test_db()
+        purchase_products = db.query(PurchaseProduct).all()
+        hours = {purchase_product.purchase_hour for purchase_product in purchase_products}
+        assert len(hours) == 1
+        assert all(purchase_product.purchase_day_of_week is not None for purchase_product in purchase_products)
+        db.close()
+
+        data = client.get("/analytics/store-purchase-times").json()
+        assert data == [{"hour": hours.pop(), "purchase_count": 2}]
+    
+    def test_top_store_pickup_users_paging(self, client, analytics_sample_data):
+        """Test the store pickup leaderboard honours limit and offset"""
+        response = client.get("/analytics/top-store-pickup-users?limit=1")
+        assert response.status_code == 200
+        assert [user["customer_id"] for user in response.json()] == [analytics_sample_data["customer_1_id"]]
+
+        response = client.get("/analytics/top-store-pickup-users?limit=5&offset=1")
+        assert [(user["customer_id"], user["store_order_count"]) for user in response.json()] == [
+            (analytics_sample_data["customer_3_id"], 1)
+        ]
+
+        assert client.get("/analytics/top-store-pickup-users?limit=0").status_code == 422
+
+    def test_top_store_pickup_users_follow_new_purchases(self, client, analytics_sample_data, test_db):
+        """Test each new order with a store pickup counts once towards the customer"""
+        from src.data.tables.location import Location, LocationType
+        db = test_db()
+        store_location_id = db.query(Location.id).filter(Location.location_type == LocationType.STORE).first().id
+        product_id = 1
+        db.close()
+
+        store_item = {"product_id": product_id, "shipping_location_id": store_location_id}
+        for _ in range(2):
+            response = client.post("/purchase/", json={
+                "customer_id": analytics_sample_data["customer_3_id"],
+                "products": [store_item, store_item]
+            })
+            assert response.status_code == 200
+
+        data = client.get("/analytics/top-store-pickup-users").json()
+        assert [(user["customer_id"], user["store_order_count"]) for user in data] == [
+            (analytics_sample_data["customer_3_id"], 3),
+            (analytics_sample_data["customer_1_id"], 2)
+        ]
+    
+    def test_analytics_time_window(self, client, analytics_sample_data):
+        """Test start/end restrict every endpoint to purchases made in [start, end)"""
+        window = {"start": "2024-01-01T12:00:00+02:00", "end": "2024-01-01T12:00:00"}
+
+        response = client.get("/analytics/orders-by-shipping-zip", params=window)
+        assert response.status_code == 200
+        assert response.json() == [
+            {"zip_code": "55555", "order_count": 2},
+            {"zip_code": "78901", "order_count": 1}
+        ]
+
+        response = client.get("/analytics/store-purchase-times", params=window)
+        assert response.json() == [{"hour": 11, "purchase_count": 2}]
+
+        response = client.get("/analytics/top-store-pickup-users", params=window)
+        assert [(user["customer_id"], user["store_order_count"]) for user in response.json()] == [
+            (analytics_sample_data["customer_1_id"], 1),
+            (analytics_sample_data["customer_3_id"], 1)
+        ]
+
+        # Purchase rollups are created now, so only an open ended window sees them
+        response = client.get("/analytics/orders-by-billing-zip", params={"end": "2024-01-02T00:00:00"})
+        assert response.json() == []
+        response = client.get("/analytics/orders-by-billing-zip", params={"start": "2024-01-02T00:00:00", "ascending": True})
+        assert response.json() == [
+            {"zip_code": "54321", "order_count": 1},
+            {"zip_code": "12345", "order_count": 4}
+        ]
+
+        response = client.get("/analytics/orders-by-billing-zip", params={"start": "2024-01-02", "end": "2024-01-01"})
+        assert response.status_code == 400
+
+    def test_zip_order_counts_keyset_pages(self, client, analytics_sample_data):
+        """Test following X-Next-Cursor pages through the same rows as the unpaged list"""
+        for url, params in (
+            ("/analytics/orders-by-shipping-zip", {}),
+            ("/analytics/orders-by-shipping-zip", {"ascending": True}),
+            ("/analytics/orders-by-shipping-zip", {"start": "2024-01-01T00:00:00"}),
+            ("/analytics/orders-by-billing-zip", {}),
+        ):
+            expected = client.get(url, params=params).json()
+            pages, cursor = [], None
+            while True:
+                page_params = {**params, "limit": 1} if cursor is None else {**params, "limit": 1, "cursor": cursor}
+                response = client.get(url, params=page_params)
+                assert response.status_code == 200
+                pages.append(response.json())
+                cursor = response.headers.get("x-next-cursor")
+                if cursor is None:
+                    break
+            assert all(len(page) == 1 for page in pages)
+            assert [row for page in pages for row in page] == expected
+
+        response = client.get("/analytics/orders-by-shipping-zip?limit=2")
+        assert [row["zip_code"] for row in response.json()] == ["55555", "78901"]
+        cursor = response.headers["x-next-cursor"]
+        assert client.get(f"/analytics/orders-by-shipping-zip?limit=2&cursor={cursor}").json() == [
+            {"zip_code": "32109", "order_count": 1},
+            {"zip_code": "77777", "order_count": 1}
+        ]
+        # A cursor only continues the ordering it came from
+        assert client.get(f"/analytics/orders-by-shipping-zip?ascending=true&cursor={cursor}").status_code == 400
+        assert client.get("/analytics/orders-by-shipping-zip?cursor=not-a-cursor").status_code == 400
+
+    def test_zip_order_counts_pages_read_an_index(self, test_db):
+        """Test a page of zip order counts, in either direction, is read off an index instead of sorting every zip code"""
+        from sqlalchemy import text
+        from sqlalchemy.dialects import sqlite
+        from src.data.tables.zip_order_count import BillingZipOrderCount, ShippingZipOrderCount
+        from src.services.analytics_service import AnalyticsService
+        db = test_db()
+        for table in (BillingZipOrderCount, ShippingZipOrderCount):
+            for ascending, after in ((False, None), (False, (3, "12345")), (True, None), (True, (3, "12345"))):
+                query = AnalyticsService(db)._zip_order_counts_query(table, None, ascending, None, None, 50, after)
+                sql = str(query.compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True}))
+                plan = " ".join(row[-1] for row in db.execute(text(f"EXPLAIN QUERY PLAN {sql}")))
+                assert "USING" in plan and "INDEX" in plan
+                assert "TEMP B-TREE" not in plan
+        db.close()
+
+    def test_zip_order_counts_stream(self, client, analytics_sample_data):
+        """Test stream=true writes the same rows as NDJSON"""
+        import json
+        response = client.get("/analytics/orders-by-shipping-zip?stream=true")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert rows == client.get("/analytics/orders-by-shipping-zip").json()
+
+        response = client.get("/analytics/orders-by-billing-zip?stream=true&ascending=true&limit=1")
+        assert [json.loads(line) for line in response.text.splitlines()] == [{"zip_code": "54321", "order_count": 1}]
+
+    def test_hyperloglog_estimates_and_merges(self):
+        """Test HyperLogLog counts within its error, merges to the union and serializes compactly"""
+        from src.services.hyperloglog import HyperLogLog
+        first, second = HyperLogLog(), HyperLogLog()
+        first.update(range(0, 60000))
+        second.update(range(40000, 100000))
+        assert abs(first.count() - 60000) <= 3 * first.relative_error * 60000
+
+        first.merge(second)
+        assert abs(first.count() - 100000) <= 3 * first.relative_error * 100000
+        assert HyperLogLog.from_bytes(first.to_bytes()).count() == first.count()
+
+        small = HyperLogLog()
+        small.update([1, 2, 3, 3])
+        assert small.count() == 3
+        assert len(small.to_bytes()) < 100
+
+    def test_approximate_counts(self, client, analytics_sample_data):
+        """Test approximate=true answers windows from the sketches, with an error bound, and follows new purchases"""
+        exact = client.get("/analytics/orders-by-shipping-zip").json()
+        response = client.get("/analytics/orders-by-shipping-zip?approximate=true")
+        assert response.status_code == 200
+        assert response.headers["x-approximate-relative-error"] == "0.0163"
+        # Without a window the exact rollup is read
+        assert response.json() == [{**row, "error_bound": 0} for row in exact]
+
+        window = {"approximate": True, "start": "2024-01-01T00:00:00", "end": "2024-01-02T00:00:00"}
+        response = client.get("/analytics/orders-by-shipping-zip", params=window)
+        exact = client.get("/analytics/orders-by-shipping-zip", params={"start": window["start"], "end": window["end"]}).json()
+        assert [{"zip_code": row["zip_code"], "order_count": row["order_count"]} for row in response.json()] == exact
+        assert len(exact) == 4
+        assert all(row["error_bound"] >= 1 for row in response.json())
+        window["start"] = "2024-01-02T00:00:00"
+        window.pop("end")
+        assert client.get("/analytics/orders-by-shipping-zip", params=window).json() == []
+        assert client.get("/analytics/orders-by-shipping-zip?approximate=true&limit=1").status_code == 400
+        # The sketches are per day, a window that isn't whole days can't be answered within the error bound
+        part_of_a_day = {"approximate": True, "start": "2024-01-01T10:00:00", "end": "2024-01-01T12:00:00"}
+        assert client.get("/analytics/orders-by-shipping-zip", params=part_of_a_day).status_code == 400
+        assert client.get("/analytics/top-store-pickup-users", params=part_of_a_day).status_code == 400
+        response = client.get("/analytics/top-store-pickup-users", params={"approximate": True, "end": "2024-01-01T00:00:01"})
+        assert response.status_code == 400
+
+        store_item = {"product_id": 1, "shipping_location_id": 5}
+        for _ in range(3):
+            response = client.post("/purchase/", json={
+                "customer_id": analytics_sample_data["customer_3_id"],
+                "products": [store_item, store_item]
+            })
+            assert response.status_code == 200
+
+        response = client.get("/analytics/top-store-pickup-users?approximate=true")
+        assert [(user["customer_id"], user["store_order_count"]) for user in response.json()] == [
+            (analytics_sample_data["customer_3_id"], 4),
+            (analytics_sample_data["customer_1_id"], 2)
+        ]
+        response = client.get("/analytics/top-store-pickup-users", params=window)
+        assert [(user["customer_id"], user["store_order_count"]) for user in response.json()] == [
+            (analytics_sample_data["customer_3_id"], 3)
+        ]
+
+    def test_columnar_backend_matches_sql(self, client, analytics_sample_data, monkeypatch):
+        """Test the columnar snapshot backend returns exactly what the SQL backend does"""
+        from src.rest_api import analytics_rest_api
+        from src.services.analytics_cache import analytics_cache
+        from src.services.columnar_analytics import purchase_fact_snapshot
+        store_item = {"product_id": 2, "shipping_location_id": 5}
+        billing_item = {"product_id": 1, "ship_to_billing_address": True}
+        for customer_id in ("customer_2_id", "customer_3_id", "customer_3_id"):
+            response = client.post("/purchase/", json={
+                "customer_id": analytics_sample_data[customer_id],
+                "products": [store_item, billing_item, store_item]
+            })
+            assert response.status_code == 200
+
+        urls = [
+            "/analytics/orders-by-billing-zip",
+            "/analytics/orders-by-billing-zip?ascending=true&start=2024-01-02T00:00:00",
+            "/analytics/orders-by-shipping-zip",
+            "/analytics/orders-by-shipping-zip?ascending=true",
+            "/analytics/orders-by-shipping-zip?start=2024-01-01T10:00:00&end=2024-01-01T12:00:00",
+            "/analytics/store-purchase-times",
+            "/analytics/store-purchase-times?end=2024-01-01T12:00:00",
+            "/analytics/top-store-pickup-users",
+            "/analytics/top-store-pickup-users?limit=1&offset=1",
+            "/analytics/top-store-pickup-users?start=2024-01-01T11:00:00&end=2024-01-02T00:00:00",
+        ]
+
+        # A client that hasn't written, one that has reads its own writes on the SQL backend
+        reader = TestClient(client.app)
+
+        def results(backend):
+            monkeypatch.setattr(analytics_rest_api, "ANALYTICS_BACKEND", backend)
+            analytics_cache.clear()
+            return [reader.get(url).json() for url in urls]
+
+        sql_results = results("sql")
+        assert results("columnar") == sql_results
+        assert purchase_fact_snapshot.products["rollup_id"].size == 15
+
+        # A new purchase is picked up incrementally on the next read
+        response = client.post("/purchase/", json={
+            "customer_id": analytics_sample_data["customer_2_id"],
+            "products": [store_item]
+        })
+        assert response.status_code == 200
+        assert results("columnar") == results("sql") != sql_results
+        assert purchase_fact_snapshot.products["rollup_id"].size == 16
+
+    def test_columnar_snapshot_picks_up_late_commits(self, client, analytics_sample_data, test_db, monkeypatch):
+        """Test a purchase committed after one with a higher id still makes it into the snapshot"""
+        from src.data.tables.purchase_rollup import PurchaseRollup
+        from src.rest_api import analytics_rest_api
+        from src.services.analytics_cache import analytics_cache
+        from src.services.columnar_analytics import purchase_fact_snapshot
+        monkeypatch.setattr(analytics_rest_api, "ANALYTICS_BACKEND", "columnar")
+        monkeypatch.setattr(purchase_fact_snapshot, "refresh_seconds", 0)
+
+        def billing_zip_counts():
+            analytics_cache.clear()
+            rows = client.get("/analytics/orders-by-billing-zip").json()
+            return {row["zip_code"]: row["order_count"] for row in rows}
+
+        assert billing_zip_counts()["54321"] == 1
+        db = test_db()
+        for purchase_rollup_id in (1000, 999):
+            db.add(PurchaseRollup(id=purchase_rollup_id, customer_id=analytics_sample_data["customer_2_id"], total_cost=1000))
+            db.commit()
+            assert billing_zip_counts()["54321"] == 1002 - purchase_rollup_id
+        db.close()
+        assert purchase_fact_snapshot.orders["rollup_id"].size == len(set(purchase_fact_snapshot.orders["rollup_id"]))
+
+    def test_columnar_results_cached_per_snapshot(self, client, analytics_sample_data, test_db, monkeypatch):
+        """Test a columnar result is recomputed when the snapshot picks up a late commit, which leaves the data version as it was"""
+        from src.data.tables.purchase_rollup import PurchaseRollup
+        from src.rest_api import analytics_rest_api
+        from src.services.columnar_analytics import purchase_fact_snapshot
+        monkeypatch.setattr(analytics_rest_api, "ANALYTICS_BACKEND", "columnar")
+        monkeypatch.setattr(purchase_fact_snapshot, "refresh_seconds", 0)
+
+        def billing_zip_counts():
+            rows = client.get("/analytics/orders-by-billing-zip").json()
+            return {row["zip_code"]: row["order_count"] for row in rows}
+
+        db = test_db()
+        for purchase_rollup_id in (1000, 999):
+            db.add(PurchaseRollup(id=purchase_rollup_id, customer_id=analytics_sample_data["customer_2_id"], total_cost=1000))
+            db.commit()
+            assert billing_zip_counts()["54321"] == 1002 - purchase_rollup_id
+        db.close()
+
+    def test_analytics_etag_not_modified(self, client, analytics_sample_data, assert_max_queries):
+        """Test a matching If-None-Match gets a 304 without a query while the data version is fresh"""
+        response = client.get("/analytics/orders-by-billing-zip")
+        etag = response.headers["etag"]
+        assert response.headers["cache-control"] == "no-cache"
+        assert client.get("/analytics/orders-by-billing-zip?ascending=true").headers["etag"] != etag
+
+        with assert_max_queries(0):
+            response = client.get("/analytics/orders-by-billing-zip", headers={"If-None-Match": etag})
+            cached = client.get("/analytics/orders-by-billing-zip")
+
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+        assert cached.headers["etag"] == etag
+        assert client.get("/analytics/cache-stats").json()["hits"] == 2
+
+    def test_analytics_etag_changes_after_write_elsewhere(self, client, analytics_sample_data, test_db, monkeypatch):
+        """Test a purchase committed outside this process (another worker) is picked up once the data version is read again"""
+        from sqlalchemy import insert
+        from src.data.tables.purchase_rollup import PurchaseRollup
+        from src.services.analytics_cache import data_version
+        url = "/analytics/orders-by-billing-zip?start=2000-01-01T00:00:00"
+        response = client.get(url)
+        etag = response.headers["etag"]
+        assert {"zip_code": "54321", "order_count": 1} in response.json()
+
+        # Written without an ORM session, so nothing in this process hears about it
+        with test_db.kw["bind"].begin() as connection:
+            connection.execute(insert(PurchaseRollup).values(customer_id=analytics_sample_data["customer_2_id"], total_cost=1000))
+
+        assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+        monkeypatch.setattr(data_version, "ttl_seconds", 0)
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+        assert {"zip_code": "54321", "order_count": 2} in response.json()
+
+    def test_analytics_etag_changes_after_write_in_process(self, client, analytics_sample_data, test_db):
+        """Test a commit that wrote in this process is seen straight away, without waiting for the data version to expire"""
+        from src.data.tables.purchase_rollup import PurchaseRollup
+        url = "/analytics/orders-by-billing-zip?start=2000-01-01T00:00:00"
+        etag = client.get(url).headers["etag"]
+
+        db = test_db()
+        db.add(PurchaseRollup(customer_id=analytics_sample_data["customer_2_id"], total_cost=1000))
+        db.commit()
+        db.close()
+
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert {"zip_code": "54321", "order_count": 2} in response.json()
+
+    def test_analytics_cache_serves_encoded_rows(self, client, analytics_sample_data):
+        """Test a cache hit sends the same JSON bytes as the request that computed them"""
+        first = client.get("/analytics/orders-by-billing-zip?limit=1")
+        cached = client.get("/analytics/orders-by-billing-zip?limit=1")
+
+        assert first.headers["content-type"] == "application/json"
+        assert first.content == b'[{"zip_code":"12345","order_count":4}]'
+        assert cached.content == first.content
+        assert cached.headers["x-next-cursor"] == first.headers["x-next-cursor"]
+        assert client.get("/analytics/cache-stats").json()["hits"] == 1
+
+    def test_analytics_etag_changes_after_purchase(self, client, analytics_sample_data):
+        """Test a purchase invalidates cached analytics and their ETags"""
+        response = client.get("/analytics/orders-by-billing-zip")
+        etag = response.headers["etag"]
+
+        response = client.post("/purchase/", json={
+            "customer_id": analytics_sample_data["customer_2_id"],
+            "products": [{"product_id": 1, "ship_to_billing_address": True}]
+        })
+        assert response.status_code == 200
+
+        response = client.get("/analytics/orders-by-billing-zip", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+        assert response.json() == [
+            {"zip_code": "12345", "order_count": 4},
+            {"zip_code": "54321", "order_count": 2}
+        ]
+
+    def test_analytics_cache_serves_stale_while_refreshing(self):
+        """Test callers get the previous result while another caller recomputes it"""
+        import asyncio
+        from src.services.analytics_cache import AnalyticsCache
+        cache = AnalyticsCache(max_size=10, ttl_seconds=60)
+
+        async def scenario():
+            release = asyncio.Event()
+            calls = []
+
+            async def compute():
+                calls.append(len(calls))
+                if len(calls) > 1:
+                    await release.wait()
+                return len(calls)
+
+            assert (await cache.get_or_compute("key", "1", compute))[0] == 1
+            refresh = asyncio.create_task(cache.get_or_compute("key", "2", compute))
+            await asyncio.sleep(0)
+            stale = await cache.get_or_compute("key", "2", compute)
+            release.set()
+            fresh = await refresh
+            return stale, fresh, calls
+
+        stale, fresh, calls = asyncio.run(scenario())
+        assert stale[0] == 1
+        assert fresh[0] == 2
+        assert stale[1] != fresh[1]
+        assert len(calls) == 2
+        assert cache.stats()["stale_hits"] == 1
+
+    def test_single_flight_coalesces_concurrent_calls(self):
+        """Test identical concurrent calls share one execution, in threads and coroutines"""
+        import asyncio
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from src.services.single_flight import SingleFlight
+        single_flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            release.wait()
+            return "result"
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(single_flight.do, "key", compute) for _ in range(4)]
+            while single_flight.stats()["coalesced"] < 3:
+                pass
+            release.set()
+            assert [future.result() for future in futures] == ["result"] * 4
+        assert len(calls) == 1
+
+        class Service:
+            @single_flight.coalesce
+            async def count(self, ascending=False):
+                calls.append(1)
+                await asyncio.sleep(0.01)
+                return ascending
+
+        async def scenario():
+            return await asyncio.gather(
+                Service().count(), Service().count(ascending=False), Service().count(True)
+            )
+
+        assert asyncio.run(scenario()) == [False, False, True]
+        assert len(calls) == 3
+        assert single_flight.stats() == {"in_flight": 0, "executed": 3, "coalesced": 4}
+
+    def test_single_flight_shares_errors(self):
+        """Test every coalesced caller gets the exception raised by the shared call"""
+        import asyncio
+        from src.services.single_flight import SingleFlight
+        single_flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        async def scenario():
+            return await asyncio.gather(
+                *(single_flight.do_async("key", fail) for _ in range(3)), return_exceptions=True
+            )
+
+        results = asyncio.run(scenario())
+        assert all(isinstance(result, ValueError) for result in results)
+        assert single_flight.stats()["executed"] == 1
+
+    def test_single_flight_survives_leader_cancellation(self):
+        """Test followers take over the call when the caller running it is cancelled"""
+        import asyncio
+        from src.services.single_flight import SingleFlight
+        single_flight = SingleFlight()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return len(calls)
+
+        async def scenario():
+            leader = asyncio.create_task(single_flight.do_async("key", compute))
+            await asyncio.sleep(0)
+            followers = [asyncio.create_task(single_flight.do_async("key", compute)) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            results = await asyncio.gather(*followers)
+            return leader.cancelled(), results
+
+        leader_cancelled, results = asyncio.run(scenario())
+        assert leader_cancelled
+        assert results == [2, 2]
+        assert len(calls) == 2
+        # Both followers joined the first call, then one joined the other's retry
+        assert single_flight.stats() == {"in_flight": 0, "executed": 2, "coalesced": 3}
+
+    def test_single_flight_scope(self):
+        """Test only calls in the same scope are coalesced, and calls without one aren't"""
+        import asyncio
+        from src.services.single_flight import SingleFlight
+        single_flight = SingleFlight(scope=lambda service: service.target)
+        calls = []
+
+        class Service:
+            def __init__(self, target):
+                self.target = target
+
+            @single_flight.coalesce
+            async def count(self):
+                calls.append(self.target)
+                await asyncio.sleep(0.01)
+                return self.target
+
+        async def scenario():
+            return await asyncio.gather(*(Service(target).count() for target in ("replica", "primary", None, None, "replica")))
+
+        assert asyncio.run(scenario()) == ["replica", "primary", None, None, "replica"]
+        assert sorted(calls, key=str) == [None, None, "primary", "replica"]
+        assert single_flight.stats() == {"in_flight": 0, "executed": 2, "coalesced": 1}
+
     def test_analytics_endpoints_empty_data(self, client):
         """Test analytics endpoints with no data"""
         # Test all endpoints return empty lists when no data exists
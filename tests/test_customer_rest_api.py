@@ -121,6 +121,99 @@ class TestCustomerEndpoints:
         assert response.status_code == 404
         assert response.json()["detail"] == "Customer not found"
     
+    def test_lookup_customers(self, client, basic_sample_data):
+        """Test many customers are resolved by email and phone in one request, with misses as null"""
+        response = client.post("/customer/lookup", json={
+            "emails": ["test@example.com", "missing@example.com"],
+            "phone_numbers": ["0000000000", "1234567890"]
+        })
+
+        assert response.status_code == 200
+        data = response.json()
+        assert list(data["by_email"]) == ["test@example.com", "missing@example.com"]
+        assert data["by_email"]["test@example.com"]["id"] == basic_sample_data["customer_id"]
+        assert data["by_email"]["missing@example.com"] is None
+        assert data["by_phone"]["0000000000"] is None
+        assert data["by_phone"]["1234567890"] == data["by_email"]["test@example.com"]
+
+        response = client.post("/customer/lookup", json={"emails": ["x@example.com"] * 5001})
+        assert response.status_code == 422
+
+    def test_customer_purchase_history_pages(self, client, basic_sample_data, test_db, assert_max_queries):
+        """Test purchase history is keyset paginated newest first, ties on created_at broken by id"""
+        from datetime import datetime, timezone
+        from tests.conftest import TestDataFactory
+        customer_id = basic_sample_data["customer_id"]
+
+        # Three purchases made at the same instant, then two through the API
+        db = test_db()
+        same_time = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc)
+        purchase_ids = [
+            TestDataFactory.create_purchase_rollup(db, customer_id, created_at=same_time).id for _ in range(3)
+        ]
+        db.commit()
+        db.close()
+        purchase_data = {
+            "customer_id": customer_id,
+            "products": [{"product_id": basic_sample_data["product1_id"], "ship_to_billing_address": True}]
+        }
+        purchase_ids += [client.post("/purchase/", json=purchase_data).json()["id"] for _ in range(2)]
+
+        pages = []
+        statement_counts = []
+        params = {"limit": 2}
+        while True:
+            with assert_max_queries(1) as statements:
+                response = client.get(f"/customer/{customer_id}/purchases", params=params)
+            assert response.status_code == 200
+            pages.append(response.json())
+            statement_counts.append(len(statements))
+            if "x-next-cursor" not in response.headers:
+                break
+            params["cursor"] = response.headers["x-next-cursor"]
+
+        assert [len(page) for page in pages] == [2, 2, 1]
+        assert [purchase["id"] for page in pages for purchase in page] == list(reversed(purchase_ids))
+        assert pages[2][0]["created_at"] == "2024-01-01T12:00:00+00:00"
+        assert len(set(statement_counts)) == 1
+
+        expanded = client.get(f"/customer/{customer_id}/purchases", params={"limit": 3, "expand": "products"}).json()
+        assert expanded[0]["products"][0]["product"]["price"] == 1000
+        assert expanded[2]["products"] == []
+
+        assert client.get(f"/customer/{customer_id}/purchases", params={"cursor": "nope"}).status_code == 400
+        other_cursor = client.get(f"/customer/{customer_id}/purchases", params={"limit": 1}).headers["x-next-cursor"]
+        assert client.get("/customer/99999/purchases", params={"cursor": other_cursor}).status_code == 400
+        assert client.get("/customer/99999/purchases").status_code == 404
+
+    def test_create_customers_share_billing_location(self, client, test_db):
+        """Test customers at the same billing address reuse one location row"""
+        def customer_data(email, phone_number, address_line_1):
+            return {
+                "email": email,
+                "phone_number": phone_number,
+                "first_name": "Sam",
+                "last_name": "Lee",
+                "billing_address": {
+                    "location_type": "billing",
+                    "address_line_1": address_line_1,
+                    "city": "Anytown",
+                    "state": "CA",
+                    "zip_code": "12345"
+                }
+            }
+
+        first = client.post("/customer/", json=customer_data("one@example.com", "1000000001", "1 Shared Way"))
+        second = client.post("/customer/", json=customer_data("two@example.com", "1000000002", "1 SHARED WAY"))
+        third = client.post("/customer/", json=customer_data("three@example.com", "1000000003", "2 Other Way"))
+
+        assert first.json()["billing_location_id"] == second.json()["billing_location_id"]
+        assert third.json()["billing_location_id"] != first.json()["billing_location_id"]
+
+        db = test_db()
+        assert db.query(Location).count() == 2
+        db.close()
+    
     def test_create_customer_invalid_email(self, client):
         """Test customer creation with invalid email format"""
         customer_data = {
@@ -0,0 +1,109 @@
+import io
+import pytest
+import pyarrow as pa
+import pyarrow.parquet as pq
+from fastapi.testclient import TestClient
+
+
+class TestExportEndpoints:
+
+    def test_export_purchase_fact_arrow_stream(self, admin_client, analytics_sample_data):
+        """Test the purchase fact view streams as Arrow IPC, one row per purchase product"""
+        response = admin_client.get("/export/purchase_fact?format=arrow&batch_size=4")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/vnd.apache.arrow.stream"
+        table = pa.ipc.open_stream(response.content).read_all()
+        assert table.num_rows == 6
+        assert table.column("id").to_pylist() == [1, 2, 3, 4, 5, 6]
+
+        rows = table.to_pylist()
+        assert rows[0]["customer_id"] == analytics_sample_data["customer_1_id"]
+        assert rows[0]["billing_zip_code"] == "12345"
+        assert rows[0]["shipping_zip_code"] == "78901"
+        assert rows[0]["shipping_location_type"] == "shipping"
+        assert rows[0]["price"] == 1000
+        assert rows[3]["shipping_location_type"] == "store"
+        assert rows[3]["created_at"].hour == 11
+
+    def test_export_table_parquet_since_id(self, admin_client, analytics_sample_data):
+        """Test a table exports as Parquet, incrementally after an id"""
+        response = admin_client.get("/export/purchase_rollup?since_id=2")
+
+        assert response.status_code == 200
+        table = pq.read_table(io.BytesIO(response.content))
+        assert table.column_names == ["id", "customer_id", "total_cost", "created_at", "updated_at"]
+        assert table.column("id").to_pylist() == [3, 4, 5]
+
+        response = admin_client.get("/export/purchase_rollup?since_id=5")
+        assert pq.read_table(io.BytesIO(response.content)).num_rows == 0
+
+    def test_export_unknown_table(self, admin_client):
+        """Test exporting something that isn't an export source is a 404"""
+        assert admin_client.get("/export/pg_user").status_code == 404
+        assert admin_client.get("/export/customer?format=csv").status_code == 422
+
+    def test_export_requires_admin_token(self, client, monkeypatch):
+        """Test exports, like the admin endpoints, need the admin token and are off without one"""
+        from src.rest_api import admin_auth
+        assert client.get("/export/customer").status_code == 401
+        assert client.get("/admin/traces").status_code == 401
+        assert client.get("/export/customer", headers={"Authorization": "Bearer wrong"}).status_code == 401
+
+        monkeypatch.setattr(admin_auth, "ADMIN_TOKEN", "")
+        response = client.get("/export/customer", headers={"Authorization": "Bearer "})
+        assert response.status_code == 403
+
+    def test_export_lag_holds_back_recent_rows(self, client, admin_client, analytics_sample_data, test_db, tmp_path):
+        """Test a lagged export stops before rows created within the lag, so resuming after its last id misses nothing"""
+        from src.services.export_service import export_table, last_exported_id
+        response = client.post("/purchase/", json={
+            "customer_id": analytics_sample_data["customer_2_id"],
+            "products": [{"product_id": 1, "ship_to_billing_address": True}]
+        })
+        assert response.status_code == 200
+
+        db = test_db()
+        paths = export_table(db, "purchase_fact", tmp_path, "parquet", lag_seconds=60)
+        assert [path.name for path in paths] == ["part-000000000001-000000000006.parquet"]
+        paths = export_table(db, "purchase_fact", tmp_path, "parquet", since_id=last_exported_id(tmp_path, "purchase_fact"),
+                             lag_seconds=60)
+        assert paths == []
+        paths = export_table(db, "purchase_fact", tmp_path, "parquet", since_id=last_exported_id(tmp_path, "purchase_fact"),
+                             lag_seconds=0)
+        db.close()
+        assert [path.name for path in paths] == ["part-000000000007-000000000007.parquet"]
+
+        response = admin_client.get("/export/purchase_product?format=arrow&lag_seconds=60")
+        assert pa.ipc.open_stream(response.content).read_all().column("id").to_pylist() == [1, 2, 3, 4, 5, 6]
+
+    def test_export_cli_writes_incremental_part_files(self, client, analytics_sample_data, test_db, tmp_path):
+        """Test the CLI export splits files by row count and continues after the last exported id"""
+        from src.services.export_service import export_table, last_exported_id
+        db = test_db()
+        paths = export_table(db, "purchase_product", tmp_path, "parquet", batch_size=4, rows_per_file=4)
+        assert [path.name for path in paths] == [
+            "part-000000000001-000000000004.parquet",
+            "part-000000000005-000000000006.parquet"
+        ]
+        assert last_exported_id(tmp_path, "purchase_product") == 6
+
+        response = client.post("/purchase/", json={
+            "customer_id": analytics_sample_data["customer_2_id"],
+            "products": [{"product_id": 1, "ship_to_billing_address": True}]
+        })
+        assert response.status_code == 200
+
+        paths = export_table(db, "purchase_product", tmp_path, "arrow", since_id=last_exported_id(tmp_path, "purchase_product"))
+        db.close()
+        assert [path.name for path in paths] == ["part-000000000007-000000000007.arrow"]
+        assert pa.ipc.open_file(paths[0]).read_all().column("id").to_pylist() == [7]
+        assert sorted(path.name for path in (tmp_path / "purchase_product").iterdir()) == [
+            "part-000000000001-000000000004.parquet",
+            "part-000000000005-000000000006.parquet",
+            "part-000000000007-000000000007.arrow"
+        ]
+
+
+if __name__ == "__main__":
+    pytest.main(["./test_export_rest_api.py", "-v"])
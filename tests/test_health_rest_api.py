@@ -0,0 +1,56 @@
+import pytest
+from sqlalchemy import create_engine, exc, text
+from src.data.pool import InstrumentedQueuePool, pool_registry
+
+
+@pytest.fixture(scope="function")
+def small_pool(tmp_path):
+    """A one connection pool registered with the health endpoints"""
+    engine = create_engine(
+        f"sqlite:///{tmp_path}/pool.sqlite", poolclass=InstrumentedQueuePool, pool_size=1, max_overflow=0, pool_timeout=0.05
+    )
+    pool_registry.instrument("test", engine)
+    yield engine
+    pool_registry.remove("test")
+    engine.dispose()
+
+
+class TestHealthEndpoints:
+
+    def test_pool_metrics(self, client, small_pool):
+        """Test checkouts, wait times, timeouts and invalidations are counted"""
+        with small_pool.connect() as conn:
+            conn.execute(text("select 1"))
+            stats = client.get("/health/pool").json()["pools"]["test"]
+            assert stats["in_use"] == 1
+            assert stats["capacity"] == 1
+            assert stats["saturated"] is True
+
+            with pytest.raises(exc.TimeoutError):
+                small_pool.connect()
+            conn.invalidate()
+
+        stats = client.get("/health/pool").json()["pools"]["test"]
+        assert stats["in_use"] == 0
+        assert stats["checkouts"] == 1
+        assert stats["timeouts"] == 1
+        assert stats["checkout_wait_seconds"]["max"] > 0
+        assert stats["invalidations"] == 1
+        assert stats["connects"] == 1
+        assert stats["saturated"] is False
+        assert "primary" in client.get("/health/pool").json()["pools"]
+
+    def test_readiness_degraded_when_pool_saturated(self, client, small_pool):
+        """Test the readiness probe fails while a pool has no free connections"""
+        assert client.get("/health/ready").json() == {"status": "ok", "saturated_pools": []}
+
+        with small_pool.connect():
+            response = client.get("/health/ready")
+            assert response.status_code == 503
+            assert response.json() == {"status": "degraded", "saturated_pools": ["test"]}
+
+        assert client.get("/health/ready").status_code == 200
+
+
+if __name__ == "__main__":
+    pytest.main(["./test_health_rest_api.py", "-v"])
@@ -0,0 +1,274 @@
+import pytest
+
+
+class TestMonitoring:
+
+    def test_server_timing_header(self, client, basic_sample_data):
+        """Test responses carry the request's time and database queries in Server-Timing"""
+        response = client.get("/customer/by-email/test@example.com")
+
+        assert response.status_code == 200
+        app_timing, db_timing = response.headers["server-timing"].split(", ")
+        assert app_timing.startswith("app;dur=")
+        assert db_timing.startswith("db;dur=")
+        assert db_timing.endswith('desc="1 queries"')
+
+    def test_metrics_per_route(self, client, basic_sample_data):
+        """Test requests are counted against their route template, with latency and queries"""
+        for email in ("test@example.com", "nobody@example.com"):
+            client.get(f"/customer/by-email/{email}")
+        client.get("/no/such/path")
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        lines = response.text.splitlines()
+
+        route = 'method="GET",route="/customer/by-email/{email}"'
+        assert f'http_requests_total{{{route},status="200"}} 1' in lines
+        assert f'http_requests_total{{{route},status="404"}} 1' in lines
+        assert 'http_requests_total{method="GET",route="unmatched",status="404"} 1' in lines
+        assert f'http_request_errors_total{{{route}}} 0' in lines
+        assert f'http_request_duration_seconds_bucket{{{route},le="+Inf"}} 2' in lines
+        assert f'http_request_duration_seconds_count{{{route}}} 2' in lines
+        assert f'http_request_db_queries_total{{{route}}} 2' in lines
+        assert any(line.startswith(f'http_request_duration_quantile_seconds{{{route},quantile="0.99"}}') for line in lines)
+        assert any(line.startswith('db_pool_connections_in_use{pool="primary"}') for line in lines)
+
+    def test_metrics_count_server_errors(self, client, monkeypatch):
+        """Test an unhandled exception counts as a 500 and an error"""
+        from fastapi.testclient import TestClient
+        from src.services.customer_service import CustomerService
+
+        async def fail(self, email):
+            raise RuntimeError("boom")
+
+        monkeypatch.setattr(CustomerService, "query_customer_by_email", fail)
+        response = TestClient(client.app, raise_server_exceptions=False).get("/customer/by-email/test@example.com")
+        assert response.status_code == 500
+
+        lines = client.get("/metrics").text.splitlines()
+        assert 'http_request_errors_total{method="GET",route="/customer/by-email/{email}"} 1' in lines
+
+    def test_query_budget_modes(self, tmp_path, caplog):
+        """Test a block over its query budget logs, warns or raises as configured"""
+        from sqlalchemy import create_engine, text
+        from src.monitoring import QueryBudget, QueryBudgetExceeded, QueryBudgetWarning
+        engine = create_engine(f"sqlite:///{tmp_path}/budget.sqlite")
+
+        def run_queries(count):
+            with engine.connect() as conn:
+                for _ in range(count):
+                    conn.execute(text("select 1"))
+
+        with QueryBudget(2, "two", mode="raise") as stats:
+            run_queries(2)
+        assert stats.statements == ["select 1", "select 1"]
+
+        with pytest.raises(QueryBudgetExceeded, match="three ran 3 queries, over its budget of 2"):
+            with QueryBudget(2, "three", mode="raise"):
+                run_queries(3)
+
+        with pytest.warns(QueryBudgetWarning):
+            with QueryBudget(2, "three", mode="warn"):
+                run_queries(3)
+
+        with QueryBudget(2, "three", mode="log"):
+            run_queries(3)
+        assert "three ran 3 queries, over its budget of 2" in caplog.text
+        engine.dispose()
+
+    def test_route_query_budget(self, client, basic_sample_data, monkeypatch):
+        """Test a route that runs more statements than its declared budget fails under QUERY_BUDGET_MODE=raise"""
+        from src.monitoring import QueryBudgetExceeded
+        from src.services.customer_service import CustomerService
+        query_customer_by_email = CustomerService.query_customer_by_email
+
+        async def query_twice(self, email):
+            await query_customer_by_email(self, email)
+            return await query_customer_by_email(self, email)
+
+        monkeypatch.setattr(CustomerService, "query_customer_by_email", query_twice)
+        with pytest.raises(QueryBudgetExceeded, match="GET /customer/by-email/{email} ran 2 queries"):
+            client.get("/customer/by-email/test@example.com")
+
+    def test_slow_query_log(self, client, admin_client, analytics_sample_data, monkeypatch):
+        """Test slow statements are logged with parameter shapes, the service method and a query plan"""
+        from src.monitoring import slow_query_log
+        monkeypatch.setattr(slow_query_log, "threshold_ms", 0)
+        monkeypatch.setattr(slow_query_log, "explain", True)
+
+        response = client.get("/analytics/orders-by-shipping-zip", params={"start": "2000-01-01T00:00:00"})
+        assert response.status_code == 200
+        # Plans are captured in the background
+        slow_query_log.wait_for_plans()
+
+        data = admin_client.get("/admin/slow-queries").json()
+        assert data["threshold_ms"] == 0
+        entry = next(
+            entry for entry in data["entries"]
+            if entry["service_call"] == "AnalyticsService.get_order_count_by_shipping_zip_code"
+        )
+        assert "FROM location JOIN purchase_product" in entry["statement"]
+        # as sent to the driver, which for SQLite is a string
+        assert entry["parameters"] == ["str"]
+        assert entry["duration_ms"] >= 0
+        assert entry["plan"]
+        assert entry["seq_scans"] == []
+
+        # Each distinct statement is explained once per interval
+        client.get("/analytics/orders-by-shipping-zip", params={"start": "2000-01-02T00:00:00"})
+        slow_query_log.wait_for_plans()
+        entries = admin_client.get("/admin/slow-queries", params={"limit": 1}).json()["entries"]
+        assert entries[0]["statement"] == entry["statement"]
+        assert entries[0]["plan"] is None
+
+        assert admin_client.delete("/admin/slow-queries").status_code == 200
+        assert admin_client.get("/admin/slow-queries").json()["entries"] == []
+
+    def test_slow_query_helpers(self):
+        """Test parameter shapes hide values, plans are scanned for full table reads and EXPLAINs are rate limited"""
+        from src.monitoring.slow_queries import parameter_shape, seq_scans
+        from src.monitoring.token_bucket import TokenBucket
+        assert parameter_shape((1, 2, 3, "a", None)) == ["int×3", "str", "NoneType"]
+        assert parameter_shape({"email": "secret@example.com"}) == {"email": "str"}
+        assert parameter_shape([(1, "a"), (2, "b")], executemany=True) == {"rows": 2, "row": ["int", "str"]}
+        assert seq_scans([
+            "Hash Join  (cost=1.09..2.21 rows=5 width=8) (actual time=0.1..0.2 rows=5 loops=1)",
+            "  ->  Seq Scan on purchase_product  (cost=0.00..1.05 rows=5 width=8)",
+            "  ->  Index Scan using location_pkey on location"
+        ]) == ["purchase_product"]
+        assert seq_scans(["SCAN purchase_product", "SEARCH location USING INTEGER PRIMARY KEY (rowid=?)"]) == ["purchase_product"]
+        assert seq_scans(["SCAN purchase_product USING COVERING INDEX ix_purchase_product_created_at_shipping"]) == []
+        assert seq_scans(["CO-ROUTINE anon_1", "SCAN product", "SCAN anon_1"]) == ["product"]
+
+        bucket = TokenBucket(2)
+        assert [bucket.take() for _ in range(3)] == [True, True, False]
+
+    def test_sync_service_methods_set_current_service_call(self):
+        """Test a sync service method names itself as the current service call while it runs, and only then"""
+        from src.monitoring import current_service_call, instrument_service
+
+        @instrument_service
+        class ExampleService:
+            def outer(self):
+                return current_service_call.get(), self.inner(), current_service_call.get()
+
+            def inner(self):
+                return current_service_call.get()
+
+        assert ExampleService().outer() == ("ExampleService.outer", "ExampleService.inner", "ExampleService.outer")
+        assert current_service_call.get() is None
+
+    def test_trace_spans(self, client, admin_client, basic_sample_data, monkeypatch):
+        """Test a sampled request is traced through its endpoint, service methods and SQL statements"""
+        from src.monitoring import tracer
+        monkeypatch.setattr(tracer, "sample_ratio", 1.0)
+        response = client.post("/purchase/", json={
+            "customer_id": basic_sample_data["customer_id"],
+            "products": [{"product_id": basic_sample_data["product1_id"], "ship_to_billing_address": True}]
+        })
+        assert response.status_code == 200
+        _, trace_id, root_id, flags = response.headers["traceparent"].split("-")
+        assert flags == "01"
+
+        trace = admin_client.get(f"/admin/traces/{trace_id}").json()
+        assert trace["resourceSpans"][0]["resource"]["attributes"] == [
+            {"key": "service.name", "value": {"stringValue": "radiantgraph"}}
+        ]
+        spans = trace["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        by_id = {span["spanId"]: span for span in spans}
+        assert all(span["traceId"] == trace_id for span in spans)
+        assert all(int(span["endTimeUnixNano"]) >= int(span["startTimeUnixNano"]) for span in spans)
+
+        def path(span):
+            names = []
+            while span is not None:
+                names.append(span["name"])
+                span = by_id.get(span.get("parentSpanId"))
+            return list(reversed(names))
+
+        root = by_id[root_id]
+        assert root["name"] == "POST /purchase/"
+        assert root["kind"] == 2 and "parentSpanId" not in root
+        assert {"key": "http.response.status_code", "value": {"intValue": "200"}} in root["attributes"]
+        paths = [path(span) for span in spans]
+        assert ["POST /purchase/", "purchase_rest_api.new_purchase", "PurchaseService.create_purchase",
+                "PurchaseService._validate_customer"] in paths
+        assert ["POST /purchase/", "purchase_rest_api.new_purchase", "PurchaseService.create_purchase",
+                "PurchaseService._process_purchase_items", "PurchaseService._validate_purchase_items",
+                "PurchaseService._resolve_shipping_location"] in paths
+        assert ["POST /purchase/", "purchase_rest_api.new_purchase", "PurchaseService.create_purchase",
+                "PurchaseService._create_purchase_records", "PurchaseService._commit"] in paths
+
+        statements = [span for span in spans if span["kind"] == 3]
+        assert statements
+        assert {span["name"] for span in statements} >= {"SELECT", "INSERT"}
+        # Every statement is run by some service method
+        assert all(by_id[span["parentSpanId"]]["name"].split(".")[0].endswith("Service") for span in statements)
+        attributes = {item["key"]: item["value"] for item in statements[0]["attributes"]}
+        assert attributes["db.system"] == {"stringValue": "sqlite"}
+        assert "test@example.com" not in str(trace)
+
+    def test_trace_sampling(self, client, admin_client, basic_sample_data, monkeypatch):
+        """Test requests are traced by the sample ratio, or the sampled flag of an incoming traceparent"""
+        from src.monitoring import tracer
+        url = "/customer/by-email/test@example.com"
+        parent_trace_id, parent_span_id = "4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7"
+
+        assert "traceparent" not in client.get(url).headers
+        response = client.get(url, headers={"traceparent": f"00-{parent_trace_id}-{parent_span_id}-01"})
+        _, trace_id, _, _ = response.headers["traceparent"].split("-")
+        assert trace_id == parent_trace_id
+
+        monkeypatch.setattr(tracer, "sample_ratio", 1.0)
+        response = client.get(url, headers={"traceparent": f"00-{parent_trace_id}-{parent_span_id}-00"})
+        assert "traceparent" not in response.headers
+        assert "traceparent" in client.get(url, headers={"traceparent": "not a traceparent"}).headers
+
+        traces = admin_client.get("/admin/traces").json()["traces"]
+        assert len(traces) == 2
+        root = traces[1]["resourceSpans"][0]["scopeSpans"][0]["spans"][0]
+        assert root["name"] == "GET /customer/by-email/{email}"
+        assert root["parentSpanId"] == parent_span_id
+        assert admin_client.get("/admin/traces/0123456789abcdef0123456789abcdef").status_code == 404
+
+    def test_traceparent_sampling_is_capped(self):
+        """Test a caller's sampled flag is followed only up to the per minute cap, past it the sample ratio decides"""
+        from src.monitoring import InMemorySpanExporter, Tracer
+        sampled = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+        tracer = Tracer(0.0, InMemorySpanExporter(10), 10, "test", parent_sampled_per_minute=2)
+        assert [tracer.start_trace("GET /", traceparent=sampled) is not None for _ in range(3)] == [True, True, False]
+
+        tracer.sample_ratio = 1.0
+        assert tracer.start_trace("GET /", traceparent=sampled) is not None
+        assert tracer.start_trace("GET /", traceparent=sampled.replace("-01", "-00")) is None
+
+    def test_trace_file_exporter(self, tmp_path):
+        """Test the file exporter appends one OTLP/JSON document a trace, and spans past the limit are dropped"""
+        import json
+        from src.monitoring import FileSpanExporter, Tracer
+        exporter = FileSpanExporter(str(tmp_path / "traces.jsonl"))
+        tracer = Tracer(1.0, exporter, 3, "test")
+
+        for _ in range(2):
+            with tracer.start_trace("GET /") as root:
+                for name in ("a", "b", "c"):
+                    span = tracer.start_span(name)
+                    if span is not None:
+                        with span:
+                            pass
+            tracer.export(root)
+
+        # Written in the background
+        exporter.flush()
+        lines = (tmp_path / "traces.jsonl").read_text().splitlines()
+        assert len(lines) == 2
+        spans = json.loads(lines[0])["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        assert [span["name"] for span in spans] == ["GET /", "a", "b"]
+        assert {"key": "trace.dropped_spans", "value": {"intValue": "1"}} in spans[0]["attributes"]
+        assert Tracer(0.0, None, 3, "test").start_trace("GET /") is None
+
+
+if __name__ == "__main__":
+    pytest.main(["./test_monitoring.py", "-v"])
@@ -0,0 +1,112 @@
+import pytest
+from fastapi.testclient import TestClient
+
+
+class TestProductEndpoints:
+
+    def test_create_product_success(self, client, test_db):
+        """Test successful product creation"""
+        response = client.post("/product/products/", json={
+            "name": "Gadget",
+            "description": "A shiny gadget",
+            "price": 1500
+        })
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["name"] == "Gadget"
+        assert data["price"] == 1500
+
+        # Verify data was persisted in database
+        from src.data.tables.product import Product
+        db = test_db()
+        product = db.query(Product).filter(Product.id == data["id"]).first()
+        assert product is not None
+        assert product.description == "A shiny gadget"
+        db.close()
+
+    def test_get_product_by_id_is_cached(self, client, basic_sample_data):
+        """Test repeated product lookups are served from the cache"""
+        product_id = basic_sample_data["product1_id"]
+
+        first = client.get(f"/product/products/{product_id}")
+        second = client.get(f"/product/products/{product_id}")
+
+        assert first.status_code == 200
+        assert second.json() == first.json()
+        assert first.json()["price"] == 1000
+
+        stats = client.get("/product/cache-stats").json()
+        assert stats["by_id"]["misses"] == 1
+        assert stats["by_id"]["hits"] == 1
+
+    def test_get_product_by_name(self, client, basic_sample_data):
+        """Test product retrieval by name"""
+        response = client.get("/product/products/by-name/Widget B")
+
+        assert response.status_code == 200
+        assert response.json()["id"] == basic_sample_data["product2_id"]
+        assert response.json()["price"] == 2000
+
+    def test_get_product_not_found(self, client):
+        """Test product retrieval with non-existent ID and name"""
+        response = client.get("/product/products/99999")
+        assert response.status_code == 404
+        assert response.json()["detail"] == "Product not found"
+
+        response = client.get("/product/products/by-name/Nope")
+        assert response.status_code == 404
+
+    def test_create_product_replaces_negative_cache_entry(self, client):
+        """Test a product looked up before it existed is visible right after it's created"""
+        assert client.get("/product/products/by-name/Gizmo").status_code == 404
+        assert client.get("/product/products/1").status_code == 404
+
+        create_response = client.post("/product/products/", json={
+            "name": "Gizmo",
+            "description": "A new gizmo",
+            "price": 700
+        })
+        assert create_response.status_code == 200
+        product_id = create_response.json()["id"]
+        assert product_id == 1
+
+        assert client.get("/product/products/by-name/Gizmo").json()["id"] == product_id
+        assert client.get(f"/product/products/{product_id}").json()["price"] == 700
+
+    def test_purchase_uses_product_cache(self, client, basic_sample_data):
+        """Test purchase validation reads product prices through the cache"""
+        purchase_data = {
+            "customer_id": basic_sample_data["customer_id"],
+            "products": [
+                {"product_id": basic_sample_data["product1_id"], "ship_to_billing_address": True},
+                {"product_id": basic_sample_data["product2_id"], "ship_to_billing_address": True}
+            ]
+        }
+
+        assert client.post("/purchase/", json=purchase_data).json()["total_cost"] == 3000
+        assert client.post("/purchase/", json=purchase_data).json()["total_cost"] == 3000
+
+        stats = client.get("/product/cache-stats").json()
+        assert stats["by_id"]["misses"] == 2
+        assert stats["by_id"]["hits"] == 2
+
+    def test_lookup_products(self, client, basic_sample_data):
+        """Test many products are resolved by id in one request, with misses as null"""
+        product1_id = basic_sample_data["product1_id"]
+        product2_id = basic_sample_data["product2_id"]
+        response = client.post("/product/products/lookup", json={"ids": [product2_id, 99999, product1_id, product2_id]})
+
+        assert response.status_code == 200
+        data = response.json()
+        assert list(data) == [str(product2_id), "99999", str(product1_id)]
+        assert data[str(product1_id)]["price"] == 1000
+        assert data[str(product2_id)]["name"] == "Widget B"
+        assert data["99999"] is None
+
+        stats = client.get("/product/cache-stats").json()
+        assert stats["by_id"]["misses"] == 3
+
+
+if __name__ == "__main__":
+    pytest.main(["./test_product_rest_api.py", "-v"])
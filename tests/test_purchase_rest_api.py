@@ -220,6 +220,38 @@ class TestPurchaseEndpoints:
         assert data["customer_id"] == basic_sample_data["customer_id"]
         assert data["total_cost"] == 1000
     
+    def test_get_purchase_expanded(self, client, basic_sample_data, assert_max_queries):
+        """Test expand loads line items, products, locations and customer in a fixed number of queries"""
+        def create_purchase(items: int) -> int:
+            response = client.post("/purchase/", json={
+                "customer_id": basic_sample_data["customer_id"],
+                "products": [
+                    {"product_id": basic_sample_data["product2_id"], "shipping_location_id": basic_sample_data["shipping_location_id"]}
+                ] * items
+            })
+            return response.json()["id"]
+
+        statement_counts = []
+        for purchase_id in (create_purchase(1), create_purchase(20)):
+            with assert_max_queries(5) as statements:
+                response = client.get(f"/purchase/{purchase_id}?expand=products,locations,customer")
+            statement_counts.append(len(statements))
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["total_cost"] == 40000
+        assert data["customer"]["id"] == basic_sample_data["customer_id"]
+        assert len(data["products"]) == 20
+        assert data["products"][0]["product"]["name"] == "Widget B"
+        assert data["products"][0]["shipping_location"]["id"] == basic_sample_data["shipping_location_id"]
+        assert data["products"][0]["shipping_location"]["location_type"] == "shipping"
+        assert statement_counts[0] == statement_counts[1]
+
+        data = client.get(f"/purchase/{purchase_id}?expand=customer").json()
+        assert set(data) == {"id", "customer_id", "total_cost", "customer"}
+        assert set(client.get(f"/purchase/{purchase_id}").json()) == {"id", "customer_id", "total_cost"}
+        assert client.get(f"/purchase/{purchase_id}?expand=refunds").status_code == 400
+
     def test_get_purchase_by_id_not_found(self, client):
         """Test purchase retrieval with non-existent ID"""
         response = client.get("/purchase/99999")
@@ -227,6 +259,23 @@ class TestPurchaseEndpoints:
         assert response.status_code == 404
         assert response.json()["detail"] == "Purchase not found"
     
+    def test_lookup_purchases(self, client, basic_sample_data, assert_max_queries):
+        """Test many purchases are resolved by id with a single query, with misses as null"""
+        purchase_data = {
+            "customer_id": basic_sample_data["customer_id"],
+            "products": [{"product_id": basic_sample_data["product1_id"], "ship_to_billing_address": True}]
+        }
+        purchase_ids = [client.post("/purchase/", json=purchase_data).json()["id"] for _ in range(3)]
+
+        with assert_max_queries(1):
+            response = client.post("/purchase/lookup", json={"ids": [*purchase_ids, 99999]})
+
+        assert response.status_code == 200
+        data = response.json()
+        assert [data[str(purchase_id)]["id"] for purchase_id in purchase_ids] == purchase_ids
+        assert data[str(purchase_ids[0])]["total_cost"] == 1000
+        assert data["99999"] is None
+
     def test_create_purchase_validation_no_shipping_option(self, client, basic_sample_data):
         """Test purchase creation validation when no shipping option is specified"""
         purchase_data = {
@@ -258,4 +307,306 @@ class TestPurchaseEndpoints:
         }
         
         response = client.post("/purchase/", json=purchase_data)
-        assert response.status_code == 422  # Validation error
\ No newline at end of file
+        assert response.status_code == 422  # Validation error
+
+    def test_create_purchase_multiple_new_locations(self, client, basic_sample_data, test_db):
+        """Test each item keeps its own inline shipping location when several are created at once"""
+        zip_codes = ["11111", "22222", "33333"]
+        purchase_data = {
+            "customer_id": basic_sample_data["customer_id"],
+            "products": [
+                {
+                    "product_id": basic_sample_data["product1_id"],
+                    "ship_to_billing_address": True
+                }
+            ] + [
+                {
+                    "product_id": basic_sample_data["product2_id"],
+                    "shipping_location": {
+                        "location_type": "shipping",
+                        "address_line_1": f"{index} Bulk St",
+                        "city": "Bulk City",
+                        "state": "TX",
+                        "zip_code": zip_code
+                    }
+                }
+                for index, zip_code in enumerate(zip_codes)
+            ]
+        }
+
+        response = client.post("/purchase/", json=purchase_data)
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["total_cost"] == 7000  # 1000 + 3 * 2000
+
+        from src.data.tables.purchase_product import PurchaseProduct
+        from src.data.tables.location import Location
+        db = test_db()
+        purchase_products = db.query(PurchaseProduct).filter(
+            PurchaseProduct.purchase_rollup_id == data["id"]
+        ).order_by(PurchaseProduct.id).all()
+        assert len(purchase_products) == 4
+        assert purchase_products[0].shipping_location_id == basic_sample_data["billing_location_id"]
+
+        locations = [db.get(Location, purchase_product.shipping_location_id) for purchase_product in purchase_products[1:]]
+        assert [location.zip_code for location in locations] == zip_codes
+        assert [location.address_line_1 for location in locations] == ["0 Bulk St", "1 Bulk St", "2 Bulk St"]
+        db.close()
+
+    def test_create_purchase_statement_count_independent_of_size(self, client, basic_sample_data, test_db, assert_max_queries):
+        """Test a large order issues the same number of statements as a single item order"""
+        def purchase_data(item_count):
+            return {
+                "customer_id": basic_sample_data["customer_id"],
+                "products": [
+                    {
+                        "product_id": basic_sample_data["product1_id"] if index % 2 else basic_sample_data["product2_id"],
+                        "shipping_location_id": basic_sample_data["shipping_location_id"]
+                    } if index % 3 else {
+                        "product_id": basic_sample_data["product1_id"],
+                        "shipping_location": {
+                            "location_type": "shipping",
+                            "address_line_1": f"{index} Count St",
+                            "city": "Count City",
+                            "state": "TX",
+                            "zip_code": "44444"
+                        }
+                    }
+                    for index in range(item_count)
+                ]
+            }
+
+        with assert_max_queries(10) as statements:
+            assert client.post("/purchase/", json=purchase_data(1)).status_code == 200
+        # The one item order has no existing location to look up
+        with assert_max_queries(len(statements) + 1):
+            assert client.post("/purchase/", json=purchase_data(200)).status_code == 200
+
+    def test_create_purchase_query_budget(self, client, basic_sample_data, assert_max_queries):
+        """Test a 50 item purchase, with new, existing and billing shipping locations, stays in a fixed number of statements"""
+        purchase_data = {
+            "customer_id": basic_sample_data["customer_id"],
+            "products": [
+                [
+                    {"product_id": basic_sample_data["product1_id"], "ship_to_billing_address": True},
+                    {"product_id": basic_sample_data["product2_id"], "shipping_location_id": basic_sample_data["shipping_location_id"]},
+                    {
+                        "product_id": basic_sample_data["product1_id"],
+                        "shipping_location": {
+                            "location_type": "shipping",
+                            "address_line_1": f"{index} Budget St",
+                            "city": "Budget City",
+                            "state": "TX",
+                            "zip_code": "77777"
+                        }
+                    }
+                ][index % 3]
+                for index in range(50)
+            ]
+        }
+
+        with assert_max_queries(16):
+            response = client.post("/purchase/", json=purchase_data)
+        assert response.status_code == 200
+        assert response.json()["total_cost"] == 33 * 1000 + 17 * 2000
+
+    def test_create_purchase_batch(self, client, basic_sample_data, test_db):
+        """Test bulk NDJSON purchase ingestion reports a result per line across chunks"""
+        import json
+        records = [
+            {
+                "customer_id": basic_sample_data["customer_id"],
+                "products": [{"product_id": basic_sample_data["product1_id"], "ship_to_billing_address": True}]
+            },
+            {
+                "customer_id": 99999,
+                "products": [{"product_id": basic_sample_data["product1_id"], "ship_to_billing_address": True}]
+            },
+            {
+                "customer_id": basic_sample_data["customer_id"],
+                "products": [
+                    {"product_id": basic_sample_data["product1_id"], "shipping_location_id": basic_sample_data["shipping_location_id"]},
+                    {
+                        "product_id": basic_sample_data["product2_id"],
+                        "shipping_location": {
+                            "location_type": "shipping",
+                            "address_line_1": "1 Batch Rd",
+                            "city": "Batch City",
+                            "state": "TX",
+                            "zip_code": "70000"
+                        }
+                    }
+                ]
+            },
+            {
+                "customer_id": basic_sample_data["customer_id"],
+                "products": [{"product_id": 99999, "ship_to_billing_address": True}]
+            },
+            {
+                "customer_id": basic_sample_data["customer_id"],
+                "products": [{"product_id": basic_sample_data["product2_id"]}]
+            },
+        ]
+        body = "\n".join(json.dumps(record) for record in records) + "\nnot json\n"
+
+        response = client.post(
+            "/purchase/batch?chunk_size=2",
+            content=body,
+            headers={"content-type": "application/x-ndjson"}
+        )
+
+        assert response.status_code == 200
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert [result["line"] for result in results] == [1, 2, 3, 4, 5, 6]
+        assert [result["status"] for result in results] == ["created", "error", "created", "error", "error", "error"]
+        assert results[0]["purchase"]["total_cost"] == 1000
+        assert results[2]["purchase"]["total_cost"] == 3000
+        assert "Customer with id 99999 not found" in results[1]["detail"]
+        assert "Product with id 99999 not found" in results[3]["detail"]
+
+        from src.data.tables.purchase_product import PurchaseProduct
+        from src.data.tables.purchase_rollup import PurchaseRollup
+        from src.data.tables.location import Location
+        db = test_db()
+        assert db.query(PurchaseRollup).count() == 2
+        purchase_products = db.query(PurchaseProduct).filter(
+            PurchaseProduct.purchase_rollup_id == results[2]["purchase"]["id"]
+        ).order_by(PurchaseProduct.id).all()
+        assert purchase_products[0].shipping_location_id == basic_sample_data["shipping_location_id"]
+        assert db.get(Location, purchase_products[1].shipping_location_id).zip_code == "70000"
+        db.close()
+
+    def test_create_purchase_batch_reports_failed_lines(self, client, basic_sample_data, test_db, monkeypatch):
+        """Test a chunk whose transaction fails is retried a purchase at a time, so only the failing line is an error"""
+        import json
+        from sqlalchemy.exc import OperationalError
+        from src.services.purchase_service import PurchaseService
+        create_purchases = PurchaseService.create_purchases
+
+        async def fail_on_three_items(self, requests):
+            if any(len(request.products) == 3 for request in requests):
+                raise OperationalError("INSERT", {}, Exception("disk I/O error"))
+            return await create_purchases(self, requests)
+
+        monkeypatch.setattr(PurchaseService, "create_purchases", fail_on_three_items)
+        records = [
+            {
+                "customer_id": basic_sample_data["customer_id"],
+                "products": [{"product_id": basic_sample_data["product1_id"], "ship_to_billing_address": True}] * count
+            }
+            for count in (1, 3, 2, 1)
+        ]
+        body = "\n".join(json.dumps(record) for record in records)
+
+        response = client.post("/purchase/batch?chunk_size=4", content=body)
+
+        assert response.status_code == 200
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert [result["status"] for result in results] == ["created", "error", "created", "created"]
+        assert results[1]["detail"] == "Could not write purchase on line 2"
+        assert [result["purchase"]["total_cost"] for result in results if result["status"] == "created"] == [1000, 2000, 1000]
+
+        from src.data.tables.purchase_rollup import PurchaseRollup
+        db = test_db()
+        assert db.query(PurchaseRollup).count() == 3
+        db.close()
+
+    def test_create_purchase_batch_worst_case_chunk_in_budget(self, client, basic_sample_data, test_db, caplog):
+        """Test a one line chunk shipping to a store and to an existing inline address, with a cold location cache, stays in budget"""
+        import json
+        from tests.conftest import TestDataFactory
+        db = test_db()
+        store_location_id = TestDataFactory.create_store_location(db).id
+        db.commit()
+        db.close()
+        record = {
+            "customer_id": basic_sample_data["customer_id"],
+            "products": [
+                {"product_id": basic_sample_data["product1_id"], "shipping_location_id": store_location_id},
+                {
+                    "product_id": basic_sample_data["product2_id"],
+                    "shipping_location": {
+                        "location_type": "shipping",
+                        "address_line_1": "456 Oak Ave",
+                        "city": "Other City",
+                        "state": "NY",
+                        "zip_code": "54321"
+                    }
+                }
+            ]
+        }
+
+        response = client.post("/purchase/batch", content=json.dumps(record))
+
+        assert response.status_code == 200
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert [result["status"] for result in results] == ["created"]
+        assert results[0]["purchase"]["total_cost"] == 3000
+        assert not [record for record in caplog.records if "over its budget" in record.getMessage()]
+
+    def test_create_purchase_batch_over_budget_reports_committed_lines(self, client, basic_sample_data, test_db,
+                                                                       monkeypatch, caplog):
+        """Test a chunk that goes over its query budget still reports the purchases it committed"""
+        import json
+        from src.rest_api import purchase_rest_api
+        monkeypatch.setattr(purchase_rest_api, "BATCH_CHUNK_QUERY_BUDGET", 1)
+        record = {
+            "customer_id": basic_sample_data["customer_id"],
+            "products": [{"product_id": basic_sample_data["product1_id"], "ship_to_billing_address": True}]
+        }
+        body = "\n".join(json.dumps(record) for _ in range(3))
+
+        response = client.post("/purchase/batch?chunk_size=2", content=body)
+
+        assert response.status_code == 200
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert [result["status"] for result in results] == ["created"] * 3
+        budget_errors = [record for record in caplog.records if "went over its query budget" in record.getMessage()]
+        assert len(budget_errors) == 2
+        assert "POST /purchase/batch lines 1-2" in str(budget_errors[0].exc_info[1])
+
+        from src.data.tables.purchase_rollup import PurchaseRollup
+        db = test_db()
+        assert db.query(PurchaseRollup).count() == 3
+        db.close()
+
+    def test_create_purchase_reuses_inline_location(self, client, basic_sample_data, test_db):
+        """Test repeated inline shipping addresses resolve to a single location row"""
+        def item(address_line_1, city):
+            return {
+                "product_id": basic_sample_data["product1_id"],
+                "shipping_location": {
+                    "location_type": "shipping",
+                    "address_line_1": address_line_1,
+                    "city": city,
+                    "state": "TX",
+                    "zip_code": "78901"
+                }
+            }
+
+        purchase_data = {
+            "customer_id": basic_sample_data["customer_id"],
+            "products": [item("789 Pine St", "New City"), item("789  pine st ", "NEW CITY")]
+        }
+        first = client.post("/purchase/", json=purchase_data)
+        second = client.post("/purchase/", json=purchase_data)
+        assert first.status_code == 200
+        assert second.status_code == 200
+
+        # Without the cache the existing row is found through the insert's conflict
+        from src.services.location_service import location_cache
+        location_cache.clear()
+        third = client.post("/purchase/", json=purchase_data)
+        assert third.status_code == 200
+
+        from src.data.tables.purchase_product import PurchaseProduct
+        from src.data.tables.location import Location
+        db = test_db()
+        shipping_location_ids = {
+            purchase_product.shipping_location_id for purchase_product in db.query(PurchaseProduct).all()
+        }
+        assert len(shipping_location_ids) == 1
+        assert None not in shipping_location_ids
+        assert db.query(Location).filter(Location.zip_code == "78901").count() == 1
+        db.close()
@@ -0,0 +1,131 @@
+import os
+import uuid
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from src.data.database import Base
+from src.data.read_replicas import replica_router
+from tests.conftest import TestDataFactory
+
+
+@pytest.fixture(scope="function")
+def replica_db(test_db):
+    """A second SQLite database standing in for a read replica, with its own data"""
+    db_filename = f"test_replica_{uuid.uuid4().hex}.sqlite"
+    replica_url = f"sqlite:///./{db_filename}"
+    replica_engine = create_engine(replica_url)
+    Base.metadata.create_all(bind=replica_engine)
+
+    db = sessionmaker(bind=replica_engine)()
+    billing_location = TestDataFactory.create_billing_location(db)
+    TestDataFactory.create_customer(db, billing_location.id, email="replica@example.com", first_name="Replica")
+    db.commit()
+    db.close()
+
+    replica_router.configure([replica_url], poolclass=NullPool)
+    yield replica_url
+
+    replica_router.configure([])
+    replica_engine.dispose()
+    if os.path.exists(db_filename):
+        os.remove(db_filename)
+
+
+class TestReadReplicas:
+
+    def test_reads_go_to_replica(self, client, replica_db):
+        """Test read only endpoints are served from the replica, not the primary"""
+        response = client.get("/customer/by-email/replica@example.com")
+        assert response.status_code == 200
+        assert response.json()["first_name"] == "Replica"
+
+        assert client.get("/analytics/orders-by-billing-zip").status_code == 200
+        assert replica_router.stats()[0]["sessions"] == 2
+
+    def test_read_your_writes_after_write(self, client, replica_db):
+        """Test a client that just wrote reads from the primary, where its write is"""
+        response = client.post("/customer/", json={
+            "email": "primary@example.com",
+            "phone_number": "5550000000",
+            "first_name": "Primary",
+            "last_name": "Writer",
+            "billing_address": {
+                "location_type": "billing",
+                "address_line_1": "1 Primary St",
+                "city": "Anytown",
+                "state": "CA",
+                "zip_code": "12345"
+            }
+        })
+        assert response.status_code == 200
+        assert "read_primary_until" in response.cookies
+
+        assert client.get("/customer/by-email/primary@example.com").status_code == 200
+        assert client.get("/customer/by-email/replica@example.com").status_code == 404
+
+        # Another client without the cookie still reads from the replica
+        other_client = TestClient(client.app)
+        assert other_client.get("/customer/by-email/primary@example.com").status_code == 404
+
+    def test_read_your_writes_skips_shared_analytics(self, client, replica_db, analytics_sample_data):
+        """Test a client reading its own writes doesn't get analytics computed on, or cached from, the replica"""
+        from src.services.analytics_cache import analytics_cache
+        other_client = TestClient(client.app)
+        assert other_client.get("/analytics/orders-by-billing-zip").json() == []
+
+        response = client.post("/purchase/", json={
+            "customer_id": analytics_sample_data["customer_2_id"],
+            "products": [{"product_id": 1, "ship_to_billing_address": True}]
+        })
+        assert response.status_code == 200
+        assert client.get("/analytics/orders-by-billing-zip").json() == [
+            {"zip_code": "12345", "order_count": 4},
+            {"zip_code": "54321", "order_count": 2}
+        ]
+        assert other_client.get("/analytics/orders-by-billing-zip").json() == []
+        # The primary's result went neither into the cache nor over the replica's one
+        assert (analytics_cache.stats()["misses"], analytics_cache.stats()["hits"]) == (1, 1)
+
+    def test_replica_connect_timeout_falls_back_to_primary(self, client, replica_db, monkeypatch):
+        """Test a replica whose connection attempt times out is marked down and the primary is read"""
+        import asyncio
+        from sqlalchemy.ext.asyncio import AsyncSession
+        connection = AsyncSession.connection
+
+        async def timing_out(session, *args, **kwargs):
+            if session.bind is replica_router.engines[0]:
+                raise asyncio.TimeoutError()
+            return await connection(session, *args, **kwargs)
+
+        monkeypatch.setattr(AsyncSession, "connection", timing_out)
+        assert client.get("/customer/by-email/replica@example.com").status_code == 404
+        assert replica_router.stats()[0]["healthy"] is False
+
+    def test_round_robin_and_unhealthy_replica(self, client, replica_db, tmp_path):
+        """Test replicas take turns and one that can't connect is skipped"""
+        broken_url = f"sqlite:///{tmp_path}/missing/replica.sqlite"
+        replica_router.configure([replica_db, broken_url, replica_db], poolclass=NullPool)
+
+        for _ in range(4):
+            response = client.get("/customer/by-email/replica@example.com")
+            assert response.status_code == 200
+
+        stats = replica_router.stats()
+        assert [replica["healthy"] for replica in stats] == [True, False, True]
+        assert stats[1]["failures"] == 1
+        assert stats[0]["sessions"] + stats[2]["sessions"] == 4
+        assert stats[0]["sessions"] >= 1 and stats[2]["sessions"] >= 1
+
+    def test_no_healthy_replica_falls_back_to_primary(self, client, replica_db, tmp_path):
+        """Test reads fall back to the primary when no replica can be reached"""
+        replica_router.configure([f"sqlite:///{tmp_path}/missing/replica.sqlite"], poolclass=NullPool)
+
+        response = client.get("/customer/by-email/replica@example.com")
+        assert response.status_code == 404
+        assert replica_router.stats()[0]["healthy"] is False
+
+
+if __name__ == "__main__":
+    pytest.main(["./test_read_replicas.py", "-v"])
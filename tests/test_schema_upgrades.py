@@ -0,0 +1,86 @@
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import sessionmaker
+from src.data.database import Base
+from src.data.schema_upgrades import create_schema
+from src.data.tables.customer import Customer
+from src.data.tables.location import Location, location_fingerprint
+from src.data.tables.purchase_product import PurchaseProduct
+
+
+@pytest.fixture(scope="function")
+def old_db(tmp_path):
+    """A database created before location.fingerprint and the purchase_product time buckets existed"""
+    engine = create_engine(f"sqlite:///{tmp_path}/old.sqlite")
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(text("DROP INDEX ix_location_fingerprint"))
+        connection.execute(text("ALTER TABLE location DROP COLUMN fingerprint"))
+        connection.execute(text("DROP INDEX ix_purchase_product_purchase_hour"))
+        connection.execute(text("ALTER TABLE purchase_product DROP COLUMN purchase_hour"))
+        connection.execute(text("ALTER TABLE purchase_product DROP COLUMN purchase_day_of_week"))
+    yield engine
+    engine.dispose()
+
+
+def insert_location(connection, address_line_1: str, city: str) -> int:
+    return connection.execute(text(
+        "INSERT INTO location (location_type, address_line_1, address_line_2, city, state, zip_code) "
+        "VALUES ('SHIPPING', :address_line_1, '', :city, 'TX', '78901')"
+    ), {"address_line_1": address_line_1, "city": city}).lastrowid
+
+
+class TestSchemaUpgrades:
+
+    def test_location_fingerprints_backfilled_and_duplicates_merged(self, old_db):
+        """Test upgrading adds location.fingerprint, fills it in and merges addresses that differ only in case or spacing"""
+        with old_db.begin() as connection:
+            first_id = insert_location(connection, "789 Pine St", "New City")
+            duplicate_id = insert_location(connection, "789  pine st ", "NEW CITY")
+            other_id = insert_location(connection, "1 Elm St", "New City")
+            connection.execute(text(
+                "INSERT INTO customer (billing_location_id, email, phone_number, first_name, last_name) "
+                "VALUES (:location_id, 'old@example.com', '5550000000', 'Old', 'Customer')"
+            ), {"location_id": duplicate_id})
+            connection.execute(text(
+                "INSERT INTO purchase_product (shipping_location_id) VALUES (:first_id), (:duplicate_id), (:other_id)"
+            ), {"first_id": first_id, "duplicate_id": duplicate_id, "other_id": other_id})
+
+        for _ in range(2):
+            with old_db.begin() as connection:
+                create_schema(connection)
+
+        indexes = {index["name"]: index for index in inspect(old_db).get_indexes("location")}
+        assert indexes["ix_location_fingerprint"]["unique"]
+
+        db = sessionmaker(bind=old_db)()
+        locations = db.query(Location).order_by(Location.id).all()
+        assert [location.id for location in locations] == [first_id, other_id]
+        assert locations[0].fingerprint == location_fingerprint(
+            locations[0].location_type, "789 Pine St", "", "New City", "TX", "78901"
+        )
+        assert db.query(Customer).one().billing_location_id == first_id
+        purchase_products = db.query(PurchaseProduct).order_by(PurchaseProduct.id).all()
+        assert [purchase_product.shipping_location_id for purchase_product in purchase_products] == [first_id, first_id, other_id]
+        db.close()
+
+    def test_purchase_time_buckets_backfilled(self, old_db):
+        """Test upgrading adds purchase_product.purchase_hour and purchase_day_of_week and fills them in from created_at"""
+        with old_db.begin() as connection:
+            connection.execute(text(
+                "INSERT INTO purchase_product (created_at) VALUES ('2024-01-06 14:30:00'), ('2024-01-08 09:05:00')"
+            ))
+
+        with old_db.begin() as connection:
+            create_schema(connection)
+
+        db = sessionmaker(bind=old_db)()
+        purchase_products = db.query(PurchaseProduct).order_by(PurchaseProduct.id).all()
+        # A Saturday and a Monday
+        assert [(row.purchase_hour, row.purchase_day_of_week) for row in purchase_products] == [(14, 6), (9, 1)]
+        db.close()
+        assert "ix_purchase_product_purchase_hour" in {index["name"] for index in inspect(old_db).get_indexes("purchase_product")}
+
+
+if __name__ == "__main__":
+    pytest.main(["./test_schema_upgrades.py", "-v"])